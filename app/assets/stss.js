@@ -0,0 +1,133 @@
+/*
+ * Clientside callbacks for the STS dataviz app (see dash_app.py).
+ *
+ * Charts with view toggles are built in the browser from the compact count
+ * arrays built by curated_data.get_count_cube, so that switching between
+ * views doesn't need a request to the server (and so that the page doesn't
+ * have to include the figure as well as the counts).
+ */
+
+/*
+ * Return the categories (indices into `totals`) to fold into a single
+ * "Other" category, in descending order of total, as crosstab.fold_small
+ * does for the charts built on the server: all but the `fold.top_n` largest,
+ * and those with less than `fold.min_share` of the grand total.  A single
+ * category is never folded on its own.
+ */
+function foldedCategories(categories, totals, fold) {
+    if (!fold) {
+        return [];
+    }
+    var grandTotal = categories.reduce(function(sum, c) { return sum + totals[c]; }, 0);
+    var byTotal = categories.slice().sort(function(a, b) { return (totals[b] - totals[a]) || (a - b); });
+    var folded = byTotal.filter(function(c, rank) {
+        return ((fold.top_n !== null) && (rank >= fold.top_n)) ||
+            ((fold.min_share !== null) && (totals[c] < fold.min_share * grandTotal));
+    });
+    return (folded.length < 2) ? [] : folded;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    stss: {
+        /*
+         * Build a stacked bar chart from a count cube.  `view` is "absolute"
+         * or "percent" (each bar as a percentage of its total), and `scope` is
+         * "public" or "all".
+         */
+        stackedCounts: function(view, scope, cube) {
+            if (!cube) {
+                return window.dash_clientside.no_update;
+            }
+            var nCat = cube.categories.length;
+            var nX = cube.x.length;
+            var nScopes = (scope === 'public') ? 1 : 2;
+            var counts = [];
+            var xTotals = new Array(nX).fill(0);
+            var i, j, k;
+            for (i = 0; i < nCat; i++) {
+                var row = new Array(nX).fill(0);
+                for (k = 0; k < nScopes; k++) {
+                    var offset = (k * nCat + i) * nX;
+                    for (j = 0; j < nX; j++) {
+                        row[j] += cube.counts[offset + j];
+                    }
+                }
+                for (j = 0; j < nX; j++) {
+                    xTotals[j] += row[j];
+                }
+                counts.push(row);
+            }
+
+            var order = [];
+            for (j = 0; j < nX; j++) {
+                order.push(j);
+            }
+            if (cube.sort) {
+                order.sort(function(a, b) { return (xTotals[b] - xTotals[a]) || (a - b); });
+            }
+            var xLabels = order.map(function(j) { return cube.x[j]; });
+
+            function value(c, j) {
+                if (view === 'percent') {
+                    return xTotals[j] ? 100 * c / xTotals[j] : null;
+                }
+                return c || null;
+            }
+
+            // Categories with no counts (in this scope) aren't shown at all.
+            var present = [];
+            var catTotals = counts.map(function(row) {
+                return row.reduce(function(sum, c) { return sum + c; }, 0);
+            });
+            for (i = 0; i < nCat; i++) {
+                if (catTotals[i] > 0) {
+                    present.push(i);
+                }
+            }
+            var folded = foldedCategories(present, catTotals, cube.fold);
+
+            var data = [];
+            present.forEach(function(i) {
+                if (folded.indexOf(i) >= 0) {
+                    return;
+                }
+                var trace = {type: 'bar', name: cube.categories[i], x: xLabels,
+                             y: order.map(function(j) { return value(counts[i][j], j); })};
+                if (cube.colors) {
+                    trace.marker = {color: cube.colors[i]};
+                }
+                data.push(trace);
+            });
+            if (folded.length) {
+                var other = order.map(function(j) {
+                    return folded.reduce(function(sum, i) { return sum + counts[i][j]; }, 0);
+                });
+                // The breakdown of "Other", shown when hovering over it.
+                var detail = order.map(function(j) {
+                    return folded.filter(function(i) { return counts[i][j] > 0; }).map(function(i) {
+                        var v = value(counts[i][j], j);
+                        var text = (view === 'percent') ? v.toFixed(1) + '%' : v.toLocaleString('en');
+                        return cube.categories[i] + ': ' + text;
+                    }).join('<br>');
+                });
+                data.push({
+                    type: 'bar',
+                    name: cube.fold.label,
+                    x: xLabels,
+                    y: order.map(function(j, k) { return value(other[k], j); }),
+                    marker: {color: cube.fold.color},
+                    customdata: detail,
+                    hovertemplate: '%{x}<br>' + cube.fold.label + ': %{y}<br>%{customdata}<extra></extra>'
+                });
+            }
+            return {
+                data: data,
+                layout: {
+                    barmode: 'stack',
+                    title: cube.title,
+                    yaxis: (view === 'percent') ? {ticksuffix: '%', range: [0, 100]} : {}
+                }
+            };
+        }
+    }
+});
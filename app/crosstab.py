@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Counting, summing and cross-tabulation of columns which may contain
+Combos.
+
+The alternative is to "flatten" a DataFrame (see fetch_data.flatten_by) and
+then use the usual pandas tools, but that builds a new row (a full copy of
+the original) for every value of every Combo, and flattening by two columns
+builds a row for every pair of values.  Here, each column is instead encoded
+once as a pair of integer arrays (the row each value belongs to, and a code
+for the value itself), and counts are computed from those arrays with
+numpy, without building any intermediate DataFrames.
+"""
+
+from typing import Any, Dict, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame, Series
+
+import fetch_data as fd
+
+
+class Encoded(NamedTuple):
+    """A column encoded as parallel arrays of row positions and value codes,
+    with one entry for each (non-null) value in the column.  Entries are in
+    row order."""
+    rows: np.ndarray
+    codes: np.ndarray
+    categories: pd.Index
+    n_rows: int
+    name: Any
+
+    def counts_per_row(self) -> np.ndarray:
+        return np.bincount(self.rows, minlength=self.n_rows)
+
+
+def _isnull(value: Any) -> bool:
+    # pd.isnull returns an array for tuples (such as nominal amounts), so
+    # just check for None and NaN.
+    return (value is None) or (value != value)
+
+
+def encode(series: Series) -> Encoded:
+    """Encode a column which may contain Combos.  This is the only step which
+    handles the values as Python objects, and it is linear in the number of
+    values."""
+    rows = []
+    values = []
+    for i, v in enumerate(series):
+        if isinstance(v, fd.Combo):
+            rows.extend([i] * len(v))
+            values.extend(v.values)
+        elif not _isnull(v):
+            rows.append(i)
+            values.append(v)
+    codes, categories = pd.factorize(pd.Series(values, dtype=object), sort=True)
+    return Encoded(np.array(rows, dtype=np.int64), codes.astype(np.int64), pd.Index(categories, name=series.name),
+                   len(series), series.name)
+
+
+def _row_weights(enc: Encoded, weights: Optional[Sequence[float]], split: bool = False) -> Optional[np.ndarray]:
+    if weights is None:
+        return None
+    weights = np.nan_to_num(np.asarray(weights, dtype=float))
+    if len(weights) != enc.n_rows:
+        raise ValueError('weights must have one entry for each row')
+    if split:
+        weights = weights / np.maximum(enc.counts_per_row(), 1)
+    return weights[enc.rows]
+
+
+def _finalise(values: np.ndarray, weighted: bool) -> np.ndarray:
+    return values if weighted else values.astype(np.int64)
+
+
+def group_count(series: Series, weights: Sequence[float] = None, split: bool = False) -> Series:
+    """Count the number of rows in which each value appears (or, if `weights`
+    is given, sum the weights of those rows, treating NaN as 0).  Equivalent
+    to `flatten_by(df, col).groupby(col).count()` (or `.sum()`).
+
+    If `split` is True, the weight of a row with a Combo is split evenly
+    between the Combo's values, rather than counted in full for each of them,
+    so that weights sum to the same total before and after grouping."""
+    enc = encode(series)
+    counts = np.bincount(enc.codes, weights=_row_weights(enc, weights, split), minlength=len(enc.categories))
+    return Series(_finalise(counts, weights is not None), index=enc.categories, name=series.name)
+
+
+def _pairs(a: Encoded, b: Encoded):
+    """Return codes for each pair of values (one from `a` and one from `b`)
+    appearing in the same row, and the row each pair belongs to.
+
+    The number of pairs is the sum over rows of the product of the number of
+    values from each column in that row.  As nearly all rows have one value
+    in each column, that is close to the number of rows."""
+    b_counts = b.counts_per_row()
+    b_starts = np.cumsum(b_counts) - b_counts
+    reps = b_counts[a.rows]
+    total = int(reps.sum())
+    out_starts = np.cumsum(reps) - reps
+    b_idx = np.arange(total) - np.repeat(out_starts, reps) + np.repeat(b_starts[a.rows], reps)
+    return np.repeat(a.codes, reps), b.codes[b_idx], np.repeat(a.rows, reps)
+
+
+def crosstab(index: Series, columns: Series, weights: Sequence[float] = None, margins: bool = False,
+             margins_name: str = 'All') -> DataFrame:
+    """Count the co-occurrences of values in two columns which may contain
+    Combos (or, if `weights` is given, sum the weights of the rows in which
+    they co-occur, treating NaN as 0).  Equivalent to calling `pd.crosstab` on a DataFrame
+    flattened by both columns.  Categories are sorted.  If `margins` is True,
+    add a row and column of totals, named `margins_name`."""
+    a = encode(index)
+    b = encode(columns)
+    a_codes, b_codes, rows = _pairs(a, b)
+    pair_weights = None if weights is None else np.nan_to_num(np.asarray(weights, dtype=float))[rows]
+    n_a = len(a.categories)
+    n_b = len(b.categories)
+    table = np.bincount(a_codes * n_b + b_codes, weights=pair_weights, minlength=n_a * n_b).reshape(n_a, n_b)
+    table = DataFrame(_finalise(table, weights is not None), index=a.categories, columns=b.categories)
+    # Only keep values which co-occur with a non-null value in the other column, as pd.crosstab does.
+    table = table.loc[table.any(axis=1), table.any(axis=0)].copy()
+    if margins:
+        table[margins_name] = table.sum(axis=1)
+        table.loc[margins_name] = table.sum(axis=0)
+    return table
+
+
+def stacked_counts(level_0: Series, level_1: Series, weights: Sequence[float] = None) -> Series:
+    """Return counts (or sums of `weights`) for each co-occurring pair of
+    values from the two columns, as a Series with a two-level index and with
+    no zero entries (as returned by `flatten_by(...).groupby([level_0,
+    level_1]).count()`).  Suitable for passing to
+    curated_data.get_stacked_bars."""
+    stacked = crosstab(level_0, level_1, weights).stack()
+    stacked = stacked[stacked != 0]
+    stacked.index = stacked.index.remove_unused_levels()
+    return stacked
+
+
+def fold_small(table: DataFrame, top_n: int = None, min_share: float = None,
+               other: str = 'Other') -> Tuple[DataFrame, DataFrame]:
+    """Fold the smaller rows of `table` (eg, the traces of a stacked bar
+    chart, or the slices of a pie chart) into a single row named `other`,
+    keeping at most the `top_n` rows with the largest totals and only those
+    whose total is at least `min_share` of the grand total.  NaN counts as 0.
+
+    Returns the folded table (with `other` as its last row, if anything was
+    folded) and the rows that were folded into it, in descending order of
+    total.  A single row is never folded on its own, as that would just
+    rename it."""
+    totals = table.fillna(0).sum(axis=1).to_numpy(dtype=float)
+    keep = np.ones(len(totals), dtype=bool)
+    if (top_n is not None) and (len(totals) > top_n):
+        keep[np.argsort(-totals, kind='stable')[top_n:]] = False
+    if min_share is not None:
+        keep &= totals >= min_share * totals.sum()
+    if (~keep).sum() < 2:
+        return table, table.iloc[0:0]
+    folded = table.iloc[np.flatnonzero(~keep)[np.argsort(-totals[~keep], kind='stable')]]
+    result = table.iloc[np.flatnonzero(keep)].copy()
+    result.loc[other] = folded.sum(axis=0, min_count=1)
+    return result, folded
+
+
+class Amounts(NamedTuple):
+    """A column of amounts (tuples of currency and amount, or Combos of such
+    tuples) encoded as parallel arrays, with one entry for each amount."""
+    rows: np.ndarray
+    currency_codes: np.ndarray
+    currencies: pd.Index
+    amounts: np.ndarray
+    n_rows: int
+
+
+def encode_amounts(series: Series) -> Amounts:
+    rows = []
+    currencies = []
+    amounts = []
+    for i, v in enumerate(series):
+        for ccy, amount in (v if isinstance(v, fd.Combo) else [] if _isnull(v) else [v]):
+            rows.append(i)
+            currencies.append(ccy)
+            amounts.append(amount)
+    codes, categories = pd.factorize(pd.Series(currencies, dtype=object), sort=True)
+    return Amounts(np.array(rows, dtype=np.int64), codes.astype(np.int64), pd.Index(categories),
+                   np.array(amounts, dtype=float), len(series))
+
+
+def to_eur(amounts: Amounts, rates: Dict[str, float]) -> np.ndarray:
+    """Convert each amount to EUR.  `rates` are XXX/EUR rates (as returned by
+    fetch_data.get_fx), so amounts are divided by them."""
+    rates = dict(rates, EUR=1.0)
+    currency_rates = np.array([rates[c] for c in amounts.currencies], dtype=float)
+    return amounts.amounts / currency_rates[amounts.currency_codes]
+
+
+def total_per_row(amounts: Amounts, rates: Dict[str, float]) -> np.ndarray:
+    """Return the total EUR value of the amounts in each row (NaN for rows
+    with no amounts)."""
+    totals = np.bincount(amounts.rows, weights=to_eur(amounts, rates), minlength=amounts.n_rows)
+    totals[np.bincount(amounts.rows, minlength=amounts.n_rows) == 0] = np.nan
+    return totals
+
+
+def total_by_currency(amounts: Amounts, rates: Dict[str, float]) -> Series:
+    """Return the total EUR value of the amounts denominated in each
+    currency."""
+    totals = np.bincount(amounts.currency_codes, weights=to_eur(amounts, rates), minlength=len(amounts.currencies))
+    return Series(totals, index=amounts.currencies.rename('Currency'))
@@ -7,46 +7,55 @@ the Dash app.
 
 from datetime import datetime
 from copy import deepcopy
-from os.path import join, exists
-from pickle import load, dump
+from os import environ, replace
+from os.path import join, exists, getmtime
+from pickle import load
+from shutil import copyfile
 import logging
 
+import numpy as np
 import pandas as pd
 
 import plotly.graph_objects as go
 from plotly.express.colors import qualitative as colors
 
 import fetch_data as fd
-
-# Get main DataFrames we will be working on.  Save full DataFrame down as
-# a "snapshot" so we don't have to go through the process of searching FIRDS
-# data, etc, every time.
-
-snapshot_file = join(fd.data_dir, 'snapshot')
-if exists(snapshot_file):
-    logging.info('Loading data from snapshot.')
-    with open(snapshot_file, 'rb') as f:
-        df = load(f)
-else:
-    logging.info('No data found; building data from sources.')
-    sts_parser = fd.RegisterParser()
-    to_end_march = sts_parser.get_between(to_date=datetime(2020, 3, 31))
-    df = fd.add_issuer_data(to_end_march)
-    with open(snapshot_file, 'wb') as f:
-        dump(df, f)
-
-df_pub = df.loc[df['Private or Public'] == 'Public']
+from crosstab import encode, crosstab, group_count, stacked_counts, encode_amounts, total_per_row, total_by_currency, fold_small
+import metrics
+from pipeline import data_pipeline
 
 def get_month_label(ts: pd.Timestamp) -> str:
     return ts.strftime('%b %Y')
 
-def get_stacked_bars(series_or_df, colormap=None, sort=False, fix_timestamps=False):
+# Stacked bar and pie charts show at most this many categories (traces or
+# slices), and only those making up at least this share of the total; the
+# rest are folded into a single "Other" category, whose breakdown is shown
+# when hovering over it.  This keeps the number of traces (and so the size of
+# the figures and the time they take to render) bounded as new countries and
+# currency combinations appear in the data.
+MAX_CATEGORIES = 10
+MIN_SHARE = 0.01
+OTHER_LABEL = 'Other'
+OTHER_COLOR = '#BBBBBB'
+
+def get_other_detail(folded):
+    """Return hover text listing the non-zero values in each column of
+    `folded` (the rows folded into "Other")."""
+    return ['<br>'.join(f'{label}: {value:,.0f}' for label, value in col.items() if value)
+            for _, col in folded.fillna(0).items()]
+
+def get_stacked_bars(series_or_df, colormap=None, sort=False, fix_timestamps=False,
+                     top_n=MAX_CATEGORIES, min_share=MIN_SHARE):
     """Takes a Series that has been taken from a DataFrame grouped by
     two columns.  Returns a list of Bars, where the x value (label) is
     the "right" index (level 1) and the y values are the "left" index
     (level 0).
     
     If sort is True, sort by total height of stacked bar.
+    
+    Level-0 values beyond the `top_n` largest, or with less than
+    `min_share` of the total, are combined into a single "Other" bar
+    (see crosstab.fold_small).
     """
     
     if isinstance(series_or_df, pd.DataFrame):
@@ -56,144 +65,439 @@ def get_stacked_bars(series_or_df, colormap=None, sort=False, fix_timestamps=Fal
     else:
         raise TypeError('get_stacked_bars takes a DataFrame or a Series')
     
-    y_labels = series.index.levels[0] 
-    x_values = list(series.index.levels[1]) 
-
+    # Rows are the level-0 values (one for each bar) and columns the level-1 values (x labels).
+    table = series.unstack(level=1).reindex(index=series.index.levels[0], columns=series.index.levels[1])
+    
     if sort:
-        x_values.sort(key=lambda x: sum([series[y][x] for y in y_labels if x in series[y]]), reverse=True)
+        table = table[table.sum(axis=0).sort_values(ascending=False, kind='stable').index]
         
     if fix_timestamps:
-        x_labels = [get_month_label(t) for t in x_values]
+        x_labels = [get_month_label(t) for t in table.columns]
     else:
-        x_labels = x_values
+        x_labels = list(table.columns)
+    
+    table, folded = fold_small(table, top_n, min_share, OTHER_LABEL)
+    # Missing values are left out of the bars, rather than shown as 0.
+    table = table.astype(object).where(table.notnull(), None)
     
     bars = []
-    for y in y_labels:
-        y_data = [] # country_data
-        for x in x_values:
-            try:
-                y_data.append(series[y][x])
-            except KeyError:
-                y_data.append(None)
-        if colormap:
+    for y, y_data in table.iterrows():
+        if not folded.empty and y == OTHER_LABEL:
+            bars.append(go.Bar(
+                name=OTHER_LABEL,
+                x=x_labels,
+                y=list(y_data),
+                marker={'color': OTHER_COLOR},
+                customdata=get_other_detail(folded),
+                hovertemplate='%{x}<br>' + OTHER_LABEL + ': %{y}<br>%{customdata}<extra></extra>'
+            ))
+        elif colormap:
             bars.append(go.Bar(
             name=str(y),
             x=x_labels,
-            y=y_data,
+            y=list(y_data),
             marker={'color': colormap[y]}
             ))
         else:
             bars.append(go.Bar(
                 name=str(y),
                 x=x_labels,
-                y=y_data
+                y=list(y_data)
             ))
     return bars
 
+def get_pie(series, colormap=None, top_n=MAX_CATEGORIES, min_share=MIN_SHARE):
+    """Return the data for a pie chart of `series`, with small slices
+    folded into an "Other" slice (see crosstab.fold_small)."""
+    table, folded = fold_small(series.to_frame(), top_n, min_share, OTHER_LABEL)
+    values = table.iloc[:, 0]
+    labels = [str(label) for label in values.index]
+    detail = [''] * len(values)
+    if not folded.empty:
+        detail[-1] = '<br>' + get_other_detail(folded)[0]
+    pie = {
+        'values': list(values),
+        'labels': labels,
+        'customdata': detail,
+        'hovertemplate': '%{label}: %{value} (%{percent})%{customdata}<extra></extra>',
+        'type': 'pie'
+    }
+    if colormap:
+        pie['marker'] = {'colors': [OTHER_COLOR if (not folded.empty and i == len(values) - 1) else colormap[v]
+                                    for i, v in enumerate(values.index)]}
+    return pie
+
+def get_count_cube(df, category_col, x_col=None, colormap=None, sort=False, title='',
+                   top_n=MAX_CATEGORIES, min_share=MIN_SHARE):
+    """Count securitisations by `category_col` and by `x_col` (or by month
+    of notification, if `x_col` is None), separately for public and private
+    securitisations, for the clientside callbacks in assets/stss.js, which
+    build stacked bar charts from the counts in the browser.
+    
+    The counts are returned as a flat list of integers, indexed by
+    (scope, category, x), where the scopes are public (0) and private (1),
+    along with the labels (and colours) of the categories and x values, and
+    the parameters with which the browser folds small categories into
+    "Other" (as get_stacked_bars does).  Only columns without Combos are
+    supported.
+    """
+    categories = category_order(df[category_col].dropna())
+    cat_codes = pd.Categorical(df[category_col], categories=categories).codes
+    if x_col is None:
+        months = df.index.to_period('M')
+        x_periods = pd.period_range(months.min(), months.max(), freq='M')
+        x_codes = months.asi8 - x_periods[0].ordinal
+        x_labels = [get_month_label(p.to_timestamp()) for p in x_periods]
+    else:
+        x_values = category_order(df[x_col].dropna())
+        x_codes = pd.Categorical(df[x_col], categories=x_values).codes
+        x_labels = [str(x) for x in x_values]
+    scope_codes = (df['Private or Public'] != 'Public').to_numpy(dtype=int)
+    n_cat = len(categories)
+    n_x = len(x_labels)
+    valid = (cat_codes >= 0) & (x_codes >= 0)
+    flat = (scope_codes * n_cat + cat_codes) * n_x + x_codes
+    counts = np.bincount(flat[valid], minlength=2 * n_cat * n_x)
+    return {
+        'title': title,
+        'categories': [str(c) for c in categories],
+        'colors': [colormap[c] for c in categories] if colormap else None,
+        'x': x_labels,
+        'sort': sort,
+        'fold': {'top_n': top_n, 'min_share': min_share, 'label': OTHER_LABEL, 'color': OTHER_COLOR},
+        'counts': counts.tolist()
+    }
+
+def country_data(df, country):
+    """Return the rows of `df` with an originator in `country` (an ISO code),
+    including those with originators in other countries too."""
+    enc = encode(df['Originator Country'])
+    codes = np.flatnonzero(enc.categories == country)
+    rows = np.unique(enc.rows[np.isin(enc.codes, codes)])
+    return df.iloc[rows]
+
 def get_map(values):
-    """Return a modified copy of fd.map_data where only the countries
-    present in `values` are represented."""
-    new_map = deepcopy(fd.map_data)
+    """Return a modified copy of the map data (see fd.get_map_data) where
+    only the countries present in `values` are represented."""
+    new_map = deepcopy(fd.get_map_data())
     new_map['features'] = list(filter(lambda f: f['id'] in values, new_map['features']))
     return new_map
 
 # Create colormaps for consistent colouring of countries, asset classes, etc
+def category_order(data) -> list:
+    """The distinct values in `data`, in the order used both for colormaps and for the
+    categories of categorical columns (see preload.compact_frame), so that the two agree.
+    Sorted by their string representations, as the values may be a mix of strings and Combos."""
+    return sorted(set(data), key=str)
+
 def get_colormap(data):
-    if len(set(data)) <= len(colors.D3):
+    categories = category_order(data)
+    if len(categories) <= len(colors.D3):
         pallette = colors.Plotly
     else:
         pallette = colors.Light24
-    return {c: pallette[i] for i, c in enumerate(sorted(set(data), key=str))}
+    return {c: pallette[i] for i, c in enumerate(categories)}
 
 def get_colors(values, colormap):
     return [colormap[v] for v in values]
 
-oc_colormap = get_colormap(df['Originator Country'].dropna())
-oc_colormap.update({fd.Combo.replace(c, fd.iso_to_name): oc_colormap[c] for c in oc_colormap})
-ic_colormap = get_colormap(df['Issuer Country'].dropna())
-ic_colormap.update({fd.Combo.replace(c, fd.iso_to_name): ic_colormap[c] for c in ic_colormap})
-ac_colormap = get_colormap(df['Underlying assets'].dropna())
-currency_colormap = get_colormap(df['Currency'].dropna())
+# Below is data curated and shaped specifically for use in dash_app.  Each
+# object is built by a stage of the data pipeline (see pipeline.py), so that
+# it is only rebuilt when its code or the data it depends on changes.  The
+# outputs of the stages are set as module attributes of the same names.
+
+# Names of the stages defined here, in the order they are defined.
+AGGREGATES = []
+
+def aggregate(name, deps=('df',), **kwargs):
+    """Decorator which adds a function to the data pipeline as the stage
+    building the object called `name`.  See Pipeline.stage."""
+    AGGREGATES.append(name)
+    return data_pipeline.stage(name, deps, **kwargs)
+
+@aggregate('df', deps=('enriched',))
+def _df(enriched):
+    return enriched
+
+# Total issued nominal amount of each securitisation's notes (from FIRDS), converted to EUR at the
+# latest ECB reference rates.  This is kept apart from df so that only the aggregates which use it
+# depend on the exchange rates.
+@aggregate('nominal_amount_eur', deps=('df', 'fx'))
+def _nominal_amount_eur(df, fx):
+    return pd.Series(total_per_row(encode_amounts(df['Nominal Amount']), fx[0]), index=df.index,
+                     name='Nominal Amount (EUR)')
+
+def with_eur(df, nominal_amount_eur):
+    """Return the public securitisations in `df`, with their EUR nominal
+    amounts."""
+    df = df.assign(**{'Nominal Amount (EUR)': nominal_amount_eur.values})
+    return df.loc[df['Private or Public'] == 'Public']
+
+@aggregate('df_pub')
+def _df_pub(df):
+    return df.loc[df['Private or Public'] == 'Public']
+
+# Create colormaps for consistent colouring of countries, asset classes, etc
+
+@aggregate('oc_colormap', uses=(get_colormap, category_order))
+def _oc_colormap(df):
+    oc_colormap = get_colormap(df['Originator Country'].dropna())
+    oc_colormap.update({fd.Combo.replace(c, fd.iso_to_name): oc_colormap[c] for c in oc_colormap})
+    return oc_colormap
 
-# Below is data curated and shaped specifically for use in dash_app
+@aggregate('ic_colormap', uses=(get_colormap, category_order))
+def _ic_colormap(df):
+    ic_colormap = get_colormap(df['Issuer Country'].dropna())
+    ic_colormap.update({fd.Combo.replace(c, fd.iso_to_name): ic_colormap[c] for c in ic_colormap})
+    return ic_colormap
 
-stss_count = len(df)
-cumul_count = df.groupby('Notification date to ESMA').count().cumsum()['Unique Securitisation Identifier']
-monthly_count = df.resample('M').count()['Unique Securitisation Identifier']
-monthly_count.index = [get_month_label(t) for t in monthly_count.index]
+@aggregate('ac_colormap', uses=(get_colormap, category_order))
+def _ac_colormap(df):
+    return get_colormap(df['Underlying assets'].dropna())
 
-private_public = df.groupby('Private or Public').count()['Unique Securitisation Identifier']
+@aggregate('currency_colormap', uses=(get_colormap, category_order))
+def _currency_colormap(df):
+    return get_colormap(df['Currency'].dropna())
 
-asset_classes = df.groupby('Underlying assets').count()['Unique Securitisation Identifier']
+@aggregate('stss_count')
+def _stss_count(df):
+    return len(df)
+
+@aggregate('cumul_count')
+def _cumul_count(df):
+    return df.groupby('Notification date to ESMA').count().cumsum()['Unique Securitisation Identifier']
+
+# The monthly aggregates are indexed by date (the end of each month), so that
+# they can be filtered by date on export; the figures label the months.
+@aggregate('monthly_count')
+def _monthly_count(df):
+    return df.resample('M').count()['Unique Securitisation Identifier']
+
+@aggregate('private_public')
+def _private_public(df):
+    return df.groupby('Private or Public').count()['Unique Securitisation Identifier']
+
+@aggregate('asset_classes')
+def _asset_classes(df):
+    return df.groupby('Underlying assets').count()['Unique Securitisation Identifier']
 
 # New securitisations (monthly) (x labels) broken down by asset class (y values)
-new_by_ac = get_stacked_bars(df.groupby(['Underlying assets']).resample('M').count(), colormap=ac_colormap, fix_timestamps=True)
+@aggregate('new_by_ac', deps=('df', 'ac_colormap'), uses=(get_stacked_bars, get_other_detail, get_month_label))
+def _new_by_ac(df, ac_colormap):
+    return get_stacked_bars(df.groupby(['Underlying assets']).resample('M').count(), colormap=ac_colormap, fix_timestamps=True)
+
+@aggregate('new_by_ac_counts', deps=('df', 'ac_colormap'), uses=(get_count_cube, category_order, get_month_label))
+def _new_by_ac_counts(df, ac_colormap):
+    return get_count_cube(df, 'Underlying assets', colormap=ac_colormap,
+                          title='New STS securitisations by securitised asset class')
 
 # STS securitisations by ABCP status
-stss_by_abcp = df.groupby('ABCP status').count()['Unique Securitisation Identifier']
-ac_by_abcp = get_stacked_bars(df.groupby(['ABCP status', 'Underlying assets']).count()['Unique Securitisation Identifier'], sort=True)
+@aggregate('stss_by_abcp')
+def _stss_by_abcp(df):
+    return df.groupby('ABCP status').count()['Unique Securitisation Identifier']
+
+@aggregate('ac_by_abcp', uses=(get_stacked_bars, get_other_detail))
+def _ac_by_abcp(df):
+    return get_stacked_bars(df.groupby(['ABCP status', 'Underlying assets']).count()['Unique Securitisation Identifier'], sort=True)
+
+@aggregate('ac_by_abcp_counts', uses=(get_count_cube, category_order))
+def _ac_by_abcp_counts(df):
+    return get_count_cube(df, 'ABCP status', 'Underlying assets', sort=True,
+                          title='Proportion of STS securitisations which are ABCP, by asset class')
 
 # Total securitisations by country of originator
 # NOTE:  When building choropleth maps, use ISO codes (ie, "Originator Country" instead of "Originator Country (full)")
 # because the map data we have uses the ISO codes (and having full country names is not necessary when you are looking
 # at a map).
-stss_by_oc_full = df_pub.groupby('Originator Country (full)').count()['Unique Securitisation Identifier']
+@aggregate('stss_by_oc_full', deps=('df_pub',))
+def _stss_by_oc_full(df_pub):
+    return df_pub.groupby('Originator Country (full)').count()['Unique Securitisation Identifier']
+
+@aggregate('stss_by_oc_pie', deps=('stss_by_oc_full', 'oc_colormap'), uses=(get_pie, get_other_detail))
+def _stss_by_oc_pie(stss_by_oc_full, oc_colormap):
+    return get_pie(stss_by_oc_full, oc_colormap)
+
+@aggregate('stss_by_oc', deps=('df_pub',))
+def _stss_by_oc(df_pub):
+    return df_pub.groupby('Originator Country').count()['Unique Securitisation Identifier']
 
-stss_by_oc = df_pub.groupby('Originator Country').count()['Unique Securitisation Identifier']
-stss_by_oc_flat = fd.flatten_by(df_pub, 'Originator Country').groupby('Originator Country').count()['Unique Securitisation Identifier']
+@aggregate('stss_by_oc_flat', deps=('df_pub',))
+def _stss_by_oc_flat(df_pub):
+    return group_count(df_pub['Originator Country']).rename('Unique Securitisation Identifier')
 
 # Choropleth
-oc_map = get_map(set(stss_by_oc_flat.index))
-stss_by_oc_choro = go.Figure(go.Choroplethmapbox(
-    geojson=oc_map,
-    locations=stss_by_oc_flat.index.astype(str),
-    z=stss_by_oc_flat.astype(str),
-    colorscale='Blues',
-    zmin=0,
-    zmax=stss_by_oc_flat.max(),
-    marker_opacity=1,
-    marker_line_width=0.5,
-    name='Number of STS securitisations involving originators in each country'
-))
-stss_by_oc_choro.update_layout(mapbox_style="light", mapbox_accesstoken=fd.mapbox_token,
-                  mapbox_zoom=3.5, mapbox_center = {"lat": 55.402021, "lon": 9.613549},
-                  scene={'aspectratio': {'x': 100, 'y': 100, 'z': 100}},
-                  height=1000, title='Number of STS securitisations involving originators in each country')
+@aggregate('stss_by_oc_choro', deps=('stss_by_oc_flat',), files=lambda _: [fd.map_file], uses=(get_map,))
+def _stss_by_oc_choro(stss_by_oc_flat):
+    oc_map = get_map(set(stss_by_oc_flat.index))
+    stss_by_oc_choro = go.Figure(go.Choroplethmapbox(
+        geojson=oc_map,
+        locations=stss_by_oc_flat.index.astype(str),
+        z=stss_by_oc_flat.astype(str),
+        colorscale='Blues',
+        zmin=0,
+        zmax=stss_by_oc_flat.max(),
+        marker_opacity=1,
+        marker_line_width=0.5,
+        name='Number of STS securitisations involving originators in each country'
+    ))
+    stss_by_oc_choro.update_layout(mapbox_style="light", mapbox_accesstoken=fd.get_mapbox_token(),
+                      mapbox_zoom=3.5, mapbox_center = {"lat": 55.402021, "lon": 9.613549},
+                      scene={'aspectratio': {'x': 100, 'y': 100, 'z': 100}},
+                      height=1000, title='Number of STS securitisations involving originators in each country')
+    return stss_by_oc_choro
 
 # Number of securitisations vs GDP for each country
-oc_vs_gdp = fd.flatten_by(df_pub, 'Originator Country (full)').groupby('Originator Country (full)').count()
-oc_vs_gdp['GDP'] = fd.gdp_data
-oc_vs_gdp = oc_vs_gdp.reindex(['Unique Securitisation Identifier', 'GDP'], axis='columns')
+@aggregate('oc_vs_gdp', deps=('df_pub',), files=lambda _: [fd.gdp_file])
+def _oc_vs_gdp(df_pub):
+    oc_vs_gdp = group_count(df_pub['Originator Country (full)']).to_frame('Unique Securitisation Identifier')
+    oc_vs_gdp['GDP'] = fd.get_gdp_data()
+    return oc_vs_gdp
 
-oc_vs_gdp_corr = oc_vs_gdp.astype(float).corr().iloc[0][1]
+@aggregate('oc_vs_gdp_corr', deps=('oc_vs_gdp',))
+def _oc_vs_gdp_corr(oc_vs_gdp):
+    return oc_vs_gdp.astype(float).corr().iloc[0][1]
 
 # Asset classes (y values) broken down by originator country (x labels)
-ac_by_oc = get_stacked_bars(fd.flatten_by(df_pub, 'Originator Country (full)').groupby(['Underlying assets', 'Originator Country (full)']).count(),
+@aggregate('ac_by_oc', deps=('df_pub', 'ac_colormap'), uses=(get_stacked_bars, get_other_detail))
+def _ac_by_oc(df_pub, ac_colormap):
+    return get_stacked_bars(stacked_counts(df_pub['Underlying assets'], df_pub['Originator Country (full)']),
                             colormap=ac_colormap, sort=True)
 
 # New securitisations (monthly) by country of originator
-#print('LEN', len(df_pub), len(df_pub['Originator Country (full)']), len(df_pub.groupby(['Originator Country (full)']).count()))
-new_by_oc = get_stacked_bars(df_pub.groupby('Originator Country (full)').resample('M')['Unique Securitisation Identifier'].count(),
+@aggregate('new_by_oc', deps=('df_pub', 'oc_colormap'), uses=(get_stacked_bars, get_other_detail, get_month_label))
+def _new_by_oc(df_pub, oc_colormap):
+    return get_stacked_bars(df_pub.groupby('Originator Country (full)').resample('M')['Unique Securitisation Identifier'].count(),
                             colormap=oc_colormap, fix_timestamps=True)
 
 # Table setting out the number of securitisations with originators in country X vs issuers in country Y
-flat_oc_ic = fd.flatten_by(fd.flatten_by(df_pub, 'Originator Country (full)'), 'Issuer Country (full)')
-oc_vs_ic = pd.crosstab(flat_oc_ic['Originator Country (full)'], flat_oc_ic['Issuer Country (full)'], dropna=False, margins=True)
-_all_vals = sorted(set(oc_vs_ic.index).union(set(oc_vs_ic.columns)))
-_all_vals.sort(key='All'.__eq__) # Move All to end
-oc_vs_ic = oc_vs_ic.reindex(index=_all_vals, columns=_all_vals, fill_value=0)
-    
-oc_vs_ic_dt_cols = [{'id': 'Originator Country (full)', 'name': 'Originator Country'}] + [{'name': c, 'id': c} for c in oc_vs_ic.columns]
-oc_vs_ic_dt_data = oc_vs_ic.to_dict('records')
-for i, c in enumerate(oc_vs_ic.index):
-    oc_vs_ic_dt_data[i]['Originator Country (full)'] = c
-oc_vs_ic_dt_style = {'width': str(100 // (len(oc_vs_ic.columns)+1)) + '%'}
+@aggregate('oc_vs_ic', deps=('df_pub',))
+def _oc_vs_ic(df_pub):
+    oc_vs_ic = crosstab(df_pub['Originator Country (full)'], df_pub['Issuer Country (full)'], margins=True)
+    _all_vals = sorted(set(oc_vs_ic.index).union(set(oc_vs_ic.columns)))
+    _all_vals.sort(key='All'.__eq__) # Move All to end
+    return oc_vs_ic.reindex(index=_all_vals, columns=_all_vals, fill_value=0)
+
+@aggregate('oc_vs_ic_dt', deps=('oc_vs_ic',))
+def _oc_vs_ic_dt(oc_vs_ic):
+    """Return the columns, data and cell style for the DataTable of
+    oc_vs_ic."""
+    oc_vs_ic_dt_cols = [{'id': 'Originator Country (full)', 'name': 'Originator Country'}] + [{'name': c, 'id': c} for c in oc_vs_ic.columns]
+    oc_vs_ic_dt_data = oc_vs_ic.to_dict('records')
+    for i, c in enumerate(oc_vs_ic.index):
+        oc_vs_ic_dt_data[i]['Originator Country (full)'] = c
+    oc_vs_ic_dt_style = {'width': str(100 // (len(oc_vs_ic.columns)+1)) + '%'}
+    return oc_vs_ic_dt_cols, oc_vs_ic_dt_data, oc_vs_ic_dt_style
 
 # Securitisations by issuer country (excluding those where issuer country == originator country)
-diff_oc_ic = df_pub[~fd.Combo.equals_by_series(df_pub['Issuer Country (full)'], df_pub['Originator Country (full)'])]
-diff_by_ic = fd.flatten_by(diff_oc_ic, 'Issuer Country (full)').groupby('Issuer Country (full)').count()['Unique Securitisation Identifier']
+@aggregate('diff_by_ic', deps=('df_pub',))
+def _diff_by_ic(df_pub):
+    diff_oc_ic = df_pub[~fd.Combo.equals_by_series(df_pub['Issuer Country (full)'], df_pub['Originator Country (full)'])]
+    return group_count(diff_oc_ic['Issuer Country (full)']).rename('Unique Securitisation Identifier')
+
+@aggregate('diff_by_ic_pie', deps=('diff_by_ic',), uses=(get_pie, get_other_detail))
+def _diff_by_ic_pie(diff_by_ic):
+    return get_pie(diff_by_ic)
 
 # Securitisations by currency
-stss_by_currency = df_pub.groupby('Currency').count()['Unique Securitisation Identifier']
-oc_by_currency = get_stacked_bars(fd.flatten_by(fd.flatten_by(df_pub, 'Currency'), 'Originator Country (full)').groupby(['Currency', 'Originator Country (full)']).count(),
-                    colormap=currency_colormap, sort=True)
+@aggregate('stss_by_currency', deps=('df_pub',))
+def _stss_by_currency(df_pub):
+    return df_pub.groupby('Currency').count()['Unique Securitisation Identifier']
+
+@aggregate('stss_by_currency_pie', deps=('stss_by_currency', 'currency_colormap'), uses=(get_pie, get_other_detail))
+def _stss_by_currency_pie(stss_by_currency, currency_colormap):
+    return get_pie(stss_by_currency, currency_colormap)
+
+@aggregate('oc_by_currency', deps=('df_pub', 'currency_colormap'), uses=(get_stacked_bars, get_other_detail))
+def _oc_by_currency(df_pub, currency_colormap):
+    return get_stacked_bars(stacked_counts(df_pub['Currency'], df_pub['Originator Country (full)']),
+                        colormap=currency_colormap, sort=True)
+
+# Value-weighted aggregates, in EUR.  Only public securitisations have ISINs (and so nominal
+# amounts), so these cover public securitisations only.  Where a securitisation has more than one
+# originator country, its value is split evenly between them so that it is only counted once.
+@aggregate('value_by_ac', deps=('df', 'nominal_amount_eur'), uses=(with_eur,))
+def _value_by_ac(df, nominal_amount_eur):
+    df_pub = with_eur(df, nominal_amount_eur)
+    return group_count(df_pub['Underlying assets'], weights=df_pub['Nominal Amount (EUR)']).rename('Nominal Amount (EUR)')
+
+@aggregate('value_by_oc', deps=('df', 'nominal_amount_eur'), uses=(with_eur,))
+def _value_by_oc(df, nominal_amount_eur):
+    df_pub = with_eur(df, nominal_amount_eur)
+    return group_count(df_pub['Originator Country (full)'], weights=df_pub['Nominal Amount (EUR)'],
+                       split=True).rename('Nominal Amount (EUR)')
+
+@aggregate('value_by_currency', deps=('df_pub', 'fx'))
+def _value_by_currency(df_pub, fx):
+    return total_by_currency(encode_amounts(df_pub['Nominal Amount']), fx[0]).rename('Nominal Amount (EUR)')
+
+@aggregate('value_by_currency_pie', deps=('value_by_currency', 'currency_colormap'), uses=(get_pie, get_other_detail))
+def _value_by_currency_pie(value_by_currency, currency_colormap):
+    return get_pie(value_by_currency / 1e6, currency_colormap)
+
+@aggregate('value_by_month', deps=('df', 'nominal_amount_eur'), uses=(with_eur,))
+def _value_by_month(df, nominal_amount_eur):
+    return with_eur(df, nominal_amount_eur)['Nominal Amount (EUR)'].resample('M').sum()
+
+# Get main DataFrames we will be working on.  Save the enriched DataFrame down
+# as a "snapshot" so we don't have to go through the process of searching
+# FIRDS data, etc, every time (and so that fetch_async can refresh it).  If
+# there is no snapshot, the pipeline builds it from source, resuming any
+# previous build which didn't complete.
+
+snapshot_file = join(fd.data_dir, 'snapshot')
+metrics.record_cache('snapshot', exists(snapshot_file))
+if exists(snapshot_file):
+    logging.info('Loading data from snapshot.')
+    with open(snapshot_file, 'rb') as f:
+        _provided = {'enriched': load(f)}
+    # Hashed from the file rather than by pickling the data again, which can
+    # give different bytes (see Pipeline.build).
+    _snapshot_hash = fd.file_hash(snapshot_file)
+    _provided_hashes = {'enriched': _snapshot_hash}
+else:
+    logging.info('No data found; building data from sources.')
+    _provided = {}
+    _provided_hashes = {}
+
+# Stages which need re-running can be run in parallel, in this many processes
+# (see Pipeline.build).  By default they are run in this process: each of the
+# aggregates takes a few milliseconds to build, less than it takes to pickle df
+# to send to a worker, so a pool only slows the build down.  A pool would also
+# be started in the uwsgi master whenever the data changed (see preload.py).
+build_processes = int(environ.get('STSS_BUILD_PROCESSES', 1))
+
+_outputs = data_pipeline.build(['enriched', 'fx'] + AGGREGATES, provided=_provided, processes=build_processes,
+                               provided_hashes=_provided_hashes)
+for _name, _status, _seconds in data_pipeline.timings():
+    logging.debug(f'Stage {_name} ({_status}): {_seconds:.3f}s')
+if not exists(snapshot_file):
+    # A copy of the cached output of the enriched stage, so that its hash is
+    # the same as the one the aggregates were built from, and they are found
+    # in the cache when the snapshot is next loaded.
+    copyfile(data_pipeline.output_file('enriched'), snapshot_file + '.tmp')
+    replace(snapshot_file + '.tmp', snapshot_file)
+    _snapshot_hash = fd.file_hash(snapshot_file)
+
+# The data version identifies the snapshot the figures were built from, so
+# that caches and clients can tell when the data has been refreshed.
+data_version = _snapshot_hash[:16]
+data_timestamp = datetime.fromtimestamp(getmtime(snapshot_file))
+
+# The hash of each stage's output, by which the export API identifies versions
+# of the datasets.
+stage_hashes = dict(data_pipeline.hashes)
+
+fx_rates, fx_date = _outputs['fx']
+oc_vs_ic_dt_cols, oc_vs_ic_dt_data, oc_vs_ic_dt_style = _outputs.pop('oc_vs_ic_dt')
+df = _outputs.pop('df').assign(**{'Nominal Amount (EUR)': _outputs.pop('nominal_amount_eur').values})
+df_pub = df.loc[df['Private or Public'] == 'Public']
+del _outputs['df_pub']
+# The other aggregates are set as module attributes of the same names.
+globals().update({name: _outputs[name] for name in AGGREGATES if name in _outputs})
+# Drop the build's own references to the data (including the enriched
+# DataFrame loaded from the snapshot), so that nothing but the module
+# attributes keeps it alive, and preload.compact_frame can free it.
+del _outputs, _provided
+
+# For looking up individual securitisations (eg, by the export API).
+register_index = fd.RegisterIndex(df)
@@ -5,19 +5,29 @@ from os.path import dirname, realpath
 import sys
 sys.path.append(dirname(realpath(__file__)))
 
+from collections import OrderedDict
 from datetime import datetime
+import threading
 
 import flask
 
 import plotly.express as px
 
 import dash
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_table as dt
 
 import markdown as md
+import fetch_data as fd
 import curated_data as cd
+from crosstab import group_count
+import metrics
+import export_api
+import enrichment
+import image_export
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
@@ -25,12 +35,409 @@ app = flask.Flask(__name__)
 
 dash_app = dash.Dash(__name__, server=app, url_base_pathname='/dataviz/stss_intro/', external_stylesheets=external_stylesheets)
 dash_app.title = 'STS securitisations in the EU'
+# Sections are rendered on demand, so their components aren't in the initial layout.
+dash_app.config.suppress_callback_exceptions = True
+
+metrics.init_app(app, base_path=dash_app.config.url_base_pathname, path='/dataviz/stss_intro/metrics')
+metrics.set_data_version(cd.data_version, cd.data_timestamp)
+
+app.register_blueprint(export_api.blueprint, url_prefix=dash_app.config.url_base_pathname + 'export')
+app.register_blueprint(enrichment.blueprint, url_prefix=dash_app.config.url_base_pathname + 'enrich')
+app.register_blueprint(image_export.blueprint, url_prefix=dash_app.config.url_base_pathname + 'images')
 
 # TODO:
-# - handle faulty FVC issuer data (no ISIN) by checking against name.
 # - may need to detect and standardise common prefixes
 
-dash_app.layout = html.Div(children=[
+# Charts which can be switched between absolute numbers and percentages, and
+# between all and only public securitisations.  The charts are built in the
+# browser (see assets/stss.js), from the counts in curated_data.<id>_counts,
+# which are sent in place of the figure.
+TOGGLED_GRAPHS = ['new_by_ac', 'ac_by_abcp']
+
+def toggled_figure(graph_id):
+    """Return the figure of a toggled graph in its default view, as built
+    on the server (by curated_data.get_stacked_bars), for exports which
+    don't run the clientside callbacks."""
+    return {
+        'data': getattr(cd, graph_id),
+        'layout': {
+            'barmode': 'stack',
+            'title': getattr(cd, graph_id + '_counts')['title']
+        }
+    }
+
+def toggled_graph(graph_id):
+    """Return a Graph with controls for switching its view.  The Graph's
+    figure is only a placeholder, until the chart is built in the browser
+    (when the page loads, and whenever the view changes)."""
+    counts = getattr(cd, graph_id + '_counts')
+    return html.Div([
+        dcc.RadioItems(
+            id=graph_id + '_view',
+            options=[{'label': 'Number', 'value': 'absolute'}, {'label': 'Percentage', 'value': 'percent'}],
+            value='absolute',
+            labelStyle={'display': 'inline-block'}
+        ),
+        dcc.RadioItems(
+            id=graph_id + '_scope',
+            options=[{'label': 'All securitisations', 'value': 'all'}, {'label': 'Public securitisations only', 'value': 'public'}],
+            value='all',
+            labelStyle={'display': 'inline-block'}
+        ),
+        dcc.Store(id=graph_id + '_counts', data=counts),
+        dcc.Graph(id=graph_id, figure={'data': [], 'layout': {'title': counts['title']}})
+    ])
+
+def asset_classes_section():
+    return [
+        html.Div(dcc.Markdown(md.asset_classes_pie)),
+
+        dcc.Graph(
+            id='asset_classes',
+            figure={
+                'data': [{
+                    'values': cd.asset_classes,
+                    'labels': cd.asset_classes.index,
+                    'type': 'pie',
+                    'marker': {
+                        'colors': cd.get_colors(cd.asset_classes.index, cd.ac_colormap)
+                    }
+                }],
+                'layout': {
+                    'title': 'STS securitisations broken down by type of assets securitised',
+                }
+            }
+
+        ),
+
+        html.Div(dcc.Markdown(md.new_by_ac)),
+
+        toggled_graph('new_by_ac'),
+
+        html.Div(dcc.Markdown(md.stss_by_abcp)),
+
+        dcc.Graph(
+            id='stss_by_abcp',
+            figure={
+                'data': [{
+                    'values': cd.stss_by_abcp,
+                    'labels': cd.stss_by_abcp.index,
+                    'type': 'pie'
+                }],
+                'layout': {
+                    'title': 'Proportion of STS securitisations which are ABCP transactions or ABCP programmes'
+                }
+            }
+        ),
+
+        html.Div(dcc.Markdown(md.ac_by_abcp)),
+
+        toggled_graph('ac_by_abcp')
+    ]
+
+def private_public_section():
+    return [
+        html.Div(dcc.Markdown(md.private_public)),
+
+        dcc.Graph(
+            id='private_public',
+            figure={
+                'data': [{
+                    'values': cd.private_public,
+                    'labels': cd.private_public.index,
+                    'type': 'pie'
+                }],
+                'layout': {
+                    'title': 'Private vs public STS securitisations'
+                }
+            }
+        )
+    ]
+
+def originator_countries_section():
+    return [
+        html.Div(dcc.Markdown(md.stss_by_oc)),
+
+        dcc.Graph(
+            id='stss_by_oc_pie',
+            figure={
+                'data': [cd.stss_by_oc_pie],
+                'layout': {
+                    'title': 'STS securitisations by country of originator'
+                }
+            }
+        ),
+
+        dcc.Graph(
+            id='stss_by_oc_choro',
+            figure=cd.stss_by_oc_choro
+        ),
+
+        html.P(['Securitisations by country of originator: '] + country_links()),
+
+        html.Div(dcc.Markdown(md.oc_vs_gdp.format(corr=round(cd.oc_vs_gdp_corr, 3)))),
+
+        dcc.Graph(
+            id='oc_vs_gdp',
+            figure={
+                'data': [{
+                    'x': cd.oc_vs_gdp['GDP'],
+                    'y': cd.oc_vs_gdp['Unique Securitisation Identifier'],
+                    'text': cd.oc_vs_gdp.index,
+                    'mode': 'markers'
+                }],
+                'layout': {
+                    'title': 'STS securitisations vs 2019 GDP (€million)'
+                }
+            }
+        ),
+
+        html.Div(dcc.Markdown(md.ac_by_oc)),
+
+        dcc.Graph(
+            id='ac_by_oc',
+            figure={
+                'data': cd.ac_by_oc,
+                'layout': {
+                    'barmode': 'stack',
+                    'title': 'Underlying assets by country of originator',
+                }
+            }
+        ),
+
+        html.Div(dcc.Markdown(md.new_by_oc)),
+
+        dcc.Graph(
+            id='new_by_oc',
+            figure={
+                'data': cd.new_by_oc,
+                'layout': {
+                    'barmode': 'stack',
+                    'title': 'New securitisations by country of originator'
+                }
+            }
+        )
+    ]
+
+def issuers_section():
+    return [
+        html.Div(dcc.Markdown(md.oc_vs_ic)),
+
+        dt.DataTable(
+            id='oc_vs_ic',
+            columns=cd.oc_vs_ic_dt_cols,
+            data=cd.oc_vs_ic_dt_data,
+            style_cell=cd.oc_vs_ic_dt_style
+        ),
+
+        html.Div(dcc.Markdown(md.diff_by_ic)),
+
+        dcc.Graph(
+            id='diff_by_ic',
+            figure={
+                'data': [cd.diff_by_ic_pie],
+                'layout': {
+                    'title': 'Number of STS securitisations involving issuers from each country, excluding securitisations where the issuer and originator are located in the same country'
+                }
+            }
+        )
+    ]
+
+def currency_section():
+    return [
+        html.Div(dcc.Markdown(md.stss_by_currency)),
+
+        dcc.Graph(
+            id='stss_by_currency',
+            figure={
+                'data': [cd.stss_by_currency_pie],
+                'layout': {
+                    'title': 'STS securitisations broken down by currency'
+                }
+            }
+        ),
+
+        html.Div(dcc.Markdown(md.oc_by_currency)),
+
+        dcc.Graph(
+            id='oc_by_currency',
+            figure={
+                'data': cd.oc_by_currency,
+                'layout': {
+                    'barmode': 'stack',
+                    'title': 'Currency of securitisation by country of originator'
+                }
+            }
+        )
+    ]
+
+def value_section():
+    fx_date = cd.fx_date.strftime('%d %B %Y') if cd.fx_date is not None else 'the date the data was built'
+    return [
+        html.Div(dcc.Markdown(md.value.format(fx_date=fx_date))),
+        
+        dcc.Graph(
+            id='value_by_month',
+            figure={
+                'data': [{
+                    'x': [cd.get_month_label(t) for t in cd.value_by_month.index],
+                    'y': cd.value_by_month / 1e6,
+                    'type': 'bar'
+                }],
+                'layout': {
+                    'title': 'Nominal amount of notes of new public STS securitisations per month (€million)'
+                }
+            }
+        ),
+        
+        dcc.Graph(
+            id='value_by_ac',
+            figure={
+                'data': [{
+                    'values': cd.value_by_ac / 1e6,
+                    'labels': cd.value_by_ac.index,
+                    'type': 'pie',
+                    'marker': {
+                        'colors': cd.get_colors(cd.value_by_ac.index, cd.ac_colormap)
+                    }
+                }],
+                'layout': {
+                    'title': 'Nominal amount of notes by type of assets securitised (€million)'
+                }
+            }
+        ),
+        
+        dcc.Graph(
+            id='value_by_oc',
+            figure={
+                'data': [{
+                    'x': cd.value_by_oc.index,
+                    'y': cd.value_by_oc / 1e6,
+                    'type': 'bar'
+                }],
+                'layout': {
+                    'title': 'Nominal amount of notes by country of originator (€million)'
+                }
+            }
+        ),
+        
+        dcc.Graph(
+            id='value_by_currency',
+            figure={
+                'data': [cd.value_by_currency_pie],
+                'layout': {
+                    'title': 'Nominal amount of notes by currency (€million, converted to EUR)'
+                }
+            }
+        )
+    ]
+
+# Per-country pages, at <base>/country/<ISO code>, are built when they are first
+# requested and the most recently used are kept.  The cache is keyed by the data
+# version too, so that pages are rebuilt when the data is refreshed.
+COUNTRY_PATH = 'country/'
+COUNTRY_CACHE_SIZE = 16
+
+_country_cache = OrderedDict()
+_country_cache_lock = threading.Lock()
+
+def country_links():
+    # Plain links rather than dcc.Link, so that each page is a full page load
+    # (and the browser's back button works as expected).
+    links = []
+    for iso in sorted(cd.stss_by_oc_flat.index, key=lambda c: fd.iso_to_name.get(c, c)):
+        if links:
+            links.append(' | ')
+        links.append(html.A(fd.iso_to_name.get(iso, iso), href=dash_app.config.url_base_pathname + COUNTRY_PATH + iso))
+    return links
+
+def country_page(iso):
+    df = cd.country_data(cd.df_pub, iso)
+    country = fd.iso_to_name.get(iso, iso)
+    monthly = df.resample('M')['Unique Securitisation Identifier'].count()
+    issuers = group_count(df['Issuer Name']).sort_values(ascending=False, kind='stable')
+    return [
+        html.H1(
+            children=f'STS securitisations with originators in {country}',
+            style={
+                'textAlign': 'center'
+            }),
+
+        html.Div(dcc.Markdown(md.country.format(count=len(df), country=country, share=len(df) / len(cd.df_pub),
+                                                overview=dash_app.config.url_base_pathname))),
+
+        dcc.Graph(
+            id='country_monthly_count',
+            figure={
+                'data': [{
+                    'x': [cd.get_month_label(t) for t in monthly.index],
+                    'y': monthly,
+                    'type': 'bar'
+                }],
+                'layout': {
+                    'title': f'New STS securitisations per month with originators in {country}'
+                }
+            }
+        ),
+
+        dcc.Graph(
+            id='country_asset_classes',
+            figure={
+                'data': [cd.get_pie(group_count(df['Underlying assets']), cd.ac_colormap)],
+                'layout': {
+                    'title': 'Type of assets securitised'
+                }
+            }
+        ),
+
+        dcc.Graph(
+            id='country_currency',
+            figure={
+                'data': [cd.get_pie(group_count(df['Currency']), cd.currency_colormap)],
+                'layout': {
+                    'title': 'Currency of notes'
+                }
+            }
+        ),
+
+        dt.DataTable(
+            id='country_issuers',
+            columns=[{'id': 'Issuer', 'name': 'Issuer'}, {'id': 'Count', 'name': 'Number of STS securitisations'}],
+            data=[{'Issuer': str(name), 'Count': int(count)} for name, count in issuers.items()]
+        )
+    ]
+
+def get_country_page(iso):
+    key = (iso, cd.data_version)
+    with _country_cache_lock:
+        page = _country_cache.get(key)
+        if page is not None:
+            _country_cache.move_to_end(key)
+    metrics.record_cache('country_pages', page is not None)
+    if page is None:
+        page = country_page(iso)
+        with _country_cache_lock:
+            _country_cache[key] = page
+            while len(_country_cache) > COUNTRY_CACHE_SIZE:
+                _country_cache.popitem(last=False)
+    return page
+
+# Sections of the page below the headline figures.  Each is only rendered
+# (and sent to the browser) when its tab is selected, so the overview page
+# contains just the introduction and headline figures when first loaded.
+SECTIONS = [
+    ('asset_classes', 'Underlying assets', asset_classes_section),
+    ('private_public', 'Private vs public', private_public_section),
+    ('originator_countries', 'Originator countries', originator_countries_section),
+    ('issuers', 'Issuers', issuers_section),
+    ('currency', 'Currency', currency_section),
+    ('value', 'Value', value_section),
+]
+
+_section_builders = {value: builder for value, _, builder in SECTIONS}
+_section_cache = {}
+
+overview_layout = [
     html.H1(
         children='Simple, transparent and standardised securitisations in the European Union',
         style={
@@ -59,7 +466,7 @@ dash_app.layout = html.Div(children=[
         id='monthly_count',
         figure={
             'data': [{
-                'x': cd.monthly_count.index,
+                'x': [cd.get_month_label(t) for t in cd.monthly_count.index],
                 'y': cd.monthly_count,
                 'type': 'bar'
             }],
@@ -69,216 +476,59 @@ dash_app.layout = html.Div(children=[
         }
     ),
     
-    html.Div(dcc.Markdown(md.asset_classes_pie)),
-    
-    dcc.Graph(
-        id='asset_classes',
-        figure={
-            'data': [{
-                'values': cd.asset_classes,
-                'labels': cd.asset_classes.index,
-                'type': 'pie',
-                'marker': {
-                    'colors': cd.get_colors(cd.asset_classes.index, cd.ac_colormap)
-                }
-            }],
-            'layout': {
-                'title': 'STS securitisations broken down by type of assets securitised',
-            }
-        }
-
-    ),
-    
-    html.Div(dcc.Markdown(md.new_by_ac)),
-    
-    dcc.Graph(
-        id='new_by_ac',
-        figure={
-            'data': cd.new_by_ac,
-            'layout': {
-                'barmode': 'stack',
-                'title': 'New STS securitisations by securitised asset class',
-            }
-        }
-    ),
-    
-    html.Div(dcc.Markdown(md.stss_by_abcp)),
-    
-    dcc.Graph(
-        id='stss_by_abcp',
-        figure={
-            'data': [{
-                'values': cd.stss_by_abcp,
-                'labels': cd.stss_by_abcp.index,
-                'type': 'pie'
-            }],
-            'layout': {
-                'title': 'Proportion of STS securitisations which are ABCP transactions or ABCP programmes'
-            }
-        }
-    ),
-    
-    html.Div(dcc.Markdown(md.ac_by_abcp)),
-    
-    dcc.Graph(
-        id='ac_by_abcp',
-        figure={
-            'data': cd.ac_by_abcp,
-            'layout': {
-                'barmode': 'stack',
-                'title': 'Proportion of STS securitisations which are ABCP, by asset class',
-            }
-        }
-    ),
-    
-    html.Div(dcc.Markdown(md.private_public)),
-    
-    dcc.Graph(
-        id='private_public',
-        figure={
-            'data': [{
-                'values': cd.private_public,
-                'labels': cd.private_public.index,
-                'type': 'pie'
-            }],
-            'layout': {
-                'title': 'Private vs public STS securitisations'
-            }
-        }
-    ),
-    
-    
-    
-    html.Div(dcc.Markdown(md.stss_by_oc)),
-    
-    dcc.Graph(
-        id='stss_by_oc_pie',
-        figure={
-            'data': [{
-                'values': cd.stss_by_oc_full.astype(str),
-                'labels': cd.stss_by_oc_full.index.astype(str),
-                'type': 'pie',
-                'marker': {
-                    'colors': cd.get_colors(cd.stss_by_oc.index, cd.oc_colormap)
-                }
-            }],
-            'layout': {
-                'title': 'STS securitisations by country of originator'
-            }
-        }
-    ),
-    
-    dcc.Graph(
-        id='stss_by_oc_choro',
-        figure=cd.stss_by_oc_choro
-    ),
-    
-    html.Div(dcc.Markdown(md.oc_vs_gdp.format(corr=round(cd.oc_vs_gdp_corr, 3)))),
-    
-    dcc.Graph(
-        id='oc_vs_gdp',
-        figure={
-            'data': [{
-                'x': cd.oc_vs_gdp['GDP'],
-                'y': cd.oc_vs_gdp['Unique Securitisation Identifier'],
-                'text': cd.oc_vs_gdp.index,
-                'mode': 'markers'
-            }],
-            'layout': {
-                'title': 'STS securitisations vs 2019 GDP (€million)'
-            }
-        }
-    ),
-    
-    html.Div(dcc.Markdown(md.ac_by_oc)),
-    
-    dcc.Graph(
-        id='ac_by_oc',
-        figure={
-            'data': cd.ac_by_oc,
-            'layout': {
-                'barmode': 'stack',
-                'title': 'Underlying assets by country of originator',
-            }
-        }
-    ),
-    
-    html.Div(dcc.Markdown(md.new_by_oc)),
-    
-    dcc.Graph(
-        id='new_by_oc',
-        figure={
-            'data': cd.new_by_oc,
-            'layout': {
-                'barmode': 'stack',
-                'title': 'New securitisations by country of originator'
-            }
-        }
-    ),
-    
-    html.Div(dcc.Markdown(md.oc_vs_ic)),
-    
-    dt.DataTable(
-        id='oc_vs_ic',
-        columns=cd.oc_vs_ic_dt_cols,
-        data=cd.oc_vs_ic_dt_data,
-        style_cell=cd.oc_vs_ic_dt_style
-    ),
-    
-    html.Div(dcc.Markdown(md.diff_by_ic)),
-    
-    dcc.Graph(
-        id='diff_by_ic',
-        figure={
-            'data': [{
-                'values': cd.diff_by_ic,
-                'labels': cd.diff_by_ic.index,
-                'type': 'pie'
-            }],
-            'layout': {
-                'title': 'Number of STS securitisations involving issuers from each country, excluding securitisations where the issuer and originator are located in the same country'
-            }
-        }
-    ),
-    
-    html.Div(dcc.Markdown(md.stss_by_currency)),
-    
-    dcc.Graph(
-        id='stss_by_currency',
-        figure={
-            'data': [{
-                'values': cd.stss_by_currency.astype(str),
-                'labels': cd.stss_by_currency.index.astype(str),
-                'type': 'pie',
-                'marker': {
-                    'colors': cd.get_colors(cd.stss_by_currency.index, cd.currency_colormap)
-                }
-            }],
-            'layout': {
-                'title': 'STS securitisations broken down by currency'
-            }
-        }
+    dcc.Tabs(
+        id='section_tabs',
+        value=SECTIONS[0][0],
+        children=[dcc.Tab(label=label, value=value) for value, label, _ in SECTIONS]
     ),
     
-    html.Div(dcc.Markdown(md.oc_by_currency)),
-    
-    dcc.Graph(
-        id='oc_by_currency',
-        figure={
-            'data': cd.oc_by_currency,
-            'layout': {
-                'barmode': 'stack',
-                'title': 'Currency of securitisation by country of originator'
-            }
-        }
-    ),
+    dcc.Loading(html.Div(id='section_content')),
     
     html.Div(dcc.Markdown(md.sources)),
     
     html.Div(dcc.Markdown(md.licence), style={'textAlign': 'center'})
-    
+]
+
+# Every page, including the overview, is rendered into page_content by the
+# render_page callback, according to the URL.  (If the overview were in the
+# initial layout, every other page would load it, and its first section,
+# before replacing it.)
+dash_app.layout = html.Div(children=[
+    dcc.Location(id='url'),
+    html.Div(id='page_content')
 ])
 
+@dash_app.callback(Output('page_content', 'children'), [Input('url', 'pathname')])
+def render_page(pathname):
+    base = dash_app.config.url_base_pathname
+    if (not pathname) or (pathname.rstrip('/') + '/' == base):
+        return overview_layout
+    if pathname.startswith(base + COUNTRY_PATH):
+        iso = pathname[len(base + COUNTRY_PATH):].strip('/').upper()
+        if iso in cd.stss_by_oc_flat.index:
+            return get_country_page(iso)
+    return [
+        html.H1('Page not found', style={'textAlign': 'center'}),
+        html.P(html.A('Back to the overview', href=base))
+    ]
+
+@dash_app.callback(Output('section_content', 'children'), [Input('section_tabs', 'value')])
+def render_section(tab):
+    if tab not in _section_builders:
+        raise PreventUpdate
+    metrics.record_cache('sections', tab in _section_cache)
+    if tab not in _section_cache:
+        _section_cache[tab] = _section_builders[tab]()
+    return _section_cache[tab]
+
+for graph_id in TOGGLED_GRAPHS:
+    dash_app.clientside_callback(
+        ClientsideFunction(namespace='stss', function_name='stackedCounts'),
+        Output(graph_id, 'figure'),
+        [Input(graph_id + '_view', 'value'), Input(graph_id + '_scope', 'value')],
+        [State(graph_id + '_counts', 'data')]
+    )
+
 if __name__ == '__main__':
     from sys import argv
     debug = '--debug' in argv
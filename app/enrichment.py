@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A service which enriches ISINs with their reference data from FIRDS and
+their issuers' data from GLEIF (as fetch_data.add_issuer_data does for the
+securitisations in the register), for use by other tools.
+
+Use it as a library:
+
+    from enrichment import get_service
+    results, breakdown = get_service().enrich(['XS2104129486', ...])
+
+or over HTTP from the same machine (the blueprint is registered by dash_app,
+but only answers requests from LOCAL_ADDRESSES):
+
+    POST /dataviz/stss_intro/enrich/  {"isins": ["XS2104129486", ...]}
+    GET  /dataviz/stss_intro/enrich/?isins=XS2104129486,...
+
+ISINs whose check digit is wrong are rejected (with a 400 over HTTP), so
+that only plausible ISINs ever cause the FIRDS files to be scanned.  The
+service only searches the FIRDS files already downloaded (eg, by
+fetch_async.py); it never downloads them itself.
+
+Results are cached (in memory and on disk), so each ISIN and each LEI is only
+looked up once.  ISINs which aren't in FIRDS are remembered for MISS_TTL
+only, so that they are found once they appear in newly downloaded files,
+and so that the cache doesn't fill up with misses.  ISINs which aren't
+cached are looked up in batches: the request which starts a batch waits a
+short window (BATCH_WINDOW) for lookups requested by other threads to join
+it, then looks up the whole batch itself, in a single scan of the FIRDS files
+and a single GLEIF query.  A request for an ISIN which is already being
+looked up waits for that lookup rather than starting another.  Each response
+includes a breakdown of where its results came from.
+
+Batches are shared between the threads of a process, so requests are only
+combined where the server runs more than one thread per process; each uwsgi
+worker process has its own service (but they share the disk cache when they
+start).  No threads are started, so the service works whether or not uwsgi
+enables them.
+"""
+
+import json
+import logging
+import re
+import threading
+import time
+from concurrent.futures import Future, wait
+from os import listdir, replace
+from os.path import exists, join
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import flask
+
+import fetch_data as fd
+import metrics
+
+cache_file = join(fd.data_dir, 'enrichment_cache.json')
+
+# How long (in seconds) to wait for other lookups to batch with a new one.
+BATCH_WINDOW = 0.05
+
+# How long (in seconds) a request waits for its lookups before giving up.
+LOOKUP_TIMEOUT = 600
+
+# How long (in seconds) an ISIN which isn't in FIRDS is remembered as such.
+MISS_TTL = 24 * 60 * 60
+
+MAX_ISINS_PER_REQUEST = 1000
+
+# Addresses that HTTP requests to the service are accepted from.
+LOCAL_ADDRESSES = {'127.0.0.1', '::1'}
+
+ISIN_RE = re.compile(r'^[A-Z]{2}[A-Z0-9]{9}[0-9]$')
+
+# Where an ISIN's result came from, as reported in the breakdown:
+# - cache: already known (including ISINs recently found not to be in FIRDS);
+# - coalesced: already being looked up, for another request;
+# - lookup: looked up for this request (in a batch which may also include
+#   ISINs for other requests).
+# ISINs missing from FIRDS are taken from fetch_data.manual_isin_data, if
+# they are there, as add_issuer_data does.
+SOURCES = ('cache', 'coalesced', 'lookup')
+
+
+def invalid_isins(isins: Sequence[str]) -> List[str]:
+    """Return those of `isins` which aren't valid ISINs (after stripping
+    and upper-casing them, as EnrichmentService.enrich does)."""
+    return [isin for isin in isins
+            if not (ISIN_RE.match(isin.strip().upper()) and fd.RegisterParser.check_isin(isin.strip()))]
+
+
+class EnrichmentService:
+
+    def __init__(self, firds_dir: str = fd.firds_data_dir, _cache_file: Optional[str] = cache_file,
+                 batch_window: float = BATCH_WINDOW):
+        self.fp = fd.FIRDSParser(firds_dir)
+        self.cache_file = _cache_file
+        self.batch_window = batch_window
+        # Reference data for each ISIN found in FIRDS, when each ISIN that wasn't found was
+        # looked up, and the name and country of each issuer, by LEI.
+        self.isins: Dict[str, Dict[str, Any]] = {}
+        self.misses: Dict[str, float] = {}
+        self.issuers: Dict[str, Dict[str, str]] = {}
+        self._load_cache()
+        self._lock = threading.Lock()
+        # Only one batch is looked up at a time; lookups requested meanwhile wait for the next.
+        self._batch_lock = threading.Lock()
+        self._queued: Set[str] = set()
+        self._in_flight: Dict[str, Future] = {}
+        # Whether a request has queued a batch that hasn't yet been started.
+        self._batch_pending = False
+        self.batches = 0
+
+    def _load_cache(self):
+        if (self.cache_file is not None) and exists(self.cache_file):
+            with open(self.cache_file) as f:
+                cached = json.load(f)
+            # Caches written before misses expired recorded them as None; drop those.
+            self.isins = {isin: self._from_json(data) for isin, data in cached['isins'].items() if data is not None}
+            self.misses = cached.get('misses', {})
+            self.issuers = cached['issuers']
+
+    def _save_cache(self):
+        if self.cache_file is None:
+            return
+        with self._lock:
+            self._expire_misses()
+            cached = {
+                'isins': {isin: self._to_json(data) for isin, data in self.isins.items()},
+                'misses': dict(self.misses),
+                'issuers': dict(self.issuers)
+            }
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(cached, f)
+        replace(tmp_file, self.cache_file)
+
+    @staticmethod
+    def _to_json(data: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if data is None:
+            return None
+        currency, amount = data['Nominal Amount']
+        return dict(data, **{'Nominal Amount': {'Currency': currency, 'Amount': amount}})
+
+    @staticmethod
+    def _from_json(data: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if data is None:
+            return None
+        amount = data['Nominal Amount']
+        return dict(data, **{'Nominal Amount': (amount['Currency'], amount['Amount'])})
+
+    def _expire_misses(self):
+        cutoff = time.time() - MISS_TTL
+        self.misses = {isin: t for isin, t in self.misses.items() if t >= cutoff}
+
+    def _cached(self, isin: str) -> bool:
+        return (isin in self.isins) or (self.misses.get(isin, 0) >= time.time() - MISS_TTL)
+
+    def _result(self, isin: str) -> Optional[Dict[str, Any]]:
+        data = self.isins.get(isin)
+        if data is None:
+            return None
+        return dict(data, **self.issuers.get(data['Issuer LEI'], {'Issuer Name': None, 'Issuer Country': None}))
+
+    def enrich(self, isins: Sequence[str]) -> Tuple[Dict[str, Optional[Dict[str, Any]]], Dict[str, int]]:
+        """Return the reference data for each of the given ISINs (None for
+        those not found in FIRDS), and the number of ISINs from each source
+        (see SOURCES), plus the number not found.  Raises ValueError if any
+        of the ISINs is invalid (see invalid_isins)."""
+        isins = list(dict.fromkeys(isin.strip().upper() for isin in isins if isin.strip()))
+        invalid = invalid_isins(isins)
+        if invalid:
+            raise ValueError(f'Invalid ISINs: {", ".join(invalid)}')
+        sources = {}
+        futures = {}
+        start_batch = False
+        with self._lock:
+            for isin in isins:
+                if self._cached(isin):
+                    sources[isin] = 'cache'
+                elif isin in self._in_flight:
+                    sources[isin] = 'coalesced'
+                    futures[isin] = self._in_flight[isin]
+                else:
+                    sources[isin] = 'lookup'
+                    futures[isin] = self._in_flight[isin] = Future()
+                    self._queued.add(isin)
+            if self._queued and not self._batch_pending:
+                self._batch_pending = start_batch = True
+        for isin, source in sources.items():
+            metrics.record_cache('enrichment', source in ('cache', 'coalesced'))
+
+        if start_batch:
+            # Look up the batch in this thread (rather than a timer thread, as
+            # uwsgi doesn't run threads started by the app unless told to),
+            # once other threads have had a chance to add to it.
+            time.sleep(self.batch_window)
+            self._run_batch()
+
+        done, not_done = wait(futures.values(), timeout=LOOKUP_TIMEOUT)
+        if not_done:
+            raise TimeoutError(f'Timed out looking up {len(not_done)} ISINs.')
+        for future in done:
+            # Re-raise any error from the lookup.
+            future.result()
+
+        with self._lock:
+            results = {isin: self._result(isin) for isin in isins}
+        breakdown = {source: 0 for source in SOURCES}
+        for source in sources.values():
+            breakdown[source] += 1
+        breakdown['not_found'] = sum(r is None for r in results.values())
+        return results, breakdown
+
+    def _xml_files(self) -> List[str]:
+        # Unlike FIRDSParser.get_xml_files, never download the files (which
+        # takes far too long to do while handling a request).
+        xml_files = [join(self.fp.data_dir, f) for f in listdir(self.fp.data_dir) if f.endswith('.xml')]
+        if not xml_files:
+            raise FileNotFoundError(f'No FIRDS files in {self.fp.data_dir}; run fetch_async.py to download them.')
+        return xml_files
+
+    def _run_batch(self):
+        with self._batch_lock:
+            with self._lock:
+                batch = self._queued
+                self._queued = set()
+                self._batch_pending = False
+                futures = {isin: self._in_flight[isin] for isin in batch}
+            if not batch:
+                return
+            self.batches += 1
+            logging.info(f'Looking up {len(batch)} ISINs.')
+            try:
+                found, missing = self.fp.search_all_files(set(batch), self._xml_files())
+                for isin in missing.intersection(fd.manual_isin_data):
+                    found[isin] = dict(fd.manual_isin_data[isin])
+                missing.difference_update(found)
+                leis = {d['Issuer LEI'] for d in found.values()}
+                new_leis = sorted(leis.difference(self.issuers))
+                issuers = self.fp.get_issuers(new_leis) if new_leis else []
+            except BaseException as e:
+                with self._lock:
+                    for isin in batch:
+                        del self._in_flight[isin]
+                for future in futures.values():
+                    future.set_exception(e)
+                return
+            with self._lock:
+                for issuer in issuers:
+                    self.issuers[issuer['LEI']['$']] = {
+                        'Issuer Name': issuer['Entity']['LegalName']['$'],
+                        'Issuer Country': fd._issuer_country(issuer)
+                    }
+                self.isins.update(found)
+                now = time.time()
+                self.misses.update(dict.fromkeys(missing, now))
+                for isin in found:
+                    self.misses.pop(isin, None)
+                for isin in batch:
+                    del self._in_flight[isin]
+            self._save_cache()
+            for future in futures.values():
+                future.set_result(None)
+
+
+_service: Optional[EnrichmentService] = None
+_service_lock = threading.Lock()
+
+
+def get_service() -> EnrichmentService:
+    """Return the service shared by this process, creating it on first use
+    (so that it is created in each uwsgi worker, rather than in the master
+    before forking)."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = EnrichmentService()
+        return _service
+
+
+blueprint = flask.Blueprint('enrichment', __name__)
+
+
+@blueprint.before_request
+def _only_local():
+    if flask.request.remote_addr not in LOCAL_ADDRESSES:
+        flask.abort(403, 'The enrichment service is only available locally.')
+
+
+def _plain(data: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    return EnrichmentService._to_json(data)
+
+
+@blueprint.route('/', methods=['GET', 'POST'])
+def enrich():
+    if flask.request.method == 'POST':
+        body = flask.request.get_json(silent=True) or {}
+        isins = body.get('isins')
+        if not (isinstance(isins, list) and all(isinstance(i, str) for i in isins)):
+            flask.abort(400, 'Expected a JSON object with a list of ISINs as "isins".')
+    else:
+        isins = [i for i in flask.request.args.get('isins', '').split(',') if i.strip()]
+    if not isins:
+        flask.abort(400, 'No ISINs given.')
+    if len(isins) > MAX_ISINS_PER_REQUEST:
+        flask.abort(400, f'At most {MAX_ISINS_PER_REQUEST} ISINs can be looked up at once.')
+    invalid = invalid_isins(isins)
+    if invalid:
+        flask.abort(400, f'Invalid ISINs: {", ".join(invalid[:20])}' + (' ...' if len(invalid) > 20 else ''))
+    try:
+        results, breakdown = get_service().enrich(isins)
+    except FileNotFoundError as e:
+        flask.abort(503, str(e))
+    return flask.jsonify({
+        'results': {isin: _plain(data) for isin, data in results.items()},
+        'cache': breakdown
+    })
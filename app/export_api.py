@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Flask endpoints for bulk export of the enriched dataset and the curated
+aggregates.
+
+Each dataset can be downloaded as CSV, JSON lines or an Arrow IPC stream, eg:
+
+    /dataviz/stss_intro/export/enriched.csv?columns=Issuer LEI,Currency&from=2019-06-01&to=2019-12-31
+
+Responses are generated in chunks as they are sent, rather than being built
+in memory, and carry an ETag derived from the version of the dataset (the
+hash of the data pipeline's output it comes from; see dataset_version) and
+the request parameters, so that clients can cheaply revalidate repeat
+downloads.  A dataset's ETag only changes when the dataset itself does, not
+whenever any of the data is refreshed.
+
+Individual securitisations can also be looked up (as JSON) by USI or ISIN, eg:
+
+    /dataviz/stss_intro/export/usi/<USI>
+    /dataviz/stss_intro/export/isin/<ISIN>
+"""
+
+import sys
+from datetime import datetime
+from hashlib import sha256
+from typing import Any, Callable, Dict, Iterator, List
+
+import flask
+import pandas as pd
+from pandas import DataFrame
+
+import fetch_data as fd
+import curated_data as cd
+from pipeline import module_hash
+
+# Names under which datasets are exported, mapped to the names of the
+# corresponding objects in curated_data.
+DATASETS = {
+    'enriched': 'df',
+    'cumul_count': 'cumul_count',
+    'monthly_count': 'monthly_count',
+    'private_public': 'private_public',
+    'asset_classes': 'asset_classes',
+    'stss_by_abcp': 'stss_by_abcp',
+    'stss_by_oc': 'stss_by_oc_full',
+    'stss_by_oc_flat': 'stss_by_oc_flat',
+    'oc_vs_gdp': 'oc_vs_gdp',
+    'oc_vs_ic': 'oc_vs_ic',
+    'diff_by_ic': 'diff_by_ic',
+    'stss_by_currency': 'stss_by_currency',
+    'value_by_ac': 'value_by_ac',
+    'value_by_oc': 'value_by_oc',
+    'value_by_currency': 'value_by_currency',
+    'value_by_month': 'value_by_month'
+}
+
+# The stages of the data pipeline whose outputs each dataset is made from, if
+# not just the stage of the same name as its object in curated_data.
+DATASET_STAGES = {
+    'enriched': ('df', 'nominal_amount_eur')
+}
+
+CHUNK_SIZE = 1000
+
+# Counts in the aggregates are taken of the "Unique Securitisation Identifier"
+# column, so that is what the resulting values are named.  Give them a more
+# helpful name on export.
+COUNT_COL = 'Unique Securitisation Identifier'
+COUNT_COL_EXPORT = 'Number of securitisations'
+
+blueprint = flask.Blueprint('export', __name__)
+
+
+def _to_plain(value: Any) -> Any:
+    """Convert Combos and tuples (such as nominal amounts) to strings."""
+    if isinstance(value, fd.Combo):
+        return ' / '.join(_to_plain(v) for v in value)
+    elif isinstance(value, tuple):
+        return ' '.join(map(str, value))
+    elif pd.isnull(value):
+        return None
+    return str(value)
+
+
+def _plain_chunks(frame: DataFrame) -> Iterator[DataFrame]:
+    for i in range(0, len(frame), CHUNK_SIZE):
+        chunk = frame.iloc[i:i+CHUNK_SIZE].copy()
+        for col in chunk.columns:
+            if not (pd.api.types.is_numeric_dtype(chunk[col]) or pd.api.types.is_datetime64_any_dtype(chunk[col])):
+                chunk[col] = chunk[col].astype(object).map(_to_plain)
+        yield chunk
+
+
+def _csv(frame: DataFrame) -> Iterator[bytes]:
+    for i, chunk in enumerate(_plain_chunks(frame)):
+        yield chunk.to_csv(index=False, header=(i == 0)).encode('utf-8')
+
+
+def _jsonl(frame: DataFrame) -> Iterator[bytes]:
+    for chunk in _plain_chunks(frame):
+        yield (chunk.to_json(orient='records', lines=True, date_format='iso') + '\n').encode('utf-8')
+
+
+def _arrow(frame: DataFrame) -> Iterator[bytes]:
+    import pyarrow as pa
+    fields = []
+    for col in frame.columns:
+        if pd.api.types.is_numeric_dtype(frame[col]) or pd.api.types.is_datetime64_any_dtype(frame[col]):
+            fields.append(pa.field(str(col), pa.from_numpy_dtype(frame[col].dtype)))
+        else:
+            fields.append(pa.field(str(col), pa.string()))
+    schema = pa.schema(fields)
+    # An Arrow IPC stream is just the schema message, followed by a message
+    # for each record batch, followed by an end-of-stream marker, so we can
+    # send each message as soon as it is serialised.
+    yield schema.serialize().to_pybytes()
+    for chunk in _plain_chunks(frame):
+        chunk.columns = [str(c) for c in chunk.columns]
+        yield pa.RecordBatch.from_pandas(chunk, schema=schema, preserve_index=False).serialize().to_pybytes()
+    yield b'\xff\xff\xff\xff\x00\x00\x00\x00'
+
+
+FORMATS: Dict[str, Dict[str, Any]] = {
+    'csv': {'mimetype': 'text/csv', 'writer': _csv},
+    'jsonl': {'mimetype': 'application/x-ndjson', 'writer': _jsonl},
+    'arrow': {'mimetype': 'application/vnd.apache.arrow.stream', 'writer': _arrow}
+}
+
+
+def dataset_version(name: str) -> str:
+    """Identify the version of a dataset, by the hashes of the pipeline
+    outputs it is made from and of the code which exports it."""
+    stages = DATASET_STAGES.get(name, (DATASETS[name],))
+    parts = [module_hash(sys.modules[__name__])] + [cd.stage_hashes[stage] for stage in stages]
+    return sha256(' '.join(parts).encode()).hexdigest()[:16]
+
+
+def _parse_date(arg: str) -> datetime:
+    value = flask.request.args.get(arg)
+    if value is None:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        flask.abort(400, f'Invalid date for "{arg}" (expected YYYY-MM-DD): {value}')
+
+
+def get_frame(name: str, columns: List[str] = None, from_date: datetime = None, to_date: datetime = None) -> DataFrame:
+    """Return the named dataset as a DataFrame (with its index as ordinary
+    columns), filtered by column and date."""
+    data = getattr(cd, DATASETS[name])
+    if (name == 'enriched') and ((from_date is not None) or (to_date is not None)):
+        # The enriched dataset has a date index, so there is no need to compare every date.
+        data = data.iloc[cd.register_index.positions_between(from_date, to_date)]
+    elif (from_date is not None) or (to_date is not None):
+        if not isinstance(data.index, pd.DatetimeIndex):
+            flask.abort(400, f'Dataset "{name}" is not indexed by date, so can\'t be filtered by date.')
+        mask = pd.Series(True, index=data.index)
+        if from_date is not None:
+            mask &= data.index >= from_date
+        if to_date is not None:
+            mask &= data.index <= to_date
+        data = data[mask.values]
+    if isinstance(data, pd.Series):
+        data = data.rename(COUNT_COL_EXPORT if data.name == COUNT_COL else data.name)
+    else:
+        data = data.rename(columns={COUNT_COL: COUNT_COL_EXPORT}) if name != 'enriched' else data
+    index_names = [n if n is not None else 'index' for n in data.index.names]
+    frame = data.reset_index()
+    frame.columns = index_names + list(frame.columns[len(index_names):])
+    if columns:
+        unknown = set(columns).difference(frame.columns)
+        if unknown:
+            flask.abort(400, f'Unknown columns: {", ".join(sorted(unknown))}')
+        frame = frame[[c for c in index_names if c not in columns] + columns]
+    return frame
+
+
+@blueprint.route('/')
+def list_datasets():
+    return flask.jsonify({
+        'data_version': cd.data_version,
+        'datasets': sorted(DATASETS),
+        'dataset_versions': {name: dataset_version(name) for name in sorted(DATASETS)},
+        'formats': sorted(FORMATS)
+    })
+
+
+@blueprint.route('/<name>.<fmt>')
+def export(name: str, fmt: str):
+    if (name not in DATASETS) or (fmt not in FORMATS):
+        flask.abort(404)
+    columns = [c.strip() for c in flask.request.args.get('columns', '').split(',') if c.strip()]
+    from_date = _parse_date('from')
+    to_date = _parse_date('to')
+
+    key = '|'.join([name, fmt, ','.join(columns), str(from_date), str(to_date)])
+    etag = '{}-{}'.format(dataset_version(name), sha256(key.encode()).hexdigest()[:16])
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    frame = get_frame(name, columns, from_date, to_date)
+    writer: Callable[[DataFrame], Iterator[bytes]] = FORMATS[fmt]['writer']
+    response = flask.Response(flask.stream_with_context(writer(frame)), mimetype=FORMATS[fmt]['mimetype'])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, no-cache'
+    response.headers['Content-Disposition'] = f'attachment; filename={name}.{fmt}'
+    return response
+
+
+def _records(rows: DataFrame) -> List[Dict[str, Any]]:
+    frame = rows.reset_index()
+    for col in frame.columns:
+        if pd.api.types.is_datetime64_any_dtype(frame[col]):
+            frame[col] = frame[col].map(lambda d: None if pd.isnull(d) else d.isoformat())
+        elif not pd.api.types.is_numeric_dtype(frame[col]):
+            frame[col] = frame[col].astype(object).map(_to_plain)
+    frame = frame.astype(object).where(frame.notnull(), None)
+    return frame.to_dict(orient='records')
+
+
+def _lookup_response(rows: DataFrame) -> flask.Response:
+    if rows.empty:
+        flask.abort(404)
+    response = flask.jsonify({'data_version': cd.data_version, 'securitisations': _records(rows)})
+    response.set_etag(dataset_version('enriched'))
+    response.headers['Cache-Control'] = 'public, no-cache'
+    return response.make_conditional(flask.request)
+
+
+@blueprint.route('/usi/<usi>')
+def lookup_usi(usi: str):
+    i = cd.register_index.usi.get(usi)
+    return _lookup_response(cd.df.iloc[[] if i is None else [i]])
+
+
+@blueprint.route('/isin/<isin>')
+def lookup_isin(isin: str):
+    return _lookup_response(cd.register_index.get_by_isin(isin.upper()))
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Concurrent orchestration of the remote fetches needed to (re)build the
+data.
+
+The STS register, the FIRDS file list and the ECB exchange rate files don't
+depend on each other, so they are all fetched at once.  The FIRDS files are
+downloaded concurrently, and each one is searched (in a separate process) as
+soon as it has been downloaded and the register has been parsed, so that
+searching overlaps with the remaining downloads.  GLEIF is queried, in
+concurrent batches, once the FIRDS searches are complete.  The total time
+taken should therefore approach that of the slowest single chain of
+downloads, rather than the sum of all of them.
+
+Concurrency is limited per host, and every request is subject to a timeout
+(on connecting and on each read, enforced by requests in the thread making
+the request, so that a timed-out request has stopped before its slot is
+released) and retried (with exponential backoff) on connection errors,
+timeouts and server errors.  A request's slot is given up while it backs
+off.
+
+Set STSS_REPLAY_URL to run against a local replay server (see
+replay_server.py) rather than the live services; concurrency is still
+limited per original host.
+
+Run this module as a script to refresh the data snapshot used by
+curated_data.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from json import loads
+from os import replace
+from os.path import join
+from pickle import dump
+from typing import Any, Collection, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from pandas import DataFrame
+
+import fetch_data as fd
+
+# Maximum number of concurrent requests to each host.  Hosts not listed here
+# get DEFAULT_HOST_LIMIT.
+HOST_LIMITS = {
+    'registers.esma.europa.eu': 2,
+    'firds.esma.europa.eu': 4,
+    'leilookup.gleif.org': 4,
+    'www.ecb.europa.eu': 4,
+    'www.esma.europa.eu': 2
+}
+DEFAULT_HOST_LIMIT = 4
+
+
+class Fetcher:
+    """Fetches URLs concurrently, subject to per-host concurrency limits,
+    timeouts and retries.
+
+    Requests are made with `requests` in a thread pool, so that the rest of
+    the code base's (synchronous) approach to HTTP is unchanged.
+    """
+
+    def __init__(self, host_limits: Dict[str, int] = None, default_limit: int = DEFAULT_HOST_LIMIT,
+                 timeout: float = 120, retries: int = 3, backoff: float = 1.0):
+        self.host_limits = HOST_LIMITS if host_limits is None else host_limits
+        self.default_limit = default_limit
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.executor = ThreadPoolExecutor(max_workers=sum(self.host_limits.values()) + default_limit)
+        self.session = requests.Session()
+
+    def _semaphore(self, host: str) -> asyncio.Semaphore:
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.host_limits.get(host, self.default_limit))
+        return self.semaphores[host]
+
+    def _get(self, url: str) -> bytes:
+        # The timeout applies to connecting and to each read from the socket.
+        response = self.session.get(fd.service_url(url), timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+    async def get(self, url: str) -> bytes:
+        loop = asyncio.get_event_loop()
+        semaphore = self._semaphore(urlsplit(url).netloc)
+        for attempt in range(self.retries + 1):
+            try:
+                # The host's slot is held only while the request is made, not
+                # while backing off, so that other requests can use it.
+                async with semaphore:
+                    # The timeout is left to requests (see _get) rather than
+                    # imposed here with asyncio.wait_for, as that can't stop the
+                    # request's thread, which would then keep running outside
+                    # the host's concurrency limit while the request is retried.
+                    return await loop.run_in_executor(self.executor, self._get, url)
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code < 500:
+                    raise
+                error = e
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt < self.retries:
+                delay = self.backoff * 2 ** attempt
+                logging.warning(f'Fetching {url} failed ({error!r}); retrying in {delay}s.')
+                await asyncio.sleep(delay)
+        raise error
+
+    async def get_to_file(self, url: str, fpath: str) -> str:
+        content = await self.get(url)
+        with open(fpath, 'wb') as f:
+            f.write(content)
+        return fpath
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+
+async def _get_register(fetcher: Fetcher, to_date: Optional[datetime]) -> DataFrame:
+    path = await fetcher.get_to_file(fd.RegisterParser.URL, fd.register_file)
+    loop = asyncio.get_event_loop()
+    parser = await loop.run_in_executor(None, fd.RegisterParser, path)
+    return parser.get_between(to_date=to_date)
+
+
+async def _get_fx_files(fetcher: Fetcher, currencies: Collection[str]) -> List[str]:
+    return await asyncio.gather(*[
+        fetcher.get_to_file(fd.fx_url_template.format(currency=c.lower()), fd.fx_fpath_template.format(currency=c.lower()))
+        for c in currencies
+    ])
+
+
+async def _isins_from(register_task: 'asyncio.Future[DataFrame]') -> Set[str]:
+    return fd.get_isins(await register_task)
+
+
+async def _download_and_search(fetcher: Fetcher, fp: fd.FIRDSParser, url: str, isins: 'asyncio.Future[Set[str]]',
+                               pool: ProcessPoolExecutor) -> Tuple[Dict[str, Dict[str, Any]], Set[str]]:
+    content = await fetcher.get(url)
+    loop = asyncio.get_event_loop()
+    fpath = await loop.run_in_executor(None, fp.extract_zipped_file, content, fp.data_dir)
+    del content
+    logging.info(f'Downloaded {fpath}.')
+    return await loop.run_in_executor(pool, fp.search_isins, await isins, fpath)
+
+
+async def refresh(fetcher: Fetcher, from_date: datetime = None, to_date: datetime = None,
+                  register_to_date: datetime = None, currencies: Collection[str] = ('GBP', 'USD'),
+                  max_procs: int = None) -> DataFrame:
+    """Fetch all data from source and return the enriched register
+    DataFrame (as returned by fd.add_issuer_data).
+
+    `from_date` and `to_date` are passed to FIRDSParser.get_query_url;
+    `register_to_date` is passed to RegisterParser.get_between.
+    """
+    fp = fd.FIRDSParser(fd.firds_data_dir)
+
+    register_task = asyncio.ensure_future(_get_register(fetcher, register_to_date))
+    fx_task = asyncio.ensure_future(_get_fx_files(fetcher, currencies))
+    isins_task = asyncio.ensure_future(_isins_from(register_task))
+
+    try:
+        file_urls = fp.parse_file_urls(await fetcher.get(fp.get_query_url(from_date, to_date)))
+        logging.info(f'Found {len(file_urls)} FIRDS files to download.')
+        with ProcessPoolExecutor(max_procs) as pool:
+            search_results = await asyncio.gather(*[
+                _download_and_search(fetcher, fp, url, isins_task, pool) for url in file_urls
+            ])
+
+        # Merge in the order the files are listed, so that (as with
+        # FIRDSParser.search_all_files) the first file containing an ISIN wins.
+        isin_data = {}
+        for results, _ in reversed(search_results):
+            isin_data.update(results)
+        missing = (await isins_task).difference(isin_data)
+        if missing:
+            logging.warning('The following ISINs are missing the FIRDS data: {}.'.format(missing))
+        isin_data.update(fd.manual_isin_data)
+
+        leis = {d['Issuer LEI'] for d in isin_data.values()}
+        issuer_data = []
+        for content in await asyncio.gather(*[fetcher.get(url) for url in fp.get_issuer_urls(leis)]):
+            issuer_data += loads(content)
+
+        await fx_task
+        df, report = fd.merge_issuer_data(await register_task, isin_data, issuer_data)
+        fd.save_name_match_report(report)
+        return df
+    finally:
+        # If anything failed, stop the fetches still running (and retrieve the
+        # errors of any which failed too), rather than leaving them pending.
+        tasks = (register_task, fx_task, isins_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def refresh_snapshot(snapshot_file: str = join(fd.data_dir, 'snapshot'), **kwargs) -> DataFrame:
+    """Refresh all data and save it to `snapshot_file`, where curated_data
+    will look for it.  Keyword arguments are passed to `refresh`."""
+    fetcher = Fetcher()
+    try:
+        df = asyncio.run(refresh(fetcher, **kwargs))
+    finally:
+        fetcher.close()
+    # Written to a temporary file first, so that curated_data never loads a
+    # partly written snapshot.
+    with open(snapshot_file + '.tmp', 'wb') as f:
+        dump(df, f)
+    replace(snapshot_file + '.tmp', snapshot_file)
+    return df
+
+
+if __name__ == '__main__':
+    start = datetime.now()
+    refresh_snapshot(register_to_date=datetime(2020, 3, 31))
+    logging.info(f'Refreshed data in {datetime.now() - start}.')
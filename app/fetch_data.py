@@ -9,37 +9,78 @@ such as note nominal amount, exchange rates, etc.
 """
 
 import logging
+import mmap
+import re
+from hashlib import sha256
 from json import load, loads
 from datetime import datetime, timedelta
+from functools import lru_cache
 from csv import reader
-from typing import List, Set, Tuple, Dict, Collection, Any, Callable, Union, NewType
+from typing import List, Set, Tuple, Dict, Collection, Any, Callable, Union, NewType, Optional
 from zipfile import ZipFile
-from os import mkdir, listdir
+from os import environ, mkdir, listdir, remove
 from os.path import join, exists, dirname, realpath
 from io import BytesIO
+from urllib.parse import urlsplit
 
 from lxml import etree
 
 import requests
 #from openpyxl import load_workbook
-from pandas import read_excel, ExcelFile, merge, DataFrame, concat
+from pandas import ExcelFile, merge, DataFrame, concat
 import pandas as pd
+import numpy as np
 from numpy import nan
 
+from ingest import read_excel_cached
+from name_match import NameIndex, identifiers_conflict
+
 logging.basicConfig(level=logging.INFO)
 
 zero_time = datetime(2018, 12, 31)
 data_dir = join(dirname(realpath(__file__)), 'data_files')
 
+# Hosts of the remote services we fetch data from.  If the environment
+# variable STSS_REPLAY_URL is set (eg, to "http://127.0.0.1:8765"), requests to
+# these hosts are instead sent to that server, with the original host name as
+# the first part of the path (see replay_server.py).
+SERVICE_HOSTS = (
+    'registers.esma.europa.eu',
+    'firds.esma.europa.eu',
+    'leilookup.gleif.org',
+    'www.ecb.europa.eu',
+    'www.esma.europa.eu'
+)
+
+def service_url(url: str) -> str:
+    """Return the URL that should actually be requested in order to fetch
+    `url`."""
+    replay_url = environ.get('STSS_REPLAY_URL')
+    if not replay_url:
+        return url
+    parts = urlsplit(url)
+    if parts.netloc not in SERVICE_HOSTS:
+        return url
+    query = '?' + parts.query if parts.query else ''
+    return f'{replay_url.rstrip("/")}/{parts.netloc}{parts.path}{query}'
+
 def fetch_data(fpath, url, force_dl=False, binary_data=False):
     if (not exists(fpath)) or force_dl:
-        response = requests.get(url)
+        response = requests.get(service_url(url))
         response.raise_for_status()
         mode = 'wb' if binary_data else 'w'
         with open(fpath, mode) as f:
-            f.write(response.text)
+            f.write(response.content if binary_data else response.text)
     return fpath
 
+def file_hash(fpath: str, chunk_size: int = 1 << 20) -> str:
+    """Return the SHA-256 hex digest of the contents of a file."""
+    h = sha256()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
 # Dicts mapping ISO codes to full country names,and vice versa
 iso_csv_file = join(data_dir, 'iso2_codes.csv')
 iso_to_name = {}
@@ -53,24 +94,33 @@ with open(iso_csv_file) as f:
         iso_to_name[iso] = name
         name_to_iso[name] = iso
 
-# Map data
+# Map data, the Mapbox token and GDP data, which are only needed to build the
+# charts, so are loaded on first use rather than when this module is imported.
 map_file = join(data_dir, 'eur_map_data', 'CNTR_RG_20M_2016_4326.geojson')
-with open(map_file) as f:
-    map_data = load(f)
-    
-for c in map_data['features']:
-    if c['id'] == 'UK':
-        c['id'] = 'GB'
-
-with open(join(data_dir, 'mapbox_token')) as f:
-    mapbox_token = f.read().strip()
-
-# GDP data
+mapbox_token_file = join(data_dir, 'mapbox_token')
 gdp_file = join(data_dir, 'eu_gdp_data.xlsx')
-gdp_data = read_excel(gdp_file, "Sheet 3", skiprows=8, header=0).set_index('TIME')['2019']
-gdp_data.rename(index={'Germany (until 1990 former territory of the FRG)': 'Germany'}, inplace=True)
-#gdp_data.rename(index=name_to_iso, inplace=True)
-#gdp_data = gdp_data.reindex(iso_to_name.keys())
+
+@lru_cache(maxsize=None)
+def get_map_data() -> Dict[str, Any]:
+    with open(map_file) as f:
+        map_data = load(f)
+    for c in map_data['features']:
+        if c['id'] == 'UK':
+            c['id'] = 'GB'
+    return map_data
+
+@lru_cache(maxsize=None)
+def get_mapbox_token() -> str:
+    with open(mapbox_token_file) as f:
+        return f.read().strip()
+
+@lru_cache(maxsize=None)
+def get_gdp_data() -> pd.Series:
+    gdp_data = read_excel_cached(gdp_file, {'TIME': 'str', '2019': 'float'}, sheet_name='Sheet 3', skiprows=8).set_index('TIME')['2019']
+    gdp_data.rename(index={'Germany (until 1990 former territory of the FRG)': 'Germany'}, inplace=True)
+    #gdp_data.rename(index=name_to_iso, inplace=True)
+    #gdp_data = gdp_data.reindex(iso_to_name.keys())
+    return gdp_data
 
 # Currency data
 fx_url_template = 'https://www.ecb.europa.eu/stats/policy_and_exchange_rates/euro_reference_exchange_rates/html/{currency}.xml'
@@ -124,6 +174,11 @@ class Combo:
     
     def __iter__(self):
         return iter(sorted(self.values))
+    
+    def __reduce__(self):
+        # Pickle the values in sorted order (rather than as a set, whose order varies between
+        # processes), so that equal Combos always pickle to the same bytes.
+        return (Combo, tuple(self))
         
     def __len__(self):
         return len(self.values)
@@ -192,10 +247,10 @@ class Combo:
     
     @staticmethod
     def total_value(value: Union[ComboType, int, float]) -> Union[int, float]:
-        if isinstance(i, Combo):
-            return sum(i)
+        if isinstance(value, Combo):
+            return sum(value)
         else:
-            return i
+            return value
     
     @staticmethod
     def sum_series(series: pd.Series) -> Union[int, float]:
@@ -240,13 +295,13 @@ class FIRDSParser:
         if (_data_dir is not None) and (not exists(_data_dir)):
             mkdir(_data_dir)
     
-    def get_file_urls(self, from_date: datetime = None, to_date: datetime = None) -> List[str]:
+    def get_query_url(self, from_date: datetime = None, to_date: datetime = None) -> str:
         if from_date is None:
             to_date = datetime.today()
             from_date = to_date - timedelta(weeks=1)
         elif to_date is None:
             to_date = from_date
-        url = self.Q_URL.format(
+        return self.Q_URL.format(
             from_year=from_date.year,
             from_month=from_date.month,
             from_day=from_date.day,
@@ -254,25 +309,37 @@ class FIRDSParser:
             to_month=to_date.month,
             to_day=to_date.day
         )
-        response = requests.get(url)
-        response.raise_for_status()
-        root = etree.fromstring(response.content)
+    
+    @staticmethod
+    def parse_file_urls(content: bytes) -> List[str]:
+        """Takes the response to a FIRDS files query and returns the URLs
+        of the FULINS_D (full debt instrument) files listed in it."""
+        root = etree.fromstring(content)
         urls = []
         for entry in root[1]:
             if entry[3].text.startswith('FULINS_D'): # File name
                 urls.append(entry[1].text) # URL
         return urls
     
-    def download_zipped_file(self, url: str, to_dir: str = None) -> str:
-        if to_dir is None:
-            to_dir = self.data_dir
-        response = requests.get(url)
+    def get_file_urls(self, from_date: datetime = None, to_date: datetime = None) -> List[str]:
+        response = requests.get(service_url(self.get_query_url(from_date, to_date)))
         response.raise_for_status()
-        zipfile = ZipFile(BytesIO(response.content))
+        return self.parse_file_urls(response.content)
+    
+    @staticmethod
+    def extract_zipped_file(content: bytes, to_dir: str) -> str:
+        zipfile = ZipFile(BytesIO(content))
         name = zipfile.namelist()[0]
         zipfile.extractall(path=to_dir)
         return join(to_dir, name)
     
+    def download_zipped_file(self, url: str, to_dir: str = None) -> str:
+        if to_dir is None:
+            to_dir = self.data_dir
+        response = requests.get(service_url(url))
+        response.raise_for_status()
+        return self.extract_zipped_file(response.content, to_dir)
+    
     def download_xml_files(self, from_date: datetime = None, to_date: datetime = None, to_dir: str = None) -> List[str]:
         fpaths = []
         for fpath in self.get_file_urls(from_date, to_date):
@@ -291,27 +358,73 @@ class FIRDSParser:
         else:
             return xml_files
     
+    # Used to prefilter the raw bytes of FIRDS files (see search_isins).  ISIN_ID_RE matches an ISIN
+    # in an Id element; REFDATA_RE matches the first RefData start tag, so we know what (if any)
+    # namespace prefix the file uses.
+    ISIN_ID_RE = re.compile(rb'<(?:[\w.-]+:)?Id>([A-Z]{2}[A-Z0-9]{9}[0-9])</')
+    REFDATA_RE = re.compile(rb'<([\w.-]+:)?RefData>')
+    
+    # The RefData fragments we extract are cut out of their document, so any namespace prefix they
+    # use is undeclared; recover mode lets lxml parse them anyway.
+    FRAGMENT_PARSER = etree.XMLParser(recover=True, huge_tree=True)
+    
+    @staticmethod
+    def _parse_refdata(elem: etree._Element) -> Dict[str, Any]:
+        currency = elem[0][4].text
+        lei = elem[1].text
+        nominal = (currency, float(elem[3][0].text))
+        #maturity = datetime.strptime(elem[3][1].text, '%Y-%m-%d')
+        #denom = float(elem[3][2].text)
+        rca = elem[4][0].text
+        return {
+            'Currency': currency,
+            'Issuer LEI': lei,
+            'Competent Authority': rca,
+            'Nominal Amount': nominal
+        }
+    
     def search_isins(self, isins: Set[str], fpath: str) -> Tuple[Dict[str, Dict[str, str]], Set[str]]:
+        """Search a FIRDS file for the given ISINs.
+        
+        Rather than parsing the whole file, we memory-map it and scan the raw bytes for ISINs in Id
+        elements, and only parse the RefData records containing an ISIN we are looking for.  Building
+        an lxml element for each of the millions of records in a file is what makes a full parse slow,
+        whereas the scan runs at close to the speed of reading the file.
+        """
         results = {}
         missing = isins.copy()
-        for event, elem in etree.iterparse(fpath):
-            if elem.tag.endswith('}RefData'):
-                isin = elem[0][0].text
-                if isin in missing:
-                    currency = elem[0][4].text
-                    lei = elem[1].text
-                    nominal = (currency, float(elem[3][0].text))
-                    #maturity = datetime.strptime(elem[3][1].text, '%Y-%m-%d')
-                    #denom = float(elem[3][2].text)
-                    rca = elem[4][0].text
-                    results[isin] = {
-                        'Currency': currency,
-                        'Issuer LEI': lei,
-                        'Competent Authority': rca,
-                        'Nominal Amount': nominal
-                    }
+        if not missing:
+            return results, missing
+        with open(fpath, 'rb') as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty file, so nothing to find
+                return results, missing
+            with mm:
+                first = self.REFDATA_RE.search(mm)
+                if first is None:
+                    return results, missing
+                prefix = first.group(1) or b''
+                start_tag = b'<' + prefix + b'RefData>'
+                end_tag = b'</' + prefix + b'RefData>'
+                for match in self.ISIN_ID_RE.finditer(mm, first.start()):
+                    isin = match.group(1).decode()
+                    if isin not in missing:
+                        continue
+                    start = mm.rfind(start_tag, 0, match.start())
+                    end = mm.find(end_tag, match.end())
+                    if (start < 0) or (end < 0):
+                        continue
+                    elem = etree.fromstring(mm[start:end + len(end_tag)], self.FRAGMENT_PARSER)
+                    # The ISIN may appear elsewhere in a record (eg, as an underlying instrument), so
+                    # check that it is the ISIN of the record itself.
+                    if elem[0][0].text != isin:
+                        continue
+                    results[isin] = self._parse_refdata(elem)
                     missing.remove(isin)
-                elem.clear()
+                    if not missing:
+                        break
         return results, missing
                 
     def search_all_files(self, isins: Set[str], fpaths: List[str]) -> Tuple[Dict[str, Tuple[str]], Set[str]]:
@@ -324,17 +437,91 @@ class FIRDSParser:
             missing = _missing
         return results, missing
     
+    def get_issuer_urls(self, leis: Collection[str], batch_size: int = 200) -> List[str]:
+        """Return the GLEIF URLs to query to get data on the given LEIs, in
+        batches of `batch_size`."""
+        leis = list(leis)
+        return [self.GLEIF_URL + ','.join(leis[i:i+batch_size]) for i in range(0, len(leis), batch_size)]
+    
     def get_issuers(self, leis: Collection[str]) -> List[str]:
         logging.info('Getting issuer data from GLEIF.')
-        leis = list(leis)
         results = []
-        for i in range(0, len(leis), 200):
-            subset = leis[i:i+200]
-            url = self.GLEIF_URL + ','.join(subset)
-            results += loads(requests.get(url).content)
+        for url in self.get_issuer_urls(leis):
+            results += loads(requests.get(service_url(url)).content)
         return results
 
 
+register_file = join(data_dir, 'sts_register.xlsx')
+
+class RegisterIndex:
+    """Indexes over a DataFrame of securitisations from the register (such
+    as RegisterParser.df, or the enriched DataFrame), so that securitisations
+    can be looked up without scanning the whole DataFrame:
+    
+    - a hash index from each USI to its row;
+    - an inverted index from each ISIN (including each ISIN in a Combo) to
+      the rows it appears in; and
+    - the rows sorted by notification date, so that date ranges can be found
+      by binary search.
+    
+    The indexes refer to rows by position, so must be rebuilt if the
+    DataFrame's rows change.
+    """
+    
+    DATE_COL = 'Notification date to ESMA'
+    
+    def __init__(self, df: DataFrame):
+        self.df = df
+        self.usi: Dict[str, int] = {}
+        for i, usi in enumerate(df['Unique Securitisation Identifier']):
+            if isinstance(usi, str):
+                # Keep the first row for a USI, as RegisterParser.clean_data does.
+                self.usi.setdefault(usi, i)
+        self.isin: Dict[str, List[int]] = {}
+        for i, value in enumerate(df['ISIN code']):
+            for isin in self._isins(value):
+                self.isin.setdefault(isin, []).append(i)
+        dates = df[self.DATE_COL] if self.DATE_COL in df.columns else df.index
+        dates = pd.DatetimeIndex(dates).values
+        # A stable sort, so rows with the same date stay in their original order.  (NaT sorts last.)
+        self.date_order = np.argsort(dates, kind='stable')
+        self.sorted_dates = dates[self.date_order]
+    
+    @staticmethod
+    def _isins(value: Any) -> List[str]:
+        # Values which are too short to be ISINs (eg, "N/A") are left as they are by
+        # RegisterParser._fix_isins, so ignore them.
+        return [isin for isin in _iter_values(value) if isinstance(isin, str) and len(isin) == 12]
+    
+    def get_by_usi(self, usi: str) -> Optional[pd.Series]:
+        i = self.usi.get(usi)
+        return None if i is None else self.df.iloc[i]
+    
+    def isins_by_usi(self, usi: str) -> Optional[List[str]]:
+        row = self.get_by_usi(usi)
+        if row is None:
+            return None
+        return self._isins(row['ISIN code']) or None
+    
+    def get_by_isin(self, isin: str) -> DataFrame:
+        """Return the rows of the securitisations that the given ISIN
+        belongs to (usually just one)."""
+        return self.df.iloc[self.isin.get(isin, [])]
+    
+    def positions_between(self, from_date: datetime = None, to_date: datetime = None) -> np.ndarray:
+        """Return the positions of the rows notified between the two dates
+        (inclusive), in their original order."""
+        lo = 0 if from_date is None else np.searchsorted(self.sorted_dates, np.datetime64(from_date, 'ns'), 'left')
+        if to_date is None:
+            # Exclude rows with no date (NaT sorts last).
+            hi = len(self.sorted_dates) - int(np.isnat(self.sorted_dates).sum())
+        else:
+            hi = np.searchsorted(self.sorted_dates, np.datetime64(to_date, 'ns'), 'right')
+        return np.sort(self.date_order[lo:hi])
+    
+    def get_between(self, from_date: datetime = None, to_date: datetime = None) -> DataFrame:
+        return self.df.iloc[self.positions_between(from_date, to_date)]
+
 class RegisterParser:
 
     URL = ( 
@@ -342,6 +529,20 @@ class RegisterParser:
         'esma33-128-760_securitisations_designated_as_sts_as_from_01_01_2019_regulation_2402_2017.xlsx'
     )
     
+    # The columns we use from the register, and the dtypes to read them as.
+    # Dates are read as strings because at least one is mis-typed in the
+    # register; they are converted in clean_data once that has been fixed.
+    COLUMNS = {
+        'Unique Securitisation Identifier': 'str',
+        'Securitisation Name': 'str',
+        'Notification date to ESMA': 'str',
+        'Private or Public': 'str',
+        'Underlying assets': 'str',
+        'Non-ABCP/      ABCP transaction/ ABCP Programme': 'str',
+        'Originator Country': 'str',
+        'ISIN code': 'str'
+    }
+    
     OC_REPLACE = {
         'Italy': 'IT',
         'UK': 'GB'
@@ -386,13 +587,15 @@ class RegisterParser:
     
     def __init__(self, path: str = None):
         if path is None:
-            path = self.URL
-        self.df = read_excel(path, skiprows=10, header=0)
-        self.df.columns = [c.strip() for c in self.df.columns]
+            path = fetch_data(register_file, self.URL, force_dl=True, binary_data=True)
+        self.df = read_excel_cached(path, self.COLUMNS, skiprows=10)
         self.clean_data()
         #self.sts_ws = load_workbook(fpath)['List of STS Securitisations'] # So we can get the hyperlink URL for the STS file
         self.df = self.df.apply(self._fix_isins, axis=1)
         self.df['Originator Country (full)'] = Combo.replace_series(self.df['Originator Country'], iso_to_name)
+        self.index = RegisterIndex(self.df)
+        # Same rows in the same order as self.df, so positions from self.index apply to it too.
+        self.df_by_date = self.df.set_index('Notification date to ESMA')
         
     
     def clean_data(self):
@@ -429,7 +632,8 @@ class RegisterParser:
         self.df = self.df.apply(self._fix_originator_country, axis=1)
         
         # Mis-spelled date entry on 31 October 2019
-        self.df['Notification date to ESMA'].replace('31/1012019', datetime(2019, 10, 31), inplace=True)
+        self.df['Notification date to ESMA'].replace('31/1012019', '2019-10-31', inplace=True)
+        self.df['Notification date to ESMA'] = pd.to_datetime(self.df['Notification date to ESMA'])
                     
     def get_ws_row_by_usi(self, usi: str):
         for r in self.sts_ws.iter_rows():
@@ -441,18 +645,10 @@ class RegisterParser:
         return r[-1].hyperlink.target
     
     def get_isins_by_usi(self, usi):
-        """Takes a Unique Securitisation Identifier and returns a list of ISINs."""
+        """Takes a Unique Securitisation Identifier and returns a list of ISINs
+        (or None if the securitisation has no valid ISINs)."""
         
-        row = self.df.loc[self.df['Unique Securitisation Identifier'] == usi]
-        isin_col = str(row['ISIN code'].iloc[0])
-        if len(isin_col) < 12:
-            # Not a valid ISIN (probably "NA" or some variant)
-            return None
-        else:
-            # Split the string, strip away a number of common delimiters
-            # from each item in the resulting list, and return only
-            # non-empty items.
-            return filter(bool, [i.split(';,\t\n') for i in isin_col.split()])
+        return self.index.isins_by_usi(usi)
     
     def get_between(self, from_date=zero_time, to_date=None):
         """Takes two datetime objects and returns all rows that are between the two dates (inclusive)."""
@@ -460,16 +656,17 @@ class RegisterParser:
         if to_date is None:
             to_date = datetime.today()
         
-        return self.df[(self.df['Notification date to ESMA'] >= from_date) & (self.df['Notification date to ESMA'] <= to_date)].set_index('Notification date to ESMA')
+        return self.df_by_date.iloc[self.index.positions_between(from_date, to_date)]
 
     def download_data(self, to_file: str = None) -> str:
-        data = requests.get(self.URL).raise_for_status().content
+        data = requests.get(service_url(self.URL)).raise_for_status().content
         if to_file:
             with open(to_file, 'w') as f:
                 f.write(data)
         return data
     
-    def check_isin(self, isin: str) -> bool:
+    @staticmethod
+    def check_isin(isin: str) -> bool:
         isin = list(isin.upper())
         checkdigit = int(isin.pop())
         # Replace country code characters with numbers
@@ -553,6 +750,10 @@ def _apply_issuer_data(row, isin_data):
         # Multiple ISINs, as a Combo.  So we *may* need to create Combos
         # in the relevant data columns.
         col_data = {col: set() for col in ISSUER_COLS}
+        # Nominal amounts are summed by currency rather than collected in a
+        # set (as a Combo is), so that tranches with the same currency and
+        # amount are all counted.
+        amounts = {}
         for isin in isin_val:
             try:
                 data = isin_data[isin]
@@ -562,7 +763,12 @@ def _apply_issuer_data(row, isin_data):
                 # is in the search results.
                 continue
             for col in data:
-                col_data[col].add(data[col])
+                if col == 'Nominal Amount':
+                    ccy, amount = data[col]
+                    amounts[ccy] = amounts.get(ccy, 0) + amount
+                else:
+                    col_data[col].add(data[col])
+        col_data['Nominal Amount'] = set(amounts.items())
         for col in col_data:
             data = col_data[col]
             if len(data) == 1:
@@ -598,11 +804,75 @@ manual_isin_data = {
 }
 
 
-def add_issuer_data(df: DataFrame) -> DataFrame:
-    logging.info('Adding issuer data.')
-    for col in ISSUER_COLS:
-        df[col] = None
-    fp = FIRDSParser(firds_data_dir)
+def _issuer_country(issuer: Dict[str, Any]) -> str:
+    ic = issuer['Entity']['LegalJurisdiction']['$']
+    if len(ic) > 2:
+        logging.warn(f'Found long issuer country code f{ic}.  Truncating to first two characters.')
+        ic = ic[:2]
+    return ic
+
+# Minimum score (from 0 to 1) for a name match to be used to fill in missing issuer data.
+NAME_MATCH_THRESHOLD = 0.6
+# Number of best matches considered for each name, so that one without conflicting identifiers can be used.
+NAME_MATCH_CANDIDATES = 5
+name_match_report_file = join(data_dir, 'issuer_name_matches.csv')
+
+def match_missing_issuers(df: DataFrame, issuer_data: List[Dict[str, Any]],
+                          min_score: float = NAME_MATCH_THRESHOLD) -> Tuple[DataFrame, DataFrame]:
+    """Where we have no issuer data for a public securitisation (eg, because its ISINs are missing
+    from the register or from FIRDS), try to identify the issuer by fuzzy-matching the name of the
+    securitisation against the legal names of the issuers we know about.
+
+    Sibling vehicles of the same programme (eg, "SC Germany Consumer 2019-1" and "SC Germany Consumer
+    2020-1") have very similar names, so issuers whose names have different years, series numbers or
+    series letters to the securitisation's (see name_match.identifiers_conflict) are never matched,
+    however high they score.
+
+    The candidates are only the issuers in `issuer_data`, ie, the GLEIF records of issuers already
+    identified (through FIRDS) for other securitisations.  So a securitisation can only be matched to
+    an issuer with other securitisations in the register (such as a programme's previous vehicles);
+    one whose issuer has none is reported with no match, or with a wrong one for review.
+
+    Returns `df`, with the issuer LEI, name and country filled in for rows where the best remaining
+    match scores at least `min_score`, and a report of the best match (if any) for each row that was
+    missing issuer data, for review.
+    """
+    index = NameIndex()
+    index.update((issuer['Entity']['LegalName']['$'], issuer) for issuer in issuer_data)
+    unmatched = (df['Issuer LEI'].isnull() & (df['Private or Public'] == 'Public')).values
+    cols = {c: df.columns.get_loc(c) for c in ('Issuer LEI', 'Issuer Name', 'Issuer Country')}
+    report = []
+    for pos in unmatched.nonzero()[0]:
+        name = df['Securitisation Name'].iat[pos]
+        matches = index.match(name, limit=NAME_MATCH_CANDIDATES) if pd.notnull(name) else []
+        compatible = [m for m in matches if not identifiers_conflict(name, m[0])]
+        conflict = bool(matches) and not compatible
+        if compatible or matches:
+            # If every candidate conflicts, report the best of them (but don't apply it).
+            issuer_name, issuer, score = (compatible or matches)[0]
+            lei = issuer['LEI']['$']
+        else:
+            issuer_name, lei, score = None, None, 0.0
+        applied = (not conflict) and (score >= min_score)
+        if applied:
+            df.iat[pos, cols['Issuer LEI']] = lei
+            df.iat[pos, cols['Issuer Name']] = issuer_name
+            df.iat[pos, cols['Issuer Country']] = _issuer_country(issuer)
+        report.append({
+            'Unique Securitisation Identifier': df['Unique Securitisation Identifier'].iat[pos],
+            'Securitisation Name': name,
+            'Matched Issuer Name': issuer_name,
+            'Matched Issuer LEI': lei,
+            'Score': round(score, 3),
+            'Identifiers Conflict': conflict,
+            'Applied': applied
+        })
+    return df, DataFrame(report, columns=['Unique Securitisation Identifier', 'Securitisation Name',
+                                          'Matched Issuer Name', 'Matched Issuer LEI', 'Score',
+                                          'Identifiers Conflict', 'Applied'])
+
+def get_isins(df: DataFrame) -> Set[str]:
+    """Return all ISINs that appear in the "ISIN code" column of `df`."""
     isins = set()
     for i in list(df['ISIN code']):
         if pd.notnull(i):
@@ -610,11 +880,17 @@ def add_issuer_data(df: DataFrame) -> DataFrame:
                 isins.update(i.values)
             else:
                 isins.add(i)
-    xml_files = fp.get_xml_files()
-    isin_data, missing = fp.search_all_files(isins, xml_files)
-    if missing:
-        logging.warn('The following ISINs are missing the FIRDS data: {}.'.format(missing))
-    isin_data.update(manual_isin_data)
+    return isins
+
+def merge_issuer_data(df: DataFrame, isin_data: Dict[str, Dict[str, Any]],
+                      issuer_data: List[Dict[str, Any]]) -> Tuple[DataFrame, DataFrame]:
+    """Takes search results from FIRDS (as returned by FIRDSParser.search_all_files) and issuer
+    records from GLEIF (as returned by FIRDSParser.get_issuers) and adds them to `df`.
+
+    Returns `df`, and the report of the issuers matched by name for securitisations with no issuer
+    data (see match_missing_issuers), which can be saved with save_name_match_report."""
+    for col in ISSUER_COLS:
+        df[col] = None
     leis = {}
     for isin in isin_data:
         lei = isin_data[isin]['Issuer LEI']
@@ -622,19 +898,16 @@ def add_issuer_data(df: DataFrame) -> DataFrame:
             leis[lei].append(isin)
         else:
             leis[lei] = [isin]
-    issuer_data = fp.get_issuers(leis.keys())
     for issuer in issuer_data:
         isins = leis[issuer['LEI']['$']] # A list of ISINs (possibly length 1)
         for isin in isins:
             isin_data[isin]['Issuer Name'] = issuer['Entity']['LegalName']['$']
-            ic = issuer['Entity']['LegalJurisdiction']['$']
-            if len(ic) > 2:
-                logging.warn(f'Found long issuer country code f{ic}.  Truncating to first two characters.')
-                ic = ic[:2]
-            isin_data[isin]['Issuer Country'] = ic
+            isin_data[isin]['Issuer Country'] = _issuer_country(issuer)
     
     df = df.apply(lambda r: _apply_issuer_data(r, isin_data), axis=1)#.set_index('Notification date to ESMA')
     
+    df, report = match_missing_issuers(df, issuer_data)
+    
     df['Issuer Country (full)'] = Combo.replace_series(df['Issuer Country'], iso_to_name)
     
     #currencies = Combo.series_set(df['Currency'].dropna())
@@ -642,6 +915,26 @@ def add_issuer_data(df: DataFrame) -> DataFrame:
     #rates, rate_date = get_fx(currencies)
     #logging.info('Got FX rates as of {}.'.format(rate_date.strftime('%Y-%m-%d')))
     #df['Nominal Amount (EUR)'] = Combo.convert_series_to_eur(df['Nominal Amount'], rates)
+    return df, report
+
+def save_name_match_report(report: DataFrame, fpath: str = name_match_report_file):
+    """Save the report of issuers matched by name (as returned by merge_issuer_data), if there were
+    any securitisations to match, for review."""
+    if len(report):
+        report.to_csv(fpath, index=False)
+        logging.warn('Matched issuers by name for {} of {} securitisations with no issuer data; see {} for review.'.format(
+            report['Applied'].sum(), len(report), fpath))
+
+def add_issuer_data(df: DataFrame) -> DataFrame:
+    logging.info('Adding issuer data.')
+    fp = FIRDSParser(firds_data_dir)
+    isins = get_isins(df)
+    xml_files = fp.get_xml_files()
+    isin_data, missing = fp.search_all_files(isins, xml_files)
+    if missing:
+        logging.warn('The following ISINs are missing the FIRDS data: {}.'.format(missing))
+    isin_data.update(manual_isin_data)
+    issuer_data = fp.get_issuers({d['Issuer LEI'] for d in isin_data.values()})
+    df, report = merge_issuer_data(df, isin_data, issuer_data)
+    save_name_match_report(report)
     return df
-    
-    
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Extraction of every debt instrument in the FIRDS (FULINS_D) files to a
+columnar dataset, for market-wide comparisons.
+
+FIRDSParser.search_isins only pulls the records for the ISINs in the STS
+register out of the FIRDS files.  Here, every RefData record with debt
+instrument attributes is written to a Parquet dataset, partitioned by the
+FIRDS file it came from:
+
+    data_files/firds_dataset/source=FULINS_D_20200104_01of03/data.parquet
+
+The files are parsed with iterparse, and records are written in row groups
+of CHUNK_ROWS as they are parsed, so memory use is bounded however large the
+files are.  Each file's partition is written to a temporary file which
+replaces the partition once complete, so an interrupted extract resumes
+from the first file that wasn't completed; files whose partitions are up to
+date (according to their size and modification time) are skipped.
+Partitions for FIRDS files that no longer exist are removed.
+
+Query the dataset with read_dataset, eg:
+
+    read_dataset(['currency', 'nominal_amount'], filters=[('competent_authority', '=', 'IE')])
+
+Run this module as a script to update the dataset.
+"""
+
+from os.path import dirname, realpath
+import sys
+sys.path.append(dirname(realpath(__file__)))
+
+import json
+import logging
+from datetime import date
+from os import listdir, makedirs, replace
+from os.path import basename, exists, getmtime, getsize, join, splitext
+from shutil import rmtree
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from lxml import etree
+import pandas as pd
+from pandas import DataFrame
+
+import fetch_data as fd
+
+dataset_dir = join(fd.data_dir, 'firds_dataset')
+state_file = join(dataset_dir, '_state.json')
+
+CHUNK_ROWS = 100000
+
+# Bump this if the columns or how they are extracted change, so that
+# existing partitions are rebuilt.
+EXTRACT_VERSION = 1
+
+COLUMNS = ['isin', 'issuer_lei', 'currency', 'nominal_amount', 'maturity', 'denomination', 'competent_authority']
+
+
+def _schema():
+    import pyarrow as pa
+    return pa.schema([
+        ('isin', pa.string()),
+        ('issuer_lei', pa.string()),
+        ('currency', pa.string()),
+        ('nominal_amount', pa.float64()),
+        ('maturity', pa.date32()),
+        ('denomination', pa.float64()),
+        ('competent_authority', pa.string())
+    ])
+
+
+def _float(text: Optional[str]) -> Optional[float]:
+    return None if text is None else float(text)
+
+
+def _date(text: Optional[str]) -> Optional[date]:
+    # Maturity dates are given as YYYY-MM-DD (perpetual instruments have none).
+    return None if text is None else date(*map(int, text[:10].split('-')))
+
+
+def iter_debt_records(fpath: str) -> Iterator[Tuple]:
+    """Yield a tuple of the values of COLUMNS for each RefData record in a
+    FIRDS file which has debt instrument attributes.  Each record's element
+    is discarded as soon as it has been read, so the whole tree is never
+    held in memory."""
+    ns = None
+    for _, elem in etree.iterparse(fpath, events=('end',), tag='{*}RefData', huge_tree=True):
+        if ns is None:
+            ns = elem.tag[:-len('RefData')]
+        debt = elem.find(ns + 'DebtInstrmAttrbts')
+        if debt is not None:
+            general = elem.find(ns + 'FinInstrmGnlAttrbts')
+            yield (
+                general.findtext(ns + 'Id'),
+                elem.findtext(ns + 'Issr'),
+                general.findtext(ns + 'NtnlCcy'),
+                _float(debt.findtext(ns + 'TtlIssdNmnlAmt')),
+                _date(debt.findtext(ns + 'MtrtyDt')),
+                _float(debt.findtext(ns + 'NmnlValPerUnit')),
+                elem.findtext(ns + 'TechAttrbts/' + ns + 'RlvntCmptntAuthrty')
+            )
+        # Free the element, and any preceding siblings which lxml still references.
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def _write_chunk(writer, rows: List[Tuple]):
+    import pyarrow as pa
+    columns = list(zip(*rows))
+    schema = _schema()
+    writer.write_table(pa.Table.from_arrays([pa.array(col, type=field.type) for col, field in zip(columns, schema)],
+                                            schema=schema))
+
+
+def extract_file(fpath: str, out_file: str, chunk_rows: int = CHUNK_ROWS) -> int:
+    """Write the debt records of a FIRDS file to a Parquet file, a row group
+    of `chunk_rows` records at a time.  Returns the number of records."""
+    import pyarrow.parquet as pq
+    # Hidden (dataset discovery skips names starting with "." or "_"), so
+    # that a partial file left by an interrupted extract isn't read.
+    tmp_file = join(dirname(out_file), '.' + basename(out_file) + '.tmp')
+    n = 0
+    with pq.ParquetWriter(tmp_file, _schema(), compression='snappy') as writer:
+        rows = []
+        for record in iter_debt_records(fpath):
+            rows.append(record)
+            if len(rows) >= chunk_rows:
+                _write_chunk(writer, rows)
+                n += len(rows)
+                rows = []
+        if rows:
+            _write_chunk(writer, rows)
+            n += len(rows)
+    replace(tmp_file, out_file)
+    return n
+
+
+def _load_state() -> Dict[str, Any]:
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(state: Dict[str, Any]):
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    replace(state_file + '.tmp', state_file)
+
+
+def update_dataset(fpaths: List[str] = None, force: bool = False, chunk_rows: int = CHUNK_ROWS) -> Dict[str, int]:
+    """Bring the dataset up to date with the given FIRDS files (by default,
+    those in fetch_data.firds_data_dir), extracting only those which have
+    changed since they were last extracted.  Returns the number of records
+    in each file."""
+    if fpaths is None:
+        fpaths = fd.FIRDSParser(fd.firds_data_dir).get_xml_files()
+    makedirs(dataset_dir, exist_ok=True)
+    state = {} if force else _load_state()
+    sources = {}
+    for fpath in sorted(fpaths):
+        source = splitext(basename(fpath))[0]
+        sources[source] = fpath
+        stat = [getsize(fpath), getmtime(fpath), EXTRACT_VERSION]
+        partition_dir = join(dataset_dir, f'source={source}')
+        out_file = join(partition_dir, 'data.parquet')
+        if state.get(source, {}).get('stat') == stat and exists(out_file):
+            logging.info(f'{source} is up to date.')
+            continue
+        logging.info(f'Extracting debt instruments from {source}.')
+        makedirs(partition_dir, exist_ok=True)
+        rows = extract_file(fpath, out_file, chunk_rows)
+        # Saved after each file, so that an interrupted update resumes from the next one.
+        state[source] = {'stat': stat, 'rows': rows}
+        _save_state(state)
+    for name in listdir(dataset_dir):
+        if name.startswith('source=') and name[len('source='):] not in sources:
+            logging.info(f'Removing {name}, as its FIRDS file no longer exists.')
+            rmtree(join(dataset_dir, name), ignore_errors=True)
+            state.pop(name[len('source='):], None)
+    _save_state(state)
+    return {source: state[source]['rows'] for source in sources}
+
+
+def read_dataset(columns: List[str] = None, filters: List[Tuple] = None) -> DataFrame:
+    """Read the dataset (or the given columns of it, filtered by `filters`;
+    see pandas.read_parquet) into a DataFrame.  Only the columns asked for
+    are read, and row groups which the filters exclude are skipped."""
+    return pd.read_parquet(dataset_dir, engine='pyarrow', columns=columns, filters=filters)
+
+
+if __name__ == '__main__':
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Extract all debt instruments from the FIRDS files to Parquet.')
+    parser.add_argument('--force', action='store_true', help='Re-extract every file, even if it is unchanged.')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='Records per row group.')
+    args = parser.parse_args()
+    counts = update_dataset(force=args.force, chunk_rows=args.chunk_rows)
+    print(f'{sum(counts.values())} debt instruments in {len(counts)} files.')
+    print(read_dataset(['currency', 'nominal_amount']).groupby('currency')['nominal_amount']
+          .agg(['count', 'sum']).sort_values('count', ascending=False).head(10).to_string())
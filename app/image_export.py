@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Static PNG and SVG images of the dashboard's charts, for embedding in
+newsletters and other sites.
+
+Each figure (every dcc.Graph in the overview and in the sections of
+dash_app) is rendered with kaleido, in a pool of worker processes, and the
+images are cached on disk under the data version:
+
+    data_files/image_cache/<data version>/<figure id>.<hash>.<png|svg>
+
+The images are served (by the blueprint, which dash_app registers) from
+URLs containing a hash of their content, so they can be cached forever by
+browsers and proxies:
+
+    /dataviz/stss_intro/images/                        (JSON list of images)
+    /dataviz/stss_intro/images/<figure id>.png         (redirects to ...)
+    /dataviz/stss_intro/images/<figure id>.<hash>.png
+
+Images are rendered on first request if they haven't been already, but
+running this module as a script renders them all up front.  A figure is
+re-rendered if its content has changed (eg, because the code that builds it
+has), even if the data hasn't.  The processes serving the app (eg, the
+uwsgi workers) share the cache: each adds its images to the manifest on
+disk, and renders them one at a time, under locks on files in the cache.
+"""
+
+from os.path import dirname, realpath
+import sys
+sys.path.append(dirname(realpath(__file__)))
+
+import fcntl
+import json
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from hashlib import sha256
+from os import listdir, makedirs, remove, replace
+from os.path import exists, join
+from shutil import rmtree
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import flask
+import plotly.io as pio
+import dash_core_components as dcc
+
+import fetch_data as fd
+import curated_data as cd
+
+cache_dir = join(fd.data_dir, 'image_cache')
+manifest_name = 'manifest.json'
+# Lock files (in each data version's directory), shared by all processes
+# using the cache, such as the uwsgi workers.
+manifest_lock_name = '.manifest.lock'
+render_lock_name = '.render.lock'
+
+FORMATS = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+# Size of the rendered images, in pixels (PNGs are rendered at SCALE times this).
+WIDTH = 1000
+HEIGHT = 600
+SCALE = 2
+
+RENDER_PROCESSES = 4
+
+
+def _iter_graphs(components: Any) -> Iterator[dcc.Graph]:
+    if isinstance(components, (list, tuple)):
+        for c in components:
+            yield from _iter_graphs(c)
+    elif isinstance(components, dcc.Graph):
+        yield components
+    elif hasattr(components, 'children'):
+        yield from _iter_graphs(components.children)
+
+
+def get_figures() -> Dict[str, str]:
+    """Return the JSON of every figure on the page, by the id of its Graph."""
+    import dash_app
+    components = list(dash_app.overview_layout)
+    for _, _, builder in dash_app.SECTIONS:
+        components.extend(builder())
+    # The figures of toggled graphs are only placeholders, until built in the browser.
+    return {graph.id: pio.to_json(dash_app.toggled_figure(graph.id) if graph.id in dash_app.TOGGLED_GRAPHS
+                                  else graph.figure, validate=False)
+            for graph in _iter_graphs(components)}
+
+
+@contextmanager
+def _file_lock(fpath: str):
+    """Hold an exclusive lock on a file (created if need be), which other
+    processes (and threads) block on until it is released."""
+    with open(fpath, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def render(figure_json: str, fmt: str) -> bytes:
+    """Render a figure to an image.  (Run in the worker processes.)"""
+    # Not validated, as some of the figures use shorthand which plotly.js
+    # accepts but plotly.py doesn't (eg, a trace type of "line").
+    return pio.to_image(json.loads(figure_json), format=fmt, width=WIDTH, height=HEIGHT,
+                        scale=SCALE if fmt == 'png' else 1, validate=False)
+
+
+class ImageCache:
+    """The rendered images for one version of the data."""
+
+    def __init__(self, data_version: str = None, _cache_dir: str = cache_dir):
+        self.data_version = data_version or cd.data_version
+        self.dir = join(_cache_dir, self.data_version)
+        self.cache_dir = _cache_dir
+        self._lock = threading.Lock()
+        self._render_lock = threading.Lock()
+        self._figures = None
+        self.manifest: Dict[str, Dict[str, str]] = self._read_manifest()
+
+    @property
+    def figures(self) -> Dict[str, str]:
+        if self._figures is None:
+            self._figures = get_figures()
+        return self._figures
+
+    def _read_manifest(self) -> Dict[str, Dict[str, str]]:
+        try:
+            with open(join(self.dir, manifest_name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def reload(self):
+        """Update the manifest with the images other processes have rendered."""
+        self.manifest = self._read_manifest()
+
+    @contextmanager
+    def _locked(self, lock_name: str):
+        makedirs(self.dir, exist_ok=True)
+        with _file_lock(join(self.dir, lock_name)):
+            yield
+
+    @staticmethod
+    def _key(figure_id: str, fmt: str) -> str:
+        return f'{figure_id}.{fmt}'
+
+    def lookup(self, figure_id: str, fmt: str) -> Tuple[Optional[str], bool]:
+        """Return the name of the image file for a figure (None if it couldn't
+        be rendered), and whether that is up to date with the figure."""
+        entry = self.manifest.get(self._key(figure_id, fmt))
+        if entry is None:
+            return None, False
+        current = entry['figure_hash'] == self._figure_hash(figure_id)
+        if entry['file'] is None:
+            return None, current
+        return entry['file'], current and exists(join(self.dir, entry['file']))
+
+    def _figure_hash(self, figure_id: str) -> str:
+        return sha256(self.figures[figure_id].encode()).hexdigest()
+
+    def _store(self, figure_id: str, fmt: str, image: Optional[bytes]) -> Optional[str]:
+        """Save an image and record it in the manifest.  If `image` is None,
+        record that the figure couldn't be rendered, so that it isn't tried
+        again until it changes."""
+        fname = None if image is None else f'{figure_id}.{sha256(image).hexdigest()[:16]}.{fmt}'
+        # Other processes write the manifest too, so the entry is added to the
+        # manifest on disk (which includes theirs), not to this one's copy.
+        # The image is written under the same lock, so that prune doesn't
+        # remove it before it is in the manifest.
+        with self._lock, self._locked(manifest_lock_name):
+            if fname is not None:
+                with open(join(self.dir, fname + '.tmp'), 'wb') as f:
+                    f.write(image)
+                replace(join(self.dir, fname + '.tmp'), join(self.dir, fname))
+            manifest = self._read_manifest()
+            manifest[self._key(figure_id, fmt)] = {
+                'file': fname,
+                'figure_hash': self._figure_hash(figure_id)
+            }
+            with open(join(self.dir, manifest_name + '.tmp'), 'w') as f:
+                json.dump(manifest, f, indent=1)
+            replace(join(self.dir, manifest_name + '.tmp'), join(self.dir, manifest_name))
+            self.manifest = manifest
+        return fname
+
+    def _render(self, figure_id: str, fmt: str, render_image: Callable[[], bytes]) -> Optional[str]:
+        try:
+            image = render_image()
+        except Exception as e:
+            # Eg, maps can't be rendered without access to their tiles.
+            logging.warning(f'Could not render {figure_id} as {fmt}: {e}')
+            image = None
+        return self._store(figure_id, fmt, image)
+
+    def get(self, figure_id: str, fmt: str) -> Optional[str]:
+        """Return the name of the image file for a figure (None if it can't
+        be rendered), rendering it in this process if it isn't up to date."""
+        fname, current = self.lookup(figure_id, fmt)
+        if not current:
+            # One at a time (across all processes), as each render starts a
+            # browser; and another process may have rendered it meanwhile.
+            with self._render_lock, self._locked(render_lock_name):
+                self.reload()
+                fname, current = self.lookup(figure_id, fmt)
+                if not current:
+                    logging.info(f'Rendering {figure_id} as {fmt}.')
+                    fname = self._render(figure_id, fmt, lambda: render(self.figures[figure_id], fmt))
+        return fname
+
+    def render_all(self, formats: Iterable[str] = FORMATS, processes: int = RENDER_PROCESSES) -> List[str]:
+        """Render every figure which isn't up to date, in a pool of
+        `processes` workers, and return the names of all the image files."""
+        self.reload()
+        jobs = [(figure_id, fmt) for figure_id in self.figures for fmt in formats
+                if not self.lookup(figure_id, fmt)[1]]
+        logging.info(f'Rendering {len(jobs)} images.')
+        if jobs:
+            # Forked, like the pipeline's workers, so that they don't re-import the app.
+            context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods()
+                                                  else None)
+            with ProcessPoolExecutor(min(processes, len(jobs)), mp_context=context) as executor:
+                futures = {(figure_id, fmt): executor.submit(render, self.figures[figure_id], fmt)
+                           for figure_id, fmt in jobs}
+                for (figure_id, fmt), future in futures.items():
+                    self._render(figure_id, fmt, future.result)
+        self.prune()
+        return [entry['file'] for entry in self.manifest.values() if entry['file'] is not None]
+
+    def prune(self):
+        """Remove images for old data versions, and superseded images for this one."""
+        if exists(self.cache_dir):
+            for name in listdir(self.cache_dir):
+                if name != self.data_version:
+                    rmtree(join(self.cache_dir, name), ignore_errors=True)
+        if not exists(self.dir):
+            return
+        # Under the manifest's lock, so that images which other processes are
+        # adding to it (see _store) aren't removed.
+        with self._lock, self._locked(manifest_lock_name):
+            self.reload()
+            keep = {entry['file'] for entry in self.manifest.values()} | {manifest_name}
+            for name in listdir(self.dir):
+                # Lock files are hidden.
+                if (name not in keep) and not name.startswith('.'):
+                    try:
+                        remove(join(self.dir, name))
+                    except OSError:
+                        pass
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> ImageCache:
+    global _cache
+    with _cache_lock:
+        if (_cache is None) or (_cache.data_version != cd.data_version):
+            _cache = ImageCache()
+        return _cache
+
+
+blueprint = flask.Blueprint('images', __name__)
+
+
+def _file_url(fname: str) -> str:
+    figure_id, content_hash, fmt = fname.rsplit('.', 2)
+    return flask.url_for('images.image_file', figure_id=figure_id, content_hash=content_hash, fmt=fmt)
+
+
+@blueprint.route('/')
+def list_images():
+    cache = get_cache()
+    cache.reload()
+    return flask.jsonify({
+        'data_version': cache.data_version,
+        'figures': sorted(cache.figures),
+        'formats': sorted(FORMATS),
+        'images': {key: _file_url(entry['file'])
+                   for key, entry in sorted(cache.manifest.items()) if entry['file'] is not None}
+    })
+
+
+@blueprint.route('/<figure_id>.<fmt>')
+def image(figure_id: str, fmt: str):
+    cache = get_cache()
+    if (fmt not in FORMATS) or (figure_id not in cache.figures):
+        flask.abort(404)
+    fname = cache.get(figure_id, fmt)
+    if fname is None:
+        flask.abort(404, f"{figure_id} can't be rendered as an image.")
+    response = flask.redirect(_file_url(fname))
+    # The image a figure's URL points to changes when the data does.
+    response.headers['Cache-Control'] = 'public, no-cache'
+    return response
+
+
+@blueprint.route('/<figure_id>.<content_hash>.<fmt>', endpoint='image_file')
+def image_file(figure_id: str, content_hash: str, fmt: str):
+    cache = get_cache()
+    fname = f'{figure_id}.{content_hash}.{fmt}'
+    if (fmt not in FORMATS) or not exists(join(cache.dir, fname)):
+        flask.abort(404)
+    response = flask.send_from_directory(cache.dir, fname, mimetype=FORMATS[fmt])
+    # The URL changes whenever the image does.
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    files = get_cache().render_all()
+    print(f'{len(files)} images in {get_cache().dir}.')
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Cached reading of Excel workbooks.
+
+Parsing xlsx files is slow, so the parsed (and column-pruned) contents of a
+workbook are cached as Parquet, keyed on a hash of the workbook's contents
+and of the arguments used to read it.  An unchanged workbook is therefore only
+ever parsed once.  Only the latest entry for each workbook (read with given
+arguments) is kept, so the cache doesn't grow each time a workbook (such as
+the register) is updated.
+"""
+
+import logging
+import re
+from hashlib import sha256
+from json import dumps
+from os import listdir, makedirs, remove, replace
+from os.path import abspath, dirname, exists, join, realpath
+from typing import Dict, Union
+
+import pandas as pd
+from pandas import DataFrame
+
+cache_dir = join(dirname(realpath(__file__)), 'data_files', 'ingest_cache')
+
+# Bump this if the way workbooks are read or cached changes, so that stale
+# cache entries are ignored.
+CACHE_VERSION = 2
+
+# Cache entries from before they were named after their source (see _source_id).
+OLD_ENTRY_RE = re.compile(r'^[0-9a-f]{64}\.parquet$')
+
+
+def _cache_key(fpath: str, **read_args) -> str:
+    h = sha256()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    h.update(dumps(read_args, sort_keys=True, default=str).encode())
+    h.update(str(CACHE_VERSION).encode())
+    return h.hexdigest()
+
+
+def _source_id(fpath: str, **read_args) -> str:
+    # Identifies a workbook (by its path) read with given arguments, whatever its contents.
+    return sha256(dumps([abspath(fpath), read_args], sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def _prune(source_id: str, keep: str):
+    """Remove all cache entries for a source except `keep`."""
+    for name in listdir(cache_dir):
+        if (name.startswith(source_id + '.') and name != keep) or OLD_ENTRY_RE.match(name):
+            try:
+                remove(join(cache_dir, name))
+            except OSError:
+                pass
+
+
+# Converters for the dtypes that columns can be read as.  Cells are read
+# as raw objects and converted afterwards, so that a stray value (such as ":"
+# for a missing figure) can't stop a whole workbook from being read.
+CONVERTERS = {
+    'str': lambda s: s.where(s.isnull(), s.astype(str)),
+    'float': lambda s: pd.to_numeric(s, errors='coerce'),
+    'datetime': lambda s: pd.to_datetime(s, errors='coerce')
+}
+
+
+def read_excel_cached(fpath: str, columns: Dict[str, str], sheet_name: Union[str, int] = 0,
+                      skiprows: int = 0) -> pd.DataFrame:
+    """Read the given columns from a sheet of an Excel workbook.
+
+    `columns` maps the names of the columns to read to the dtype each should
+    be converted to (one of the keys of CONVERTERS).  Column names in the
+    workbook are stripped of surrounding whitespace (and converted to strings)
+    before being matched, so that stray spaces or numeric headers (such as
+    years) don't prevent a match.  The returned DataFrame has its columns in
+    the order given.
+    """
+
+    read_args = {'columns': columns, 'sheet_name': sheet_name, 'skiprows': skiprows}
+    source_id = _source_id(fpath, **read_args)
+    cache_name = f'{source_id}.{_cache_key(fpath, **read_args)}.parquet'
+    cache_file = join(cache_dir, cache_name)
+    if exists(cache_file):
+        logging.info(f'Loading {fpath} from cache.')
+        return pd.read_parquet(cache_file)
+
+    logging.info(f'Parsing {fpath}.')
+    df = pd.read_excel(
+        fpath,
+        sheet_name=sheet_name,
+        skiprows=skiprows,
+        header=0,
+        usecols=lambda c: str(c).strip() in columns,
+        dtype=object
+    )
+    df.columns = [str(c).strip() for c in df.columns]
+    missing = set(columns).difference(df.columns)
+    if missing:
+        raise KeyError(f'Columns not found in {fpath}: {missing}')
+    df = DataFrame({col: CONVERTERS[col_type](df[col]) for col, col_type in columns.items()})
+
+    makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first so that an interrupted write can never
+    # leave a corrupt cache entry behind.
+    tmp_file = cache_file + '.tmp'
+    df.to_parquet(tmp_file, index=False)
+    replace(tmp_file, cache_file)
+    _prune(source_id, cache_name)
+    return df
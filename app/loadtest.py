@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""A load-testing harness for the dashboard.
+
+Simulates complete page loads (the page itself, the Dash layout and
+dependencies, the component suites and assets the page references, the
+callbacks that the page fires on load, and the component chunks, such as
+the plotly.js bundle, which the Dash renderer then loads asynchronously) at
+a configurable concurrency, either in-process against the Flask app or
+against a running server.  Reports
+throughput, latency percentiles and bytes transferred per page load, and saves
+the results as JSON so that releases can be compared.
+
+Example usage:
+
+    python loadtest.py --concurrency 8 --loads 200 --label v1.2
+    python loadtest.py --url http://127.0.0.1:8000 --compare results/v1.1.json
+"""
+
+import json
+import logging
+import re
+import threading
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+from math import ceil
+from os import makedirs
+from os.path import dirname, join, realpath
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import requests
+
+BASE_PATH = '/dataviz/stss_intro/'
+results_dir = join(dirname(realpath(__file__)), 'loadtest_results')
+
+# Local scripts and stylesheets referenced by the page HTML.
+ASSET_RE = re.compile(r'(?:src|href)="(/[^"]+)"')
+
+# Component suites' main bundles, as referenced by the page HTML.  Their
+# asynchronously loaded chunks are served from the same directory, with the
+# same fingerprint (eg, ".../dcc/async-graph.v2_14_3m1730752227.js").
+SUITE_BUNDLE_RES = {
+    'dcc': re.compile(r'^(.*/dcc/)dash_core_components(\.[^/]*)?\.js$'),
+    'dash_table': re.compile(r'^(.*/dash_table/)bundle(\.[^/]*)?\.js$')
+}
+
+# The chunks which the Dash renderer loads the first time a component of each
+# type is rendered, as (suite, chunk name).  Graphs also load plotly.js, from
+# the plotly package rather than from a chunk (see PLOTLY_JS_PATH).
+ASYNC_CHUNKS = {
+    'Graph': [('dcc', 'async-graph')],
+    'Markdown': [('dcc', 'async-markdown')],
+    'Dropdown': [('dcc', 'async-dropdown')],
+    'Slider': [('dcc', 'async-slider')],
+    'RangeSlider': [('dcc', 'async-slider')],
+    'DatePickerSingle': [('dcc', 'async-datepicker')],
+    'DatePickerRange': [('dcc', 'async-datepicker')],
+    'Upload': [('dcc', 'async-upload')],
+    'DataTable': [('dash_table', 'async-table')]
+}
+PLOTLY_JS_PATH = '_dash-component-suites/plotly/package_data/plotly.min.js'
+
+logging.basicConfig(level=logging.INFO)
+
+
+class InProcessClient:
+    """Makes requests directly against the Flask app, using its test client.
+    Each thread gets its own test client."""
+
+    def __init__(self):
+        from dash_app import app
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method: str, path: str, json_data: Any = None) -> Tuple[int, bytes]:
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(path, method=method, json=json_data)
+        return response.status_code, response.get_data()
+
+
+class HTTPClient:
+    """Makes requests against a running server.  Each thread gets its own
+    session (and so its own connection pool)."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip('/')
+        self.local = threading.local()
+
+    def request(self, method: str, path: str, json_data: Any = None) -> Tuple[int, bytes]:
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        response = session.request(method, self.base_url + path, json=json_data)
+        return response.status_code, response.content
+
+
+def _iter_components(layout: Any) -> Iterator[Dict[str, Any]]:
+    """Walk a serialised Dash layout, yielding each component."""
+    if isinstance(layout, list):
+        for child in layout:
+            yield from _iter_components(child)
+    elif isinstance(layout, dict) and 'props' in layout:
+        yield layout
+        yield from _iter_components(layout['props'].get('children'))
+
+
+def _component_types(obj: Any) -> Iterator[str]:
+    """Yield the type of every component in a layout or callback response."""
+    if isinstance(obj, list):
+        for item in obj:
+            yield from _component_types(item)
+    elif isinstance(obj, dict):
+        if 'type' in obj and 'namespace' in obj and 'props' in obj:
+            yield obj['type']
+        for value in obj.values():
+            yield from _component_types(value)
+
+
+def _async_chunk_paths(html: str, component_types: Iterable[str], base_path: str = BASE_PATH) -> List[str]:
+    """Return the paths of the chunks which the Dash renderer loads to render
+    components of the given types."""
+    suite_dirs = {}
+    for path in ASSET_RE.findall(html):
+        for suite, bundle_re in SUITE_BUNDLE_RES.items():
+            match = bundle_re.match(path)
+            if match:
+                suite_dirs[suite] = (match.group(1), match.group(2) or '')
+    paths = []
+    for component_type in component_types:
+        for suite, chunk in ASYNC_CHUNKS.get(component_type, ()):
+            if suite in suite_dirs:
+                suite_dir, fingerprint = suite_dirs[suite]
+                paths.append(f'{suite_dir}{chunk}{fingerprint}.js')
+        if component_type == 'Graph':
+            paths.append(base_path + PLOTLY_JS_PATH)
+    return list(dict.fromkeys(paths))
+
+
+def _callback_payloads(layout: Any, dependencies: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Build the requests that the Dash renderer sends on page load, ie, one
+    for each server-side callback whose inputs are all present in the initial
+    layout."""
+    props = {c['props']['id']: c['props'] for c in _iter_components(layout) if 'id' in c['props']}
+    payloads = []
+    for dep in dependencies:
+        if dep.get('clientside_function') or not all(i['id'] in props for i in dep['inputs']):
+            continue
+        payload = {
+            'output': dep['output'],
+            'inputs': [{'id': i['id'], 'property': i['property'], 'value': props[i['id']].get(i['property'])}
+                       for i in dep['inputs']],
+            'state': [{'id': s['id'], 'property': s['property'], 'value': props.get(s['id'], {}).get(s['property'])}
+                      for s in dep.get('state', [])],
+            'changedPropIds': []
+        }
+        if not dep['output'].startswith('..'):
+            _id, prop = dep['output'].rsplit('.', 1)
+            payload['outputs'] = {'id': _id, 'property': prop}
+        payloads.append(payload)
+    return payloads
+
+
+class PageLoad:
+    """Record of the requests made for a single simulated page load."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.duration = None
+        self.bytes = 0
+        self.errors = 0
+        self.requests: List[Tuple[str, float, int]] = []
+
+    def fetch(self, client, kind: str, method: str, path: str, json_data: Any = None) -> bytes:
+        start = time.perf_counter()
+        status, body = client.request(method, path, json_data)
+        self.requests.append((kind, time.perf_counter() - start, len(body)))
+        self.bytes += len(body)
+        if status >= 400:
+            self.errors += 1
+        return body
+
+
+def load_page(client, base_path: str = BASE_PATH, assets: bool = True) -> PageLoad:
+    page = PageLoad()
+    html = page.fetch(client, 'page', 'GET', base_path).decode('utf-8', 'replace')
+    if assets:
+        for path in ASSET_RE.findall(html):
+            page.fetch(client, 'assets', 'GET', path)
+    layout = json.loads(page.fetch(client, 'layout', 'GET', base_path + '_dash-layout'))
+    dependencies = json.loads(page.fetch(client, 'dependencies', 'GET', base_path + '_dash-dependencies'))
+    component_types = set(_component_types(layout))
+    for payload in _callback_payloads(layout, dependencies):
+        response = page.fetch(client, 'callback', 'POST', base_path + '_dash-update-component', payload)
+        try:
+            component_types.update(_component_types(json.loads(response)))
+        except ValueError:
+            pass
+    if assets:
+        # Fetched once the components which need them have been rendered, as
+        # the browser does.
+        for path in _async_chunk_paths(html, sorted(component_types), base_path):
+            page.fetch(client, 'async_chunks', 'GET', path)
+    page.duration = time.perf_counter() - page.start
+    return page
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """Nearest-rank percentile of `values`."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(ceil(p / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def _summarise(durations: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        'count': len(durations),
+        'p50': percentile(durations, 50),
+        'p95': percentile(durations, 95),
+        'p99': percentile(durations, 99)
+    }
+
+
+def run(client, concurrency: int, loads: int, base_path: str = BASE_PATH, assets: bool = True) -> Dict[str, Any]:
+    """Perform `loads` page loads using `concurrency` threads, and return a
+    summary of the results."""
+
+    pages: List[PageLoad] = []
+    # Page loads which raised an exception (eg, a connection error, or a
+    # response which wasn't valid JSON), by the exception's description.
+    failures: Dict[str, int] = {}
+    lock = threading.Lock()
+    remaining = [loads]
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            try:
+                page = load_page(client, base_path, assets)
+            except Exception as e:
+                error = f'{type(e).__name__}: {e}'
+                with lock:
+                    if error not in failures:
+                        logging.warning(f'Page load failed: {error}')
+                    failures[error] = failures.get(error, 0) + 1
+                continue
+            with lock:
+                pages.append(page)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    by_kind = {}
+    for page in pages:
+        for kind, duration, _ in page.requests:
+            by_kind.setdefault(kind, []).append(duration)
+
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'concurrency': concurrency,
+        'page_loads': len(pages),
+        'failed_page_loads': sum(failures.values()),
+        'failures': failures,
+        'errors': sum(p.errors for p in pages),
+        'elapsed_seconds': elapsed,
+        'throughput_per_second': len(pages) / elapsed if elapsed else None,
+        'bytes_per_page_load': sum(p.bytes for p in pages) / len(pages) if pages else None,
+        'page_load_latency': _summarise([p.duration for p in pages]),
+        'request_latency': {k: _summarise(v) for k, v in sorted(by_kind.items())}
+    }
+
+
+def save_results(results: Dict[str, Any], label: str, to_dir: str = results_dir) -> str:
+    makedirs(to_dir, exist_ok=True)
+    fpath = join(to_dir, '{}-{}.json'.format(label, datetime.now().strftime('%Y%m%d%H%M%S')))
+    with open(fpath, 'w') as f:
+        json.dump(results, f, indent=2)
+    return fpath
+
+
+def print_results(results: Dict[str, Any], previous: Dict[str, Any] = None):
+
+    def line(name, key_path, unit=''):
+        value = results
+        prev = previous
+        for k in key_path:
+            value = value[k] if value is not None else None
+            prev = prev.get(k) if isinstance(prev, dict) else None
+        if value is None:
+            return
+        text = f'{name:<28}{value:>12.3f}{unit}'
+        if prev:
+            text += f'  ({(value - prev) / prev:+.1%} vs previous)'
+        print(text)
+
+    print(f"{results['page_loads']} page loads at concurrency {results['concurrency']}, "
+          f"{results.get('failed_page_loads', 0)} failed page loads, {results['errors']} failed requests")
+    line('Throughput', ['throughput_per_second'], ' loads/s')
+    line('Bytes per page load', ['bytes_per_page_load'], ' B')
+    for p in ('p50', 'p95', 'p99'):
+        line(f'Page load {p}', ['page_load_latency', p], ' s')
+    for kind in results['request_latency']:
+        for p in ('p50', 'p95', 'p99'):
+            line(f'{kind} {p}', ['request_latency', kind, p], ' s')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Load-test the STS dashboard.')
+    parser.add_argument('--url', help='Base URL of a running server (default: drive the app in-process).')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of concurrent simulated users.')
+    parser.add_argument('--loads', type=int, default=100, help='Total number of page loads to simulate.')
+    parser.add_argument('--base-path', default=BASE_PATH, help='Path at which the dashboard is served.')
+    parser.add_argument('--no-assets', action='store_true',
+                        help='Skip scripts and stylesheets, as for a browser with a warm cache.')
+    parser.add_argument('--label', default='run', help='Label for the saved results, eg, a release number.')
+    parser.add_argument('--compare', help='A previously saved results file to compare against.')
+    args = parser.parse_args()
+
+    client = HTTPClient(args.url) if args.url else InProcessClient()
+    # Warm up (and check that the page loads at all) before timing anything.
+    load_page(client, args.base_path, not args.no_assets)
+    results = run(client, args.concurrency, args.loads, args.base_path, not args.no_assets)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_results(results, previous)
+    logging.info('Saved results to {}.'.format(save_results(results, args.label)))
@@ -12,7 +12,7 @@ When a securitisation is notified to ESMA as being an STS securitisation, ESMA p
 
 Unless stated otherwise, the data visualised here ranges from the beginning of 2019 to the end of March 2020.
 
-You should also bear in mind that the charts on this page give a breakdown of STS securitisations by *number* of securitisations; ESMA does not publish information about the size of each securitisation, so the below charts do not say anything about the *value* of assets that have been securitised.
+You should also bear in mind that, unless stated otherwise, the charts on this page give a breakdown of STS securitisations by *number* of securitisations.  ESMA does not publish information about the size of each securitisation, but the "Value" section below gives an indication of value based on the nominal amount of the notes issued (see that section for details).
 
 """
 
@@ -69,6 +69,14 @@ Finally, we break down the public STS securitisations by the currency in which t
 
 oc_by_currency = """The below bar chart shows the relationship between the currencies that STS securitisations are denominated in and the countries in which the underlying originators are based.  As you might expect, most securitisations are denominated in the national currency of the underlying originator, though this is not always the case.  Note that just because an originator is located in a country, does not mean that the underlying assets being securitised are necessarily denominated in that country's currency (for example, a securitisation could involve GBP-denominated loans originated by an Irish originator).  Where there is a mis-match between the currency of the STS securitisation and the currency of the underlying assets, the currency risk arising from this mis-match must be appropriately mitigated, such as through foreign exchange hedging agreements, pursuant to Article 21(2) of the Securitisation Regulation."""
 
+value = """## Value of notes
+
+ESMA does not publish information about the size of each STS securitisation.  However, the reference data that ESMA publishes in FIRDS (see the "Issuers" section above) includes the total nominal amount of each issue of notes.  By adding up the nominal amounts of the notes associated with each public STS securitisation, we can get an indication of the value of the securitisations.  This is only an indication: not all notes associated with a securitisation are necessarily listed (and so reported to FIRDS), and the nominal amount of notes issued is not the same as the value of the assets securitised.
+
+Amounts in other currencies have been converted to EUR at the ECB's euro reference exchange rates as of {fx_date}.  Where a securitisation has originators in more than one country, its value has been split evenly between those countries."""
+
+country = """This page looks at the {count} public STS securitisations involving originators based in {country} ({share:.1%} of all public STS securitisations).  Securitisations with originators in more than one country are included in the figures for each of those countries.  See the [overview]({overview}) for the whole of the EU."""
+
 sources = """## Data sources
 
 Data on STS securitisations obtained from ESMA's webpage at https://www.esma.europa.eu/policy-activities/securitisation/simple-transparent-and-standardised-sts-securitisation.
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Collection of serving-side performance metrics, and exposition of those
+metrics in the Prometheus text format.
+
+Each uwsgi worker keeps its own set of metrics, so every sample carries a
+`worker` label and a scrape only reports on the worker that served it.  The
+exception is memory usage, which is read from /proc for every worker, so that
+a single scrape shows how much memory the workers share.
+"""
+
+import os
+import threading
+import time
+from bisect import bisect_left
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import flask
+
+# Histogram bucket upper bounds for request latency (seconds) and response
+# size (bytes).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1e3, 1e4, 5e4, 1e5, 5e5, 1e6, 5e6, 1e7)
+
+# Path fragments used to group requests into routes.  Anything not matched
+# here is reported as "other", so that arbitrary URLs can't blow up the number
+# of time series.
+ROUTES = (
+    ('/_dash-layout', '/_dash-layout'),
+    ('/_dash-dependencies', '/_dash-dependencies'),
+    ('/_dash-update-component', '/_dash-update-component'),
+    ('/_dash-component-suites/', 'assets'),
+    ('/assets/', 'assets'),
+    ('/_favicon.ico', 'assets'),
+)
+
+
+class Histogram:
+    """A cumulative histogram with fixed bucket boundaries."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> List[Tuple[str, float]]:
+        """Return (le, cumulative count) pairs, ending with "+Inf"."""
+        results = []
+        total = 0
+        for le, n in zip(self.buckets, self.counts):
+            total += n
+            results.append((_format_value(le), total))
+        results.append(('+Inf', self.count))
+        return results
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency: Dict[str, Histogram] = {}
+        self.size: Dict[str, Histogram] = {}
+        self.cache_hits: Dict[str, int] = {}
+        self.cache_misses: Dict[str, int] = {}
+        self.gauges: Dict[str, Tuple[str, float]] = {}
+        self.data_version: Optional[str] = None
+        self.data_timestamp: Optional[datetime] = None
+
+    def observe_request(self, route: str, duration: float, size: Optional[int]):
+        with self.lock:
+            if route not in self.latency:
+                self.latency[route] = Histogram(LATENCY_BUCKETS)
+                self.size[route] = Histogram(SIZE_BUCKETS)
+            self.latency[route].observe(duration)
+            if size is not None:
+                self.size[route].observe(size)
+
+    def record_cache(self, name: str, hit: bool):
+        with self.lock:
+            self.cache_hits.setdefault(name, 0)
+            self.cache_misses.setdefault(name, 0)
+            if hit:
+                self.cache_hits[name] += 1
+            else:
+                self.cache_misses[name] += 1
+
+    def set_gauge(self, name: str, help_text: str, value: float):
+        with self.lock:
+            self.gauges[name] = (help_text, value)
+
+    def set_data_version(self, version: str, timestamp: datetime):
+        with self.lock:
+            self.data_version = version
+            self.data_timestamp = timestamp
+
+    def render(self) -> str:
+        worker = _worker_label()
+        lines = []
+        with self.lock:
+            _histogram_lines(lines, 'stss_http_request_duration_seconds',
+                             'Time taken to serve a request, by route.', self.latency, worker)
+            _histogram_lines(lines, 'stss_http_response_size_bytes',
+                             'Size of response bodies, by route.', self.size, worker)
+
+            lines.append('# HELP stss_cache_hits_total Number of cache lookups that were hits.')
+            lines.append('# TYPE stss_cache_hits_total counter')
+            for name, n in sorted(self.cache_hits.items()):
+                lines.append(_sample('stss_cache_hits_total', n, cache=name, **worker))
+            lines.append('# HELP stss_cache_misses_total Number of cache lookups that were misses.')
+            lines.append('# TYPE stss_cache_misses_total counter')
+            for name, n in sorted(self.cache_misses.items()):
+                lines.append(_sample('stss_cache_misses_total', n, cache=name, **worker))
+            lines.append('# HELP stss_cache_hit_ratio Proportion of cache lookups that were hits.')
+            lines.append('# TYPE stss_cache_hit_ratio gauge')
+            for name in sorted(self.cache_hits):
+                total = self.cache_hits[name] + self.cache_misses[name]
+                lines.append(_sample('stss_cache_hit_ratio', self.cache_hits[name] / total, cache=name, **worker))
+
+            if self.data_version is not None:
+                lines.append('# HELP stss_data_info Version of the data currently loaded.')
+                lines.append('# TYPE stss_data_info gauge')
+                lines.append(_sample('stss_data_info', 1, version=self.data_version, **worker))
+                lines.append('# HELP stss_data_age_seconds Time since the loaded data was built.')
+                lines.append('# TYPE stss_data_age_seconds gauge')
+                age = (datetime.now() - self.data_timestamp).total_seconds()
+                lines.append(_sample('stss_data_age_seconds', age, **worker))
+
+            for name, (help_text, value) in sorted(self.gauges.items()):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} gauge')
+                lines.append(_sample(name, value, **worker))
+
+        rss = get_rss()
+        if rss is not None:
+            lines.append('# HELP process_resident_memory_bytes Resident set size of the worker process.')
+            lines.append('# TYPE process_resident_memory_bytes gauge')
+            lines.append(_sample('process_resident_memory_bytes', rss, **worker))
+
+        memory = {labels['pid']: (labels, get_memory(int(labels['pid']))) for labels in _all_worker_labels()}
+        for key, help_text in MEMORY_METRICS:
+            name = f'stss_worker_{key}_memory_bytes'
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for labels, values in memory.values():
+                if values is not None:
+                    lines.append(_sample(name, values[key], **labels))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_value(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample(name: str, value: float, **labels) -> str:
+    if labels:
+        label_str = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+        return f'{name}{{{label_str}}} {_format_value(value)}'
+    return f'{name} {_format_value(value)}'
+
+
+def _histogram_lines(lines: List[str], name: str, help_text: str, histograms: Dict[str, Histogram],
+                     worker: Dict[str, str]):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} histogram')
+    for route, hist in sorted(histograms.items()):
+        for le, n in hist.samples():
+            lines.append(_sample(name + '_bucket', n, route=route, le=le, **worker))
+        lines.append(_sample(name + '_sum', hist.sum, route=route, **worker))
+        lines.append(_sample(name + '_count', hist.count, route=route, **worker))
+
+
+def _worker_label() -> Dict[str, str]:
+    try:
+        import uwsgi
+        worker_id = str(uwsgi.worker_id())
+    except ImportError:
+        worker_id = '0'
+    return {'worker': worker_id, 'pid': str(os.getpid())}
+
+
+def _all_worker_labels() -> List[Dict[str, str]]:
+    try:
+        import uwsgi
+        return [{'worker': str(w['id']), 'pid': str(w['pid'])} for w in uwsgi.workers()]
+    except ImportError:
+        return [_worker_label()]
+
+
+# Memory figures reported for each worker (keys of the dict returned by
+# get_memory), with their descriptions.
+MEMORY_METRICS = (
+    ('shared', 'Resident memory of the worker that is shared with other processes (such as pages inherited '
+               'from the uwsgi master and not yet written to).'),
+    ('private', 'Resident memory of the worker that is used by it alone.'),
+    ('proportional', 'Proportional set size of the worker (private memory plus its share of shared memory).')
+)
+
+
+def get_memory(pid: int = None) -> Optional[Dict[str, int]]:
+    """Return the shared, private and proportional (PSS) resident memory
+    (in bytes) of the given process (or the current process, if `pid` is
+    None), or None if it can't be determined (eg, if /proc is unavailable)."""
+    proc = '/proc/self' if pid is None else f'/proc/{pid}'
+    fields = {}
+    # smaps_rollup (Linux 4.14+) gives the totals directly; otherwise sum
+    # the per-mapping figures in smaps.
+    for fname in ('smaps_rollup', 'smaps'):
+        try:
+            with open(f'{proc}/{fname}') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 3 and parts[2] == 'kB':
+                        fields[parts[0]] = fields.get(parts[0], 0) + int(parts[1]) * 1024
+            break
+        except (OSError, ValueError):
+            fields = {}
+    if not fields:
+        return None
+    return {
+        'shared': fields.get('Shared_Clean:', 0) + fields.get('Shared_Dirty:', 0),
+        'private': fields.get('Private_Clean:', 0) + fields.get('Private_Dirty:', 0),
+        'proportional': fields.get('Pss:', 0)
+    }
+
+
+def get_rss(pid: int = None) -> Optional[int]:
+    """Return the resident set size (in bytes) of the given process (or the
+    current process, if `pid` is None), or None if it can't be determined."""
+    path = '/proc/self/statm' if pid is None else f'/proc/{pid}/statm'
+    try:
+        with open(path) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    if pid is None:
+        try:
+            import resource
+        except ImportError:
+            return None
+        # ru_maxrss is the peak, not the current, RSS, and is in kilobytes on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return None
+
+
+def route_label(path: str, base_path: str = '/') -> str:
+    for fragment, label in ROUTES:
+        if fragment in path:
+            return label
+    if path.rstrip('/') == base_path.rstrip('/'):
+        return '/'
+    return 'other'
+
+
+registry = Registry()
+observe_request = registry.observe_request
+record_cache = registry.record_cache
+set_gauge = registry.set_gauge
+set_data_version = registry.set_data_version
+
+
+def _count_bytes(body: Iterable, sent: List[int]) -> Iterator[bytes]:
+    """Yield the chunks of a response body (encoded as Werkzeug would),
+    adding the length of each to sent[0] as it is yielded."""
+    try:
+        for chunk in body:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            sent[0] += len(chunk)
+            yield chunk
+    finally:
+        # Eg, so that a generator wrapped in flask.stream_with_context
+        # releases its request context.
+        if hasattr(body, 'close'):
+            body.close()
+
+
+def init_app(server: flask.Flask, base_path: str = '/', path: str = '/metrics'):
+    """Instrument a Flask app so that the latency and response size of each
+    request is recorded, and serve the collected metrics at `path`."""
+
+    @server.before_request
+    def _start_timer():
+        flask.g.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def _record_request(response):
+        start = getattr(flask.g, 'metrics_start', None)
+        if start is None or flask.request.path == path:
+            return response
+        route = route_label(flask.request.path, base_path)
+        if response.is_streamed and not response.direct_passthrough:
+            # The body is generated as it is sent, so the request is recorded
+            # once the response is closed, with the bytes actually sent (fewer
+            # than the whole body if the client went away).
+            sent = [0]
+            response.response = _count_bytes(response.response, sent)
+            response.call_on_close(lambda: observe_request(route, time.perf_counter() - start, sent[0]))
+        else:
+            size = response.content_length
+            if size is None and not response.direct_passthrough:
+                size = len(response.get_data())
+            observe_request(route, time.perf_counter() - start, size)
+        return response
+
+    @server.route(path)
+    def _metrics():
+        return flask.Response(registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
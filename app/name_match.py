@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Fuzzy matching of names (such as securitisation names against issuer
+legal names) using an inverted index of character trigrams.
+
+Candidates for a query are found by looking up the query's trigrams in the
+index, so only names sharing trigrams with the query are ever scored, rather
+than every name in the index.  Very common trigrams are ignored when finding
+candidates (but not when scoring them), which keeps the number of candidates
+small.
+"""
+
+import re
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+# Words which say something about the legal form of an entity rather than
+# identifying it.  These are removed before names are compared, so that (eg)
+# "Bumper DE S.A." and "Bumper DE UG" are considered identical.
+LEGAL_FORM_WORDS = {
+    'plc', 'ltd', 'limited', 'llc', 'inc', 'sa', 'sarl', 'sas', 'spa', 'srl', 'sl', 'bv', 'nv', 'ag', 'gmbh',
+    'ug', 'kg', 'dac', 'designated', 'activity', 'company', 'fct', 'ft', 'compartment'
+}
+
+NON_ALNUM_RE = re.compile(r'[^a-z0-9 ]+')
+
+# Words which distinguish between vehicles of the same programme, such as the
+# year, series number or series letter in "SC Germany Consumer 2019-1" or
+# "Globaldrive Auto Receivables UK 2019-B": any word containing a digit, single
+# letters and roman numerals.
+IDENTIFIER_RE = re.compile(r'^(?:.*[0-9].*|[a-z]|[ivx]+)$')
+
+
+def normalise_name(name: str) -> str:
+    """Lower-case a name, strip punctuation and remove words describing the
+    entity's legal form."""
+    name = name.lower().replace('&', ' and ')
+    # Remove dots entirely (so "S.A." becomes "sa") and replace other
+    # punctuation with spaces.
+    name = NON_ALNUM_RE.sub(' ', name.replace('.', ''))
+    return ' '.join(w for w in name.split() if w not in LEGAL_FORM_WORDS)
+
+
+def identifiers(name: str) -> Set[str]:
+    """Return the words in a (normalised) name which identify a particular
+    vehicle of a programme (see IDENTIFIER_RE)."""
+    return {w for w in name.split() if IDENTIFIER_RE.match(w)}
+
+
+def identifiers_conflict(a: str, b: str) -> bool:
+    """Return whether two names have different identifiers, meaning that (if
+    they are otherwise similar) they name different vehicles of the same
+    programme, such as "Red & Black Auto Germany 6" and "Red & Black Auto
+    Germany 7 UG".  Names where only one has identifiers don't conflict, so
+    that (eg) "Bumper DE 2019-1" can match the issuer "Bumper DE S.A."."""
+    ids_a = identifiers(normalise_name(a))
+    ids_b = identifiers(normalise_name(b))
+    return bool(ids_a and ids_b) and (ids_a != ids_b)
+
+
+def trigrams(name: str) -> Set[str]:
+    padded = f'  {name} '
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+
+def dice(a: Set[str], b: Set[str]) -> float:
+    if not (a or b):
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+class NameIndex:
+    """An index of names, each associated with a payload (such as a dict of
+    data about the named entity)."""
+
+    def __init__(self, max_posting_share: float = 0.2, max_candidates: int = 50):
+        # Trigrams appearing in more than `max_posting_share` of names are
+        # not used to find candidates.  At most `max_candidates` candidates
+        # (those sharing the most trigrams with the query) are scored.
+        self.max_posting_share = max_posting_share
+        self.max_candidates = max_candidates
+        self.names: List[str] = []
+        self.payloads: List[Any] = []
+        self.grams: List[Set[str]] = []
+        self.postings: Dict[str, List[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, name: str, payload: Any = None):
+        i = len(self.names)
+        grams = trigrams(normalise_name(name))
+        self.names.append(name)
+        self.payloads.append(payload)
+        self.grams.append(grams)
+        for g in grams:
+            self.postings.setdefault(g, []).append(i)
+
+    def update(self, items: Iterable[Tuple[str, Any]]):
+        for name, payload in items:
+            self.add(name, payload)
+
+    def match(self, name: str, limit: int = 1) -> List[Tuple[str, Any, float]]:
+        """Return up to `limit` (name, payload, score) tuples for the indexed
+        names most similar to `name`, best first.  Scores are Dice
+        coefficients of the names' trigrams, from 0 to 1."""
+        query = trigrams(normalise_name(name))
+        max_postings = max(1, int(self.max_posting_share * len(self.names)))
+        counts = Counter()
+        for g in query:
+            postings = self.postings.get(g, ())
+            if len(postings) <= max_postings:
+                counts.update(postings)
+        if not counts:
+            # Only common trigrams in the query; fall back to using them.
+            for g in query:
+                counts.update(self.postings.get(g, ()))
+        scored = [(self.names[i], self.payloads[i], dice(query, self.grams[i]))
+                  for i, _ in counts.most_common(self.max_candidates)]
+        scored.sort(key=lambda t: t[2], reverse=True)
+        return scored[:limit]
@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""An incremental build of the data, modelled as a graph of stages.
+
+Each stage is a function of the outputs of the stages it depends on (and,
+optionally, of some input files).  A stage's output is cached on disk under a
+key derived from:
+
+- the source code of the stage's function and its version number, and the
+  source code of the app's functions and classes which that function refers
+  to (see Stage.code_hash);
+- hashes of the outputs of the stages it depends on; and
+- hashes of the contents of its input files.
+
+So a stage is only re-run when its code or one of its inputs has actually
+changed.  Because keys are derived from the hashes of dependencies' outputs,
+rather than from their keys, a stage whose output is unchanged after being
+re-run (eg, because a change was purely cosmetic) doesn't cause the stages
+downstream of it to be re-run.  Each stage's output is saved as soon as it
+has been computed, so a build that is interrupted resumes from the last
+completed stage when it is next run.
+
+Stages whose dependencies are all available can be run concurrently, in a
+pool of worker processes (see Pipeline.build).
+
+This module defines the stages which fetch and enrich the raw data;
+curated_data adds a stage for each of the aggregates it builds from that
+data.
+"""
+
+import inspect
+import json
+import logging
+import multiprocessing
+import pickle
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from glob import glob
+from hashlib import sha256
+from os import makedirs, remove, replace
+from functools import lru_cache
+from os.path import basename, dirname, exists, getmtime, getsize, join, realpath, sep
+from types import CodeType, ModuleType
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import fetch_data as fd
+from crosstab import encode_amounts
+
+cache_dir = join(fd.data_dir, 'build_cache')
+
+# Bump this if the way outputs are cached changes, so that stale cache
+# entries are ignored.
+CACHE_VERSION = 2
+
+app_dir = dirname(realpath(__file__))
+
+
+def _app_module(obj: Any) -> Optional[ModuleType]:
+    """Return the module defining `obj` (or `obj` itself, if it is a module)
+    if that is one of the app's modules, otherwise None."""
+    module = obj if inspect.ismodule(obj) else inspect.getmodule(obj)
+    path = getattr(module, '__file__', None)
+    if path and realpath(path).startswith(app_dir + sep):
+        return module
+    return None
+
+
+def _code_names(code: CodeType) -> Set[str]:
+    """The global (and attribute) names referred to by some code, including
+    by any functions, lambdas and comprehensions nested in it."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names.update(_code_names(const))
+    return names
+
+
+def _value_repr(value: Any) -> Optional[str]:
+    """A representation of a value built from literals (and containers of
+    them), which is the same in every process, or None for other values
+    (which are left out of code hashes)."""
+    if (value is None) or isinstance(value, (bool, int, float, str, bytes, datetime)):
+        return repr(value)
+    if isinstance(value, (tuple, list)):
+        items = [_value_repr(v) for v in value]
+        return None if None in items else type(value).__name__ + '(' + ', '.join(items) + ')'
+    if isinstance(value, (set, frozenset)):
+        # Sorted, as the iteration order of sets of strings varies between processes.
+        items = [_value_repr(v) for v in value]
+        return None if None in items else 'set(' + ', '.join(sorted(items)) + ')'
+    if isinstance(value, dict):
+        items = [(_value_repr(k), _value_repr(v)) for k, v in value.items()]
+        if any((k is None) or (v is None) for k, v in items):
+            return None
+        return 'dict(' + ', '.join(f'{k}: {v}' for k, v in items) + ')'
+    return None
+
+
+@lru_cache(maxsize=None)
+def module_hash(module: ModuleType) -> str:
+    """A hash of the source of one of the app's modules and of the app's
+    modules it imports from."""
+    modules = set()
+    stack = [module]
+    while stack:
+        m = stack.pop()
+        if m in modules:
+            continue
+        modules.add(m)
+        for obj in vars(m).values():
+            if inspect.ismodule(obj) or inspect.isfunction(obj) or inspect.isclass(obj):
+                imported = _app_module(obj)
+                if imported is not None:
+                    stack.append(imported)
+    h = sha256()
+    for m in sorted(modules, key=lambda m: m.__name__):
+        h.update(m.__name__.encode())
+        h.update(fd.file_hash(m.__file__).encode())
+    return h.hexdigest()
+
+
+class Stage:
+
+    def __init__(self, name: str, func: Callable, deps: Sequence[str] = (),
+                 files: Callable[..., Iterable[str]] = None, uses: Sequence[Callable] = (), version: int = 1):
+        # `func` is called with the outputs of `deps`, in order.  `files`, if
+        # given, is called with the same arguments and returns the paths of
+        # the stage's input files (and may fetch them if they don't exist).
+        # `uses` lists helper functions whose code should be considered part of
+        # the stage's code, if code_hash can't find them (eg, because they are
+        # only called via a dict).
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.files = files
+        self.uses = tuple(uses)
+        self.version = version
+
+    def code_hash(self) -> str:
+        """A hash of the stage's code: the source of its function (and of
+        `uses`); of the functions and classes they refer to which are defined
+        in the same module or in the app's other modules (whether by name or
+        as attributes of those modules, eg `fd.Combo`), and so on
+        recursively; and of the values of constants they refer to and of
+        their arguments' defaults.  So a change to any helper in the app
+        which the stage might call changes the hash, even if the helper is in
+        another module, but a change elsewhere in that module doesn't."""
+        h = sha256()
+        seen = []
+        stack = list(reversed((self.func,) + self.uses))
+        while stack:
+            obj = stack.pop()
+            if inspect.isfunction(obj):
+                obj = inspect.unwrap(obj)
+            if obj in seen:
+                continue
+            seen.append(obj)
+            try:
+                h.update(inspect.getsource(obj).encode())
+            except (OSError, TypeError):
+                # Source isn't available (eg, a builtin), so fall back to its name.
+                h.update(getattr(obj, '__qualname__', repr(obj)).encode())
+            if inspect.isclass(obj):
+                # The methods' source is part of the class's, but what they refer to isn't.
+                stack.extend(base for base in obj.__bases__ if _app_module(base) is not None)
+                for attr in vars(obj).values():
+                    func = attr.fget if isinstance(attr, property) else getattr(attr, '__func__', attr)
+                    if inspect.isfunction(func):
+                        stack.append(func)
+                continue
+            code = getattr(obj, '__code__', None)
+            if code is None:
+                continue
+            # Default values of arguments are often module-level constants.
+            h.update(repr((obj.__defaults__, obj.__kwdefaults__)).encode())
+            names = _code_names(code)
+            f_globals = getattr(obj, '__globals__', {})
+            for name in sorted(names.intersection(f_globals)):
+                value = f_globals[name]
+                if inspect.ismodule(value):
+                    if _app_module(value) is None:
+                        continue
+                    # Only the module's attributes which the code refers to
+                    # (as for `fd.Combo`, whose name is among the code's names).
+                    for attr in sorted(names):
+                        if attr in vars(value):
+                            self._hash_ref(h, stack, f'{name}.{attr}', vars(value)[attr])
+                else:
+                    self._hash_ref(h, stack, name, value)
+        h.update(str(self.version).encode())
+        return h.hexdigest()
+
+    def _hash_ref(self, h, stack: List[Any], name: str, value: Any):
+        """Hash a constant which code refers to by value, or add a function
+        or class it refers to to `stack`, if it is defined in the app."""
+        if inspect.isfunction(value) or inspect.isclass(value):
+            if (getattr(value, '__module__', None) == self.func.__module__) or _app_module(value):
+                stack.append(value)
+        elif not (callable(value) or inspect.ismodule(value)):
+            r = _value_repr(value)
+            if r is not None:
+                h.update(f'{name}={r}'.encode())
+
+
+# The functions of the stages being built, by name.  Worker processes
+# inherit this when they are forked, so that only the name of a stage need be
+# sent to them.  (Sending the function itself would mean the worker importing
+# the module which defines it, and if the build was started while that module
+# was being imported, as curated_data does, the worker would wait forever on
+# the import lock held by the parent.)
+_stage_funcs: Dict[str, Callable] = {}
+
+
+def _run_stage(name: str, args: List[Any]) -> Tuple[bytes, float]:
+    """Run a stage's function, returning its pickled output (which the
+    parent process needs anyway, to hash and cache it) and how long it
+    took."""
+    start = time.perf_counter()
+    output = _stage_funcs[name](*args)
+    seconds = time.perf_counter() - start
+    return pickle.dumps(output, protocol=pickle.HIGHEST_PROTOCOL), seconds
+
+
+class Pipeline:
+
+    def __init__(self, _cache_dir: str = cache_dir):
+        self.cache_dir = _cache_dir
+        self.stages: Dict[str, Stage] = {}
+        # How each stage was obtained in the last build ("cached" or
+        # "built"), and how long that took, in seconds.
+        self.report: Dict[str, Dict[str, Any]] = {}
+        # The cache key and the hash of the output of each stage in the last
+        # build.
+        self.keys: Dict[str, str] = {}
+        self.hashes: Dict[str, str] = {}
+        self._file_hashes: Optional[Dict[str, Any]] = None
+
+    def add(self, stage: Stage):
+        if stage.name in self.stages:
+            raise ValueError(f'Duplicate stage name: {stage.name}')
+        self.stages[stage.name] = stage
+
+    def stage(self, name: str = None, deps: Sequence[str] = (), files: Callable[..., Iterable[str]] = None,
+              uses: Sequence[Callable] = (), version: int = 1) -> Callable:
+        """Decorator which adds a function to the pipeline as a stage, named
+        after the function unless `name` is given.  The function itself is
+        returned unchanged."""
+        def decorator(func: Callable) -> Callable:
+            self.add(Stage(name or func.__name__, func, deps, files, uses, version))
+            return func
+        return decorator
+
+    def order(self, targets: Iterable[str] = None) -> List[str]:
+        """Return the names of the given stages (or all stages) and
+        everything they depend on, in an order in which they can be built."""
+        ordered = []
+        visiting = set()
+
+        def visit(name: str):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise ValueError(f'Dependency cycle involving stage {name}')
+            if name not in self.stages:
+                raise KeyError(f'Unknown stage: {name}')
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                visit(dep)
+            visiting.remove(name)
+            ordered.append(name)
+
+        for name in (self.stages if targets is None else targets):
+            visit(name)
+        return ordered
+
+    def _file_hash(self, path: str) -> str:
+        # Hashing large input files (such as FIRDS files) takes a while, so
+        # remember their hashes for as long as their size and mtime are
+        # unchanged.
+        if self._file_hashes is None:
+            try:
+                with open(join(self.cache_dir, 'file_hashes.json')) as f:
+                    self._file_hashes = json.load(f)
+            except (OSError, ValueError):
+                self._file_hashes = {}
+        stat = [getsize(path), getmtime(path)]
+        cached = self._file_hashes.get(path)
+        if cached is None or cached['stat'] != stat:
+            cached = {'stat': stat, 'hash': fd.file_hash(path)}
+            self._file_hashes[path] = cached
+        return cached['hash']
+
+    def _save_file_hashes(self):
+        if self._file_hashes is not None:
+            makedirs(self.cache_dir, exist_ok=True)
+            tmp_file = join(self.cache_dir, 'file_hashes.json.tmp')
+            with open(tmp_file, 'w') as f:
+                json.dump(self._file_hashes, f)
+            replace(tmp_file, join(self.cache_dir, 'file_hashes.json'))
+
+    def key(self, stage: Stage, dep_hashes: List[str], files: Iterable[str]) -> str:
+        return sha256(json.dumps({
+            'cache_version': CACHE_VERSION,
+            'name': stage.name,
+            'code': stage.code_hash(),
+            'deps': dep_hashes,
+            'files': sorted((basename(p), self._file_hash(p)) for p in files)
+        }).encode()).hexdigest()
+
+    def _paths(self, name: str, key: str):
+        stage_dir = join(self.cache_dir, name)
+        return join(stage_dir, key + '.pkl'), join(stage_dir, key + '.sha256')
+
+    def _save(self, name: str, key: str, data: bytes) -> str:
+        """Save a stage's pickled output and return its hash."""
+        output_hash = sha256(data).hexdigest()
+        out_file, hash_file = self._paths(name, key)
+        makedirs(join(self.cache_dir, name), exist_ok=True)
+        # Write to temporary files first so that an interrupted write can
+        # never leave a corrupt cache entry behind.  The hash is written
+        # last, as its presence marks the entry as complete.
+        for path, content in ((out_file, data), (hash_file, output_hash.encode())):
+            with open(path + '.tmp', 'wb') as f:
+                f.write(content)
+            replace(path + '.tmp', path)
+        # Only the latest output of each stage is kept.
+        for old_file in glob(join(self.cache_dir, name, '*')):
+            if not old_file.startswith(join(self.cache_dir, name, key)):
+                remove(old_file)
+        return output_hash
+
+    def _cached_hash(self, name: str, key: str) -> Optional[str]:
+        out_file, hash_file = self._paths(name, key)
+        if exists(hash_file) and exists(out_file):
+            with open(hash_file) as f:
+                return f.read().strip()
+        return None
+
+    def _load(self, name: str, key: str) -> Any:
+        with open(self._paths(name, key)[0], 'rb') as f:
+            return pickle.load(f)
+
+    def output_file(self, name: str) -> str:
+        """The file in which the output of a stage built (or found in the
+        cache) by the last build is cached, as the pickle which its hash is
+        the hash of."""
+        return self._paths(name, self.keys[name])[0]
+
+    def build(self, targets: Iterable[str] = None, provided: Dict[str, Any] = None,
+              processes: int = None, provided_hashes: Dict[str, str] = None) -> Dict[str, Any]:
+        """Build the given stages (or all stages), re-running only those
+        whose inputs or code have changed, and return their outputs.
+
+        `provided` maps stage names to outputs to use in place of running
+        those stages (eg, data loaded from elsewhere); stages which only they
+        depend on are then not run at all.  Provided outputs are hashed by
+        pickling them, unless their hashes are given in `provided_hashes`.
+        The hash of a pickled output isn't necessarily the same after it has
+        been unpickled and pickled again, so (to avoid re-running the stages
+        which depend on it) where an output is loaded from a copy of a file
+        written by output_file, the hash of that file should be given.
+
+        If `processes` is more than 1, stages which need to be re-run are run
+        in a pool of that many worker processes, each as soon as the stages
+        it depends on are available.  The workers are forked, so that they
+        inherit the stage functions (see _stage_funcs); where forking isn't
+        available, stages are run one at a time in this process.  The input
+        files of stages are still listed (and fetched) in this process.  The
+        outputs of a stage's dependencies are pickled to send to the worker,
+        so this only pays off for stages which take much longer to run than
+        their inputs take to pickle.
+        """
+        provided = provided or {}
+        provided_hashes = provided_hashes or {}
+        targets = list(self.stages if targets is None else targets)
+        self.report = {}
+        hashes = self.hashes = {}
+        keys = self.keys = {}
+        outputs: Dict[str, Any] = {}
+
+        def output(name: str) -> Any:
+            if name not in outputs:
+                outputs[name] = self._load(name, keys[name])
+            return outputs[name]
+
+        for name, value in provided.items():
+            outputs[name] = value
+            hashes[name] = provided_hashes.get(name) or sha256(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+        # Stages that a provided stage depends on are only needed if something
+        # else depends on them too.
+        needed = set()
+        for name in reversed(self.order(targets)):
+            if name in provided:
+                continue
+            if name in targets or any(name in self.stages[n].deps for n in needed):
+                needed.add(name)
+
+        _stage_funcs.clear()
+        _stage_funcs.update({name: self.stages[name].func for name in needed})
+        executor = None
+        if (processes or 1) > 1:
+            if 'fork' in multiprocessing.get_all_start_methods():
+                executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork'))
+            else:
+                logging.warning('Can\'t fork worker processes, so building stages one at a time.')
+        running: Dict[Future, str] = {}
+        build_start = time.perf_counter()
+
+        def finish(name: str, data: bytes, seconds: float):
+            hashes[name] = self._save(name, keys[name], data)
+            outputs[name] = pickle.loads(data)
+            self.report[name] = {'status': 'built', 'seconds': seconds}
+
+        pending = [n for n in self.order(targets) if n in needed]
+        try:
+            while pending or running:
+                # Start (or find in the cache) every stage whose dependencies
+                # are available, until there are no more.
+                ready = [n for n in pending if all(d in hashes for d in self.stages[n].deps)]
+                for name in ready:
+                    pending.remove(name)
+                    stage = self.stages[name]
+                    start = time.perf_counter()
+                    args = None
+                    files = []
+                    if stage.files is not None:
+                        args = [output(d) for d in stage.deps]
+                        files = list(stage.files(*args))
+                    keys[name] = self.key(stage, [hashes[d] for d in stage.deps], files)
+                    cached_hash = self._cached_hash(name, keys[name])
+                    if cached_hash is not None:
+                        hashes[name] = cached_hash
+                        self.report[name] = {'status': 'cached', 'seconds': time.perf_counter() - start}
+                        continue
+                    logging.info(f'Building stage {name}.')
+                    if args is None:
+                        args = [output(d) for d in stage.deps]
+                    if executor is not None:
+                        running[executor.submit(_run_stage, name, args)] = name
+                    else:
+                        finish(name, *_run_stage(name, args))
+                if ready:
+                    continue
+                if not running:
+                    # Can't happen, as self.order has checked the dependencies.
+                    raise RuntimeError(f'Stages can\'t be built: {", ".join(pending)}')
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(running.pop(future), *future.result())
+        finally:
+            if executor is not None:
+                # If a stage failed, don't start any more.
+                for future in running:
+                    future.cancel()
+                executor.shutdown()
+
+        self._save_file_hashes()
+        built = [n for n, r in self.report.items() if r['status'] == 'built']
+        logging.info(f'Built {len(built)} of {len(self.report)} stages in {time.perf_counter() - build_start:.2f}s: '
+                     f'{", ".join(built) or "none"}.')
+        return {name: output(name) for name in targets}
+
+    def timings(self) -> List[Tuple[str, str, float]]:
+        """The status of each stage in the last build and how long it took
+        (for built stages, how long their function ran for), slowest first."""
+        return sorted(((n, r['status'], r['seconds']) for n, r in self.report.items()), key=lambda t: -t[2])
+
+data_pipeline = Pipeline()
+
+# Only securitisations notified up to this date are included.
+REGISTER_TO_DATE = datetime(2020, 3, 31)
+
+
+@data_pipeline.stage(files=lambda: [fd.fetch_data(fd.register_file, fd.RegisterParser.URL, binary_data=True)])
+def register():
+    return fd.RegisterParser(fd.register_file).get_between(to_date=REGISTER_TO_DATE)
+
+
+@data_pipeline.stage(deps=('register',), files=lambda register: fd.FIRDSParser(fd.firds_data_dir).get_xml_files())
+def isin_data(register):
+    fp = fd.FIRDSParser(fd.firds_data_dir)
+    results, missing = fp.search_all_files(fd.get_isins(register), fp.get_xml_files())
+    if missing:
+        logging.warning('The following ISINs are missing the FIRDS data: {}.'.format(missing))
+    results.update(fd.manual_isin_data)
+    # Sorted so that the output (and so its hash) doesn't depend on the order the ISINs were found in.
+    return dict(sorted(results.items()))
+
+
+@data_pipeline.stage(deps=('isin_data',))
+def issuer_data(isin_data):
+    fp = fd.FIRDSParser(fd.firds_data_dir)
+    return fp.get_issuers(sorted({d['Issuer LEI'] for d in isin_data.values()}))
+
+
+@data_pipeline.stage(deps=('register', 'isin_data', 'issuer_data'))
+def enriched(register, isin_data, issuer_data):
+    df, report = fd.merge_issuer_data(register, isin_data, issuer_data)
+    fd.save_name_match_report(report)
+    return df
+
+
+def _fx_currencies(enriched) -> List[str]:
+    return sorted(set(encode_amounts(enriched['Nominal Amount']).currencies) - {'EUR'})
+
+
+def _fx_files(enriched) -> List[str]:
+    return [fd.fetch_data(fd.fx_fpath_template.format(currency=c.lower()), fd.fx_url_template.format(currency=c.lower()))
+            for c in _fx_currencies(enriched)]
+
+
+@data_pipeline.stage(deps=('enriched',), files=_fx_files, uses=(_fx_currencies,))
+def fx(enriched):
+    return fd.get_fx(_fx_currencies(enriched))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Preloading of the app in the uwsgi master process, so that pre-forked
+workers share the data copy-on-write rather than each building their own
+copy.
+
+uwsgi (without `lazy-apps`) imports the app once in the master and then forks
+the workers, so everything built at import time is initially shared.  Pages
+only stay shared as long as nothing writes to them, however, and in CPython
+even reading an object writes to it (to update its reference count), as does
+the garbage collector when it traverses it.  So before the workers are forked
+we:
+
+- convert every object column of the DataFrames to a categorical, so that
+  each column is an integer array of codes (which is never written to)
+  plus a lookup array of its distinct values, rather than a Python object
+  per cell.  Filtering, sorting or copying a frame then only copies codes,
+  rather than incrementing the reference count of every value in it (the
+  categories are in the same order as the colormaps built by
+  curated_data.get_colormap);
+- build every section of the page up front, rather than in each worker on
+  first request; and
+- move all objects that exist at that point into the garbage collector's
+  permanent generation (gc.freeze), so that collections in the workers don't
+  touch them.
+
+Sharing is only partial, however.  The values of the columns are still
+Python objects (held once each, in the lookup arrays), and the pages holding
+any that a worker reads (eg, when exporting or looking up rows) become
+private to it.  Likewise the aggregates and the figures built from them are
+ordinary pandas and Python objects, which are read (and so written to) every
+time a page is served.  On a copy of the register scaled up to about 10,000
+rows, converting the high-cardinality columns (the USI, securitisation name
+and ISINs) as well as the others reduced the private memory of each of four
+workers, as reported by memory_report after serving the page and a CSV and
+JSON export, from 36.1 MiB to 33.1 MiB (of about 150 MiB resident).  On a
+snapshot of the same size, freeing the uncompacted DataFrames (which the
+build's outputs had kept alive) cut the resident memory of each process by
+about 7 MiB, and the private memory of each worker from 26.4 MiB to 25.8 MiB.
+
+Point uwsgi at this module (rather than dash_app) to use it; see
+stss_dataviz.ini.
+
+Run this module as a script, with the PIDs of some processes (eg, the uwsgi
+workers) as arguments, to print a report of their shared and private memory.
+Run it with no arguments to print a report of the memory used by each column
+of the DataFrames before and after compaction.
+"""
+
+from os.path import dirname, realpath
+import sys
+sys.path.append(dirname(realpath(__file__)))
+
+import gc
+import logging
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+import fetch_data as fd
+import curated_data as cd
+import dash_app
+import metrics
+
+def compact_frame(df: DataFrame) -> DataFrame:
+    """Return a copy of `df` with its object columns converted to
+    categoricals.  Combos and nominal amount tuples are hashable, so columns
+    containing them can be converted too.  Columns with a distinct value for
+    nearly every row (like the USI) take slightly more memory once converted,
+    but their values are then only touched when they are read."""
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype != object:
+            continue
+        # factorize rather than pd.Categorical, as the categories may be a
+        # mix of strings and Combos, which pd.Categorical can't sort.
+        codes, uniques = pd.factorize(df[col])
+        categories = cd.category_order(uniques)
+        position = {c: i for i, c in enumerate(categories)}
+        remap = np.array([position[c] for c in uniques] + [-1])
+        # Missing values have a code of -1, which indexes the -1 at the end of remap.
+        df[col] = pd.Categorical.from_codes(remap[codes], categories=categories)
+    return df
+
+
+def frame_memory(df: DataFrame) -> pd.Series:
+    """The memory used by each column (and the index) of `df`, in bytes,
+    counting the Python objects in object columns."""
+    return df.memory_usage(index=True, deep=True)
+
+
+def compaction_report(before: Dict[str, DataFrame], after: Dict[str, DataFrame]) -> DataFrame:
+    """Compare the memory used (in KiB) by each column of each of the
+    given DataFrames before and after compaction."""
+    rows = []
+    for name, df in before.items():
+        mem_before = frame_memory(df)
+        mem_after = frame_memory(after[name])
+        for col in mem_before.index:
+            dtype = after[name].index.dtype if col == 'Index' else after[name][col].dtype
+            rows.append((name, col, str(dtype), mem_before[col] / 2**10, mem_after[col] / 2**10))
+    report = DataFrame(rows, columns=['frame', 'column', 'dtype', 'before', 'after'])
+    report['saved'] = report['before'] - report['after']
+    return report
+
+
+def frame_totals(report: DataFrame) -> DataFrame:
+    """Sum a compaction report by frame."""
+    totals = report.groupby('frame', sort=False)[['before', 'after', 'saved']].sum()
+    return pd.concat([totals, totals.sum().rename('total').to_frame().T])
+
+
+# The compaction report from the last call to preload.
+report: Optional[DataFrame] = None
+
+
+def preload():
+    global report
+    before = {'df': cd.df, 'df_pub': cd.df_pub}
+    cd.df = compact_frame(cd.df)
+    cd.df_pub = cd.df.loc[cd.df['Private or Public'] == 'Public']
+    report = compaction_report(before, {'df': cd.df, 'df_pub': cd.df_pub})
+    del before
+    totals = frame_totals(report)
+    logging.info(f'Compacted DataFrames from {totals.loc["total", "before"]:.0f} KiB to '
+                 f'{totals.loc["total", "after"]:.0f} KiB.')
+    cd.register_index = fd.RegisterIndex(cd.df)
+    for value, builder in dash_app._section_builders.items():
+        if value not in dash_app._section_cache:
+            dash_app._section_cache[value] = builder()
+    gc.collect()
+    gc.freeze()
+    logging.info(f'Preloaded app; froze {gc.get_freeze_count()} objects.')
+
+
+preload()
+app = dash_app.app
+
+
+def memory_report(pids) -> DataFrame:
+    """Return the shared, private and proportional memory (in MiB) of each
+    of the given processes."""
+    report = {}
+    for pid in pids:
+        memory = metrics.get_memory(pid)
+        if memory is not None:
+            report[pid] = {k: v / 2**20 for k, v in memory.items()}
+    return DataFrame.from_dict(report, orient='index', columns=[k for k, _ in metrics.MEMORY_METRICS])
+
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        memory = memory_report([int(pid) for pid in sys.argv[1:]])
+        print(memory.round(1).to_string())
+        print(memory.sum().round(1).to_string())
+    else:
+        print(report.round(1).to_string(index=False))
+        print(frame_totals(report).round(1).to_string())
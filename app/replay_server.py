@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""A local stand-in for the remote services we fetch data from (the ESMA STS
+register and FIRDS file list, the FIRDS files themselves, GLEIF and the ECB),
+so that fetching can be tested and benchmarked offline and deterministically.
+
+Requests are made to the server with the original host name as the first
+part of the path, eg:
+
+    http://127.0.0.1:8765/leilookup.gleif.org/api/v2/leirecords?lei=...
+
+which is what fetch_data.service_url produces when the environment variable
+STSS_REPLAY_URL is set to the server's URL.
+
+Each request is answered from a recorded response, if there is one, or
+otherwise from deterministic synthetic data (a register of made-up
+securitisations, with matching FIRDS files, GLEIF records and exchange
+rates).  With --record, requests for which there is no recording are
+forwarded to the live service and the response is recorded.
+
+Latency, per-connection bandwidth and an error rate can be imposed on every
+response, and Range requests are supported.  Errors (503s) are chosen
+deterministically from the seed, the URL and the number of times that URL has
+been requested, so a given sequence of requests for a URL always meets the
+same errors, however requests for different URLs are interleaved.
+
+Example usage:
+
+    python replay_server.py --port 8765 --latency 0.2 --bandwidth 1000000 --error-rate 0.1
+    STSS_REPLAY_URL=http://127.0.0.1:8765 python fetch_async.py
+"""
+
+import json
+import logging
+import random
+import re
+import threading
+import time
+import zipfile
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from os import makedirs
+from os.path import dirname, exists, join, realpath
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+import requests
+
+logging.basicConfig(level=logging.INFO)
+
+replay_dir = join(dirname(realpath(__file__)), 'data_files', 'replay')
+
+CHUNK_SIZE = 1 << 16
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+Response = Tuple[bytes, str]
+
+
+def _isin(rng: random.Random, country: str) -> str:
+    """Return a random ISIN with a valid check digit."""
+    body = country + ''.join(rng.choice('0123456789') for _ in range(9))
+    digits = ''.join(str(int(c, 36)) for c in body)
+    total = 0
+    for i, d in enumerate(reversed(digits)):
+        n = int(d) * (2 if i % 2 == 0 else 1)
+        total += n // 10 + n % 10
+    return body + str((10 - total % 10) % 10)
+
+
+class Synthetic:
+    """Deterministic synthetic responses for each of the services.  The data
+    is consistent between services: the ISINs in the register are found in
+    the FIRDS files, the issuers of those ISINs are known to GLEIF, and there
+    are exchange rates for all of their currencies."""
+
+    ASSET_CLASSES = ('auto loans / leases', 'residential mortgages', 'trade receivables', 'SME loans',
+                     'consumer loans')
+    COUNTRIES = ('DE', 'FR', 'IT', 'NL', 'ES', 'IE', 'BE', 'AT', 'UK', 'DE; FR')
+    CURRENCIES = ('EUR', 'EUR', 'EUR', 'GBP', 'USD')
+
+    def __init__(self, n_deals: int = 300, n_files: int = 4, noise_per_file: int = 20000, seed: int = 0):
+        self.n_files = n_files
+        self.noise_per_file = noise_per_file
+        self.seed = seed
+        rng = random.Random(seed)
+        self.leis = ['{:020d}'.format(rng.randrange(10 ** 19)) for _ in range(max(1, n_deals // 3))]
+        self.deals = []
+        self.isins = {}
+        for i in range(n_deals):
+            public = rng.random() < 0.6
+            isins = [_isin(rng, rng.choice(('XS', 'DE', 'FR'))) for _ in range(rng.choice((1, 1, 2, 3)))] if public else []
+            for isin in isins:
+                ccy = rng.choice(self.CURRENCIES)
+                self.isins[isin] = {
+                    'lei': rng.choice(self.leis),
+                    'currency': ccy,
+                    'amount': rng.randint(1, 900) * 1000000,
+                    'rca': rng.choice(('IE', 'LU', 'DE', 'FR')),
+                    'file': rng.randrange(n_files)
+                }
+            self.deals.append({
+                'Unique Securitisation Identifier': f'SYNTH{i:06d}',
+                'Securitisation Name': f'Synthetic Funding {i} S.A.',
+                'Notification date to ESMA': datetime(2019, 1, 1) + timedelta(days=rng.randrange(450)),
+                'Private or Public': 'Public' if public else 'Private',
+                'Underlying assets': rng.choice(self.ASSET_CLASSES),
+                'Non-ABCP/      ABCP transaction/ ABCP Programme': rng.choice(('Non-ABCP', 'ABCP transaction')),
+                'Originator Country': rng.choice(self.COUNTRIES) if public else None,
+                'ISIN code': ' ; '.join(isins) or None
+            })
+
+    def register(self) -> Response:
+        buf = BytesIO()
+        # RegisterParser skips the first 10 rows of the sheet.
+        pd.DataFrame(self.deals).to_excel(buf, index=False, startrow=10)
+        return buf.getvalue(), 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+    def file_name(self, i: int) -> str:
+        return f'FULINS_D_20200404_{i + 1:02d}of{self.n_files:02d}'
+
+    def file_list(self) -> Response:
+        docs = []
+        for i in range(self.n_files):
+            name = self.file_name(i)
+            docs.append(
+                f'<doc><str name="id">{i}</str>'
+                f'<str name="download_link">https://firds.esma.europa.eu/firds/{name}.zip</str>'
+                f'<date name="publication_date">2020-04-04T00:00:00Z</date>'
+                f'<str name="file_name">{name}.zip</str></doc>'
+            )
+        xml = ('<?xml version="1.0" encoding="UTF-8"?>\n<response><lst name="responseHeader"/>'
+               f'<result name="response" numFound="{self.n_files}" start="0">{"".join(docs)}</result></response>')
+        return xml.encode(), 'application/xml'
+
+    @staticmethod
+    def _refdata(isin: str, lei: str, ccy: str, amount: int, rca: str) -> str:
+        return (
+            f'<RefData><FinInstrmGnlAttrbts><Id>{isin}</Id><FullNm>Synthetic note</FullNm><ShrtNm>SYNTH</ShrtNm>'
+            f'<ClssfctnTp>DAVSFR</ClssfctnTp><NtnlCcy>{ccy}</NtnlCcy><CmmdtyDerivInd>false</CmmdtyDerivInd>'
+            f'</FinInstrmGnlAttrbts><Issr>{lei}</Issr><TradgVnRltdAttrbts><Id>XDUB</Id></TradgVnRltdAttrbts>'
+            f'<DebtInstrmAttrbts><TtlIssdNmnlAmt Ccy="{ccy}">{amount}</TtlIssdNmnlAmt><MtrtyDt>2040-01-01</MtrtyDt>'
+            f'<NmnlValPerUnit Ccy="{ccy}">100000</NmnlValPerUnit><IntrstRate><Fxd>1.5</Fxd></IntrstRate>'
+            f'</DebtInstrmAttrbts><TechAttrbts><RlvntCmptntAuthrty>{rca}</RlvntCmptntAuthrty></TechAttrbts></RefData>\n'
+        )
+
+    def firds_file(self, name: str) -> Optional[Response]:
+        names = [self.file_name(i) for i in range(self.n_files)]
+        if name not in names:
+            return None
+        i = names.index(name)
+        rng = random.Random(f'{self.seed}:{name}')
+        records = [self._refdata(isin, d['lei'], d['currency'], d['amount'], d['rca'])
+                   for isin, d in self.isins.items() if d['file'] == i]
+        records += [self._refdata(_isin(rng, 'XS'), rng.choice(self.leis), 'EUR', rng.randint(1, 900) * 1000000, 'IE')
+                    for _ in range(self.noise_per_file)]
+        rng.shuffle(records)
+        xml = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<BizData xmlns="urn:iso:std:iso:20022:tech:xsd:head.003.001.01"><Hdr/><Pyld>'
+            '<Document xmlns="urn:iso:std:iso:20022:tech:xsd:auth.017.001.02"><FinInstrmRptgRefDataRpt><RptHdr/>\n'
+            + ''.join(records) +
+            '</FinInstrmRptgRefDataRpt></Document></Pyld></BizData>\n'
+        )
+        buf = BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr(name + '.xml', xml)
+        return buf.getvalue(), 'application/zip'
+
+    def gleif(self, leis: List[str]) -> Response:
+        records = []
+        for lei in leis:
+            rng = random.Random(f'{self.seed}:{lei}')
+            records.append({
+                'LEI': {'$': lei},
+                'Entity': {
+                    'LegalName': {'$': f'Synthetic Issuer {lei[-4:]} {rng.choice(("DAC", "S.A.", "PLC", "B.V."))}'},
+                    'LegalJurisdiction': {'$': rng.choice(('IE', 'LU', 'NL', 'GB'))}
+                }
+            })
+        return json.dumps(records).encode(), 'application/json'
+
+    def fx(self, currency: str) -> Response:
+        rng = random.Random(f'{self.seed}:{currency}')
+        rate = rng.uniform(0.5, 2)
+        obs = []
+        day = datetime(2019, 1, 1)
+        while day <= datetime(2020, 4, 3):
+            if day.weekday() < 5:
+                rate *= rng.uniform(0.995, 1.005)
+                obs.append(f'<Obs TIME_PERIOD="{day:%Y-%m-%d}" OBS_VALUE="{rate:.4f}"/>')
+            day += timedelta(days=1)
+        xml = ('<?xml version="1.0" encoding="UTF-8"?>\n<CompactData><Header/><DataSet><Group/>'
+               f'<Series CURRENCY="{currency.upper()}">{"".join(obs)}</Series></DataSet></CompactData>\n')
+        return xml.encode(), 'application/xml'
+
+    def response(self, host: str, path: str, query: Dict[str, List[str]]) -> Optional[Response]:
+        if host == 'www.esma.europa.eu' and path.endswith('.xlsx'):
+            return self.register()
+        elif host == 'registers.esma.europa.eu' and path.startswith('/solr/esma_registers_firds_files/'):
+            return self.file_list()
+        elif host == 'firds.esma.europa.eu' and path.endswith('.zip'):
+            return self.firds_file(path.rsplit('/', 1)[-1][:-len('.zip')])
+        elif host == 'leilookup.gleif.org' and path.endswith('/leirecords'):
+            return self.gleif([l for l in ','.join(query.get('lei', [])).split(',') if l])
+        elif host == 'www.ecb.europa.eu' and path.endswith('.xml'):
+            return self.fx(path.rsplit('/', 1)[-1][:-len('.xml')])
+        return None
+
+
+class Recordings:
+    """Recorded responses, stored as one file for the body and one for the
+    metadata per URL, under a directory for each host."""
+
+    def __init__(self, _dir: str = replay_dir):
+        self.dir = _dir
+
+    def _paths(self, host: str, path_and_query: str) -> Tuple[str, str]:
+        key = sha256(path_and_query.encode()).hexdigest()[:32]
+        return join(self.dir, host, key + '.body'), join(self.dir, host, key + '.json')
+
+    def get(self, host: str, path_and_query: str) -> Optional[Response]:
+        body_file, meta_file = self._paths(host, path_and_query)
+        if not exists(meta_file):
+            return None
+        with open(meta_file) as f:
+            meta = json.load(f)
+        with open(body_file, 'rb') as f:
+            return f.read(), meta['content_type']
+
+    def record(self, host: str, path_and_query: str, timeout: float = 300) -> Optional[Response]:
+        url = f'https://{host}{path_and_query}'
+        logging.info(f'Recording {url}.')
+        response = requests.get(url, timeout=timeout)
+        if not response.ok:
+            logging.warning(f'Not recording {url}: status {response.status_code}.')
+            return None
+        body_file, meta_file = self._paths(host, path_and_query)
+        makedirs(dirname(body_file), exist_ok=True)
+        content_type = response.headers.get('Content-Type', 'application/octet-stream')
+        with open(body_file, 'wb') as f:
+            f.write(response.content)
+        with open(meta_file, 'w') as f:
+            json.dump({'url': url, 'content_type': content_type, 'recorded': datetime.now().isoformat()}, f)
+        return response.content, content_type
+
+
+class Replay:
+    """The state and options shared by all of the server's handlers."""
+
+    def __init__(self, recordings: Recordings, synthetic: Synthetic, record: bool = False, latency: float = 0,
+                 jitter: float = 0, bandwidth: float = None, error_rate: float = 0, seed: int = 0):
+        self.recordings = recordings
+        self.synthetic = synthetic
+        self.record = record
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.request_counts: Dict[str, int] = {}
+        # Synthetic responses are built once and kept, as FIRDS files are
+        # costly to build.
+        self.cache: Dict[str, Response] = {}
+
+    def delay_and_error(self, key: str) -> Tuple[float, bool]:
+        """Return the latency to impose on this request for `key` and whether
+        it should fail."""
+        with self.lock:
+            n = self.request_counts.get(key, 0)
+            self.request_counts[key] = n + 1
+        rng = random.Random(f'{self.seed}:{key}:{n}')
+        delay = max(0.0, self.latency + rng.uniform(-self.jitter, self.jitter))
+        return delay, rng.random() < self.error_rate
+
+    def response(self, host: str, path_and_query: str) -> Optional[Response]:
+        key = host + path_and_query
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+        response = self.recordings.get(host, path_and_query)
+        if (response is None) and self.record:
+            response = self.recordings.record(host, path_and_query)
+        if response is None:
+            parts = urlsplit(path_and_query)
+            response = self.synthetic.response(host, parts.path, parse_qs(parts.query))
+        if response is not None:
+            with self.lock:
+                self.cache[key] = response
+        return response
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def _respond(self, send_body: bool):
+        replay: Replay = self.server.replay
+        host, _, rest = self.path.lstrip('/').partition('/')
+        path_and_query = '/' + rest
+
+        delay, error = replay.delay_and_error(host + path_and_query)
+        if delay:
+            time.sleep(delay)
+        if error:
+            self.send_error(503, 'Injected error')
+            return
+        response = replay.response(host, path_and_query)
+        if response is None:
+            self.send_error(404, 'No recorded or synthetic response')
+            return
+        body, content_type = response
+
+        status = 200
+        start, end = 0, len(body)
+        range_header = self.headers.get('Range')
+        if range_header:
+            match = RANGE_RE.match(range_header.strip())
+            if match and (match.group(1) or match.group(2)):
+                if not match.group(1):
+                    # Suffix range: the last N bytes
+                    start = max(0, len(body) - int(match.group(2)))
+                else:
+                    start = int(match.group(1))
+                    if match.group(2):
+                        end = min(len(body), int(match.group(2)) + 1)
+                if start >= end:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{len(body)}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{len(body)}')
+        self.end_headers()
+        if send_body:
+            self._write(body, start, end, replay.bandwidth)
+
+    def _write(self, body: bytes, start: int, end: int, bandwidth: Optional[float]):
+        began = time.perf_counter()
+        sent = 0
+        for i in range(start, end, CHUNK_SIZE):
+            chunk = body[i:min(i + CHUNK_SIZE, end)]
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if bandwidth:
+                # Sleep until the time at which the bytes sent so far would
+                # have been sent at the given rate.
+                ahead = sent / bandwidth - (time.perf_counter() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def log_message(self, format, *args):
+        logging.debug('%s - %s', self.address_string(), format % args)
+
+
+def make_server(host: str = '127.0.0.1', port: int = 8765, replay: Replay = None) -> ThreadingHTTPServer:
+    """Return a replay server (not yet serving).  Call its serve_forever
+    method (eg, in a thread) to start it and shutdown to stop it.  Pass port
+    0 to have a free port chosen (see the server's server_address)."""
+    server = ThreadingHTTPServer((host, port), ReplayHandler)
+    server.daemon_threads = True
+    server.replay = replay if replay is not None else Replay(Recordings(), Synthetic())
+    return server
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Serve recorded or synthetic responses in place of the remote services.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--dir', default=replay_dir, help='Directory in which recordings are kept.')
+    parser.add_argument('--record', action='store_true',
+                        help='Forward requests with no recording to the live service and record the response.')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds to wait before each response.')
+    parser.add_argument('--jitter', type=float, default=0, help='Maximum random variation in latency (seconds).')
+    parser.add_argument('--bandwidth', type=float, help='Maximum bytes per second sent on each connection.')
+    parser.add_argument('--error-rate', type=float, default=0, help='Proportion of requests answered with a 503.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for synthetic data, latency jitter and errors.')
+    parser.add_argument('--deals', type=int, default=300, help='Number of securitisations in the synthetic register.')
+    parser.add_argument('--files', type=int, default=4, help='Number of synthetic FIRDS files.')
+    parser.add_argument('--noise', type=int, default=20000,
+                        help='Number of unrelated records in each synthetic FIRDS file.')
+    args = parser.parse_args()
+
+    replay = Replay(
+        Recordings(args.dir),
+        Synthetic(args.deals, args.files, args.noise, args.seed),
+        record=args.record,
+        latency=args.latency,
+        jitter=args.jitter,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        seed=args.seed
+    )
+    server = make_server(args.host, args.port, replay)
+    logging.info('Serving on http://{}:{}; set STSS_REPLAY_URL to this to use it.'.format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Export of the dashboard as a static site, which any plain web server can
+serve without running Python.
+
+The overview page's Dash layout (including every section, which the live app
+only renders when its tab is selected) is rendered to a single HTML page.
+Each figure is written to its own JSON file, which the page fetches and
+plots with plotly.js when the figure is first shown.  Figure files and
+assets are named after a hash of their contents, so they can be cached
+indefinitely, and figure files are also written gzip-compressed alongside
+the originals, for servers which can serve precompressed files (such as
+nginx with `gzip_static on`).
+
+The export is incremental: if neither the data version nor the code which
+renders the page (this module and the app modules it uses, and the versions
+of plotly and Dash) has changed since the last export, nothing is done, and
+otherwise only files whose contents have changed are written.  The page
+itself is written last, so that it never refers to files which don't exist
+yet, and files no longer referred to are then removed.
+
+Example usage:
+
+    python static_export.py --out /var/www/stss_intro
+"""
+
+import gzip
+import json
+import logging
+import re
+import sys
+from argparse import ArgumentParser
+from hashlib import sha256
+from html import escape
+from os import listdir, makedirs, remove, replace
+from io import BytesIO
+from os.path import dirname, exists, join, realpath
+from typing import Any, Dict, Set
+
+import dash
+import plotly
+from plotly.utils import PlotlyJSONEncoder
+
+import curated_data as cd
+import dash_app
+from pipeline import module_hash
+
+out_dir = join(dirname(realpath(__file__)), 'static_site')
+manifest_name = 'manifest.json'
+
+# Graphs are this high in the live app (Dash's default).
+GRAPH_HEIGHT = '450px'
+
+# Hash length used in file names.
+HASH_LEN = 16
+
+PLOTLY_JS = join(dirname(plotly.__file__), 'package_data', 'plotly.min.js')
+
+SCRIPT = """
+(function () {
+    function plot(div) {
+        if (div.dataset.plotted) { return; }
+        div.dataset.plotted = '1';
+        fetch(div.dataset.figure).then(function (r) { return r.json(); }).then(function (fig) {
+            Plotly.newPlot(div, fig.data || [], fig.layout || {}, {responsive: true});
+        });
+    }
+    function plotVisible(root) {
+        root.querySelectorAll('.static-graph').forEach(function (div) {
+            if (div.offsetParent !== null) { plot(div); }
+        });
+    }
+    function showTab(value) {
+        document.querySelectorAll('[data-tab-panel]').forEach(function (panel) {
+            panel.style.display = panel.dataset.tabPanel === value ? '' : 'none';
+        });
+        document.querySelectorAll('[data-tab]').forEach(function (tab) {
+            tab.classList.toggle('static-tab--selected', tab.dataset.tab === value);
+        });
+        plotVisible(document);
+    }
+    document.addEventListener('DOMContentLoaded', function () {
+        document.querySelectorAll('[data-tab]').forEach(function (tab) {
+            tab.addEventListener('click', function () { showTab(tab.dataset.tab); });
+        });
+        var selected = document.querySelector('.static-tab--selected');
+        if (selected) { showTab(selected.dataset.tab); } else { plotVisible(document); }
+    });
+})();
+"""
+
+STYLE = """
+.static-graph { height: %s; }
+.static-tabs { display: flex; border-bottom: 1px solid #d6d6d6; }
+.static-tab { flex: 1; padding: 6px; border: 1px solid #d6d6d6; border-bottom: none; background: #f9f9f9;
+              cursor: pointer; font: inherit; }
+.static-tab--selected { background: white; border-top: 2px solid #1975FA; }
+table.static-table { border-collapse: collapse; }
+table.static-table th, table.static-table td { border: 1px solid #d6d6d6; padding: 4px 8px; }
+""" % GRAPH_HEIGHT
+
+
+# A minimal Markdown converter, covering the syntax used in markdown.py
+# (headings, paragraphs, links, images, bold and italic text and bare URLs).
+# We can't use the markdown package, as our own markdown module shadows it.
+
+HEADING_RE = re.compile(r'^(#{1,6})\s+(.*)$')
+IMAGE_RE = re.compile(r'!\[([^\]]*)\]\(([^)\s]+)\)')
+LINK_RE = re.compile(r'\[([^\]]+)\]\(([^)\s]+)\)')
+BARE_URL_RE = re.compile(r'(?<![">])\b(https?://[^\s<]+[^\s<.,;)])')
+BOLD_RE = re.compile(r'\*\*(.+?)\*\*')
+ITALIC_RE = re.compile(r'\*(.+?)\*')
+
+# Matches the capitals in camel-cased style properties (eg, textAlign).
+CAMEL_RE = re.compile(r'[A-Z]')
+
+
+def _inline(text: str) -> str:
+    text = escape(text, quote=False)
+    text = IMAGE_RE.sub(lambda m: f'<img src="{m.group(2)}" alt="{m.group(1)}">', text)
+    text = LINK_RE.sub(lambda m: f'<a href="{m.group(2)}">{m.group(1)}</a>', text)
+    text = BARE_URL_RE.sub(lambda m: f'<a href="{m.group(1)}">{m.group(1)}</a>', text)
+    text = BOLD_RE.sub(r'<strong>\1</strong>', text)
+    return ITALIC_RE.sub(r'<em>\1</em>', text)
+
+
+def markdown_to_html(text: str) -> str:
+    blocks = []
+    for block in re.split(r'\n\s*\n', text.strip()):
+        match = HEADING_RE.match(block.strip())
+        if match:
+            level = len(match.group(1))
+            blocks.append(f'<h{level}>{_inline(match.group(2))}</h{level}>')
+        elif block.strip():
+            blocks.append(f'<p>{_inline(" ".join(block.split()))}</p>')
+    return '\n'.join(blocks)
+
+
+def _css_property(name: str) -> str:
+    return CAMEL_RE.sub(lambda m: '-' + m.group(0).lower(), name)
+
+
+def _hash(data: bytes) -> str:
+    return sha256(data).hexdigest()[:HASH_LEN]
+
+
+def _gzip(data: bytes) -> bytes:
+    # With no timestamp, so that the same data always compresses to the same
+    # bytes.  (gzip.compress only takes an mtime from Python 3.8.)
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def code_version() -> str:
+    """A hash of the code which renders the page: this module and the app
+    modules it uses, and the versions of plotly and Dash."""
+    return _hash(' '.join((module_hash(sys.modules[__name__]), plotly.__version__, dash.__version__)).encode())
+
+
+def _write(path: str, data: bytes):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    replace(tmp_path, path)
+
+
+class Exporter:
+
+    def __init__(self, _out_dir: str = out_dir):
+        self.out_dir = _out_dir
+        # Paths (relative to out_dir) of every file the new export refers to.
+        self.files: Set[str] = set()
+        self.written = 0
+
+    def add_file(self, subdir: str, name: str, ext: str, data: bytes, precompress: bool = False) -> str:
+        """Write `data` to a content-hashed file (unless it already exists)
+        and return its path relative to out_dir."""
+        rel_path = f'{subdir}/{name}.{_hash(data)}.{ext}'
+        path = join(self.out_dir, rel_path)
+        makedirs(dirname(path), exist_ok=True)
+        if not exists(path):
+            _write(path, data)
+            self.written += 1
+        self.files.add(rel_path)
+        if precompress:
+            gz_path = path + '.gz'
+            if not exists(gz_path):
+                # mtime=0 so that the same data always compresses to the same bytes.
+                _write(gz_path, _gzip(data))
+            self.files.add(rel_path + '.gz')
+        return rel_path
+
+    def add_figure(self, graph_id: str, figure: Any) -> str:
+        if hasattr(figure, 'to_plotly_json'):
+            figure = figure.to_plotly_json()
+        data = json.dumps(figure, cls=PlotlyJSONEncoder, separators=(',', ':')).encode('utf-8')
+        return self.add_file('figures', graph_id, 'json', data, precompress=True)
+
+    def render(self, component: Any) -> str:
+        """Render a component (or a list of components, or a string) to
+        HTML."""
+        if component is None:
+            return ''
+        if isinstance(component, (list, tuple)):
+            return '\n'.join(self.render(c) for c in component)
+        if isinstance(component, (str, int, float)):
+            return escape(str(component))
+        return self.render_component(component.to_plotly_json())
+
+    def render_component(self, obj: Dict[str, Any]) -> str:
+        namespace = obj['namespace']
+        _type = obj['type']
+        props = obj['props']
+        if namespace == 'dash_html_components':
+            if props.get('id') == 'section_content':
+                # Filled in by callback in the live app; here, with every section (see sections).
+                return self._html_element(_type.lower(), props, self.sections())
+            return self._html_element(_type.lower(), props, self.render(props.get('children')))
+        if _type == 'Markdown':
+            children = props.get('children')
+            text = '\n'.join(children) if isinstance(children, (list, tuple)) else (children or '')
+            return self._html_element('div', props, markdown_to_html(text))
+        if _type == 'Graph':
+            if props['id'] in dash_app.TOGGLED_GRAPHS:
+                # Their figures are only placeholders, until built in the browser.
+                figure = dash_app.toggled_figure(props['id'])
+            else:
+                figure = props.get('figure', {})
+            src = self.add_figure(props['id'], figure)
+            return f'<div class="static-graph" id="{escape(props["id"])}" data-figure="{src}"></div>'
+        if _type == 'Tabs':
+            return self._tabs(props)
+        if _type == 'Loading':
+            return self.render(props.get('children'))
+        if _type == 'DataTable':
+            return self._table(props)
+        if _type in ('RadioItems', 'Store', 'Location'):
+            # Components which only work in the live app: controls for switching the views of
+            # graphs (see dash_app.toggled_graph), which are exported in their default view, and
+            # the URL, which selects the page (only the overview is exported).
+            return ''
+        logging.warning(f'Not exporting unsupported component {namespace}.{_type}.')
+        return ''
+
+    @staticmethod
+    def _html_element(tag: str, props: Dict[str, Any], inner: str) -> str:
+        attrs = []
+        if props.get('id'):
+            attrs.append(f'id="{escape(str(props["id"]))}"')
+        if props.get('className'):
+            attrs.append(f'class="{escape(props["className"])}"')
+        if props.get('style'):
+            css = ';'.join(f'{_css_property(k)}:{v}' for k, v in props['style'].items())
+            attrs.append(f'style="{escape(css)}"')
+        if props.get('href'):
+            attrs.append(f'href="{escape(props["href"])}"')
+        if props.get('src'):
+            attrs.append(f'src="{escape(props["src"])}"')
+        attr_str = (' ' + ' '.join(attrs)) if attrs else ''
+        return f'<{tag}{attr_str}>{inner}</{tag}>'
+
+    def _tabs(self, props: Dict[str, Any]) -> str:
+        # The tabs of the section list (SECTIONS) select which section is
+        # shown in the section_content div, which the live app fills in by
+        # callback.  Here, every section is rendered up front (see sections).
+        buttons = []
+        for tab in props.get('children', []):
+            tab_props = tab.to_plotly_json()['props']
+            selected = ' static-tab--selected' if tab_props['value'] == props.get('value') else ''
+            buttons.append(f'<button class="static-tab{selected}" data-tab="{escape(tab_props["value"])}">'
+                           f'{escape(tab_props["label"])}</button>')
+        return f'<div class="static-tabs">{"".join(buttons)}</div>'
+
+    @staticmethod
+    def _table(props: Dict[str, Any]) -> str:
+        columns = props.get('columns', [])
+        head = ''.join(f'<th>{escape(str(c["name"]))}</th>' for c in columns)
+        rows = []
+        for row in props.get('data', []):
+            cells = ''.join(f'<td>{escape(str(row.get(c["id"], "")))}</td>' for c in columns)
+            rows.append(f'<tr>{cells}</tr>')
+        return f'<table class="static-table"><thead><tr>{head}</tr></thead><tbody>{"".join(rows)}</tbody></table>'
+
+    def sections(self) -> str:
+        panels = []
+        for value, _, builder in dash_app.SECTIONS:
+            panels.append(f'<div data-tab-panel="{escape(value)}">{self.render(builder())}</div>')
+        return '\n'.join(panels)
+
+    def page(self) -> str:
+        # Only the overview is exported (which the live app renders into its
+        # layout by callback; see dash_app.render_page).
+        body = self.render(dash_app.overview_layout)
+        with open(PLOTLY_JS, 'rb') as f:
+            plotly_js = self.add_file('assets', 'plotly', 'min.js', f.read(), precompress=True)
+        script = self.add_file('assets', 'static', 'js', SCRIPT.encode('utf-8'), precompress=True)
+        style = self.add_file('assets', 'static', 'css', STYLE.encode('utf-8'), precompress=True)
+        stylesheets = ''.join(f'<link rel="stylesheet" href="{escape(s)}">'
+                              for s in dash_app.external_stylesheets + [style])
+        return (
+            '<!DOCTYPE html>\n<html lang="en">\n<head>\n<meta charset="utf-8">\n'
+            f'<title>{escape(dash_app.dash_app.title)}</title>\n{stylesheets}\n'
+            f'<script src="{plotly_js}"></script>\n<script src="{script}"></script>\n'
+            f'</head>\n<body>\n{body}\n</body>\n</html>\n'
+        )
+
+    def prune(self, keep: Set[str]):
+        for subdir in ('figures', 'assets'):
+            path = join(self.out_dir, subdir)
+            if not exists(path):
+                continue
+            for fname in listdir(path):
+                if f'{subdir}/{fname}' not in keep:
+                    remove(join(path, fname))
+
+
+def load_manifest(_out_dir: str = out_dir) -> Dict[str, Any]:
+    try:
+        with open(join(_out_dir, manifest_name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def export(_out_dir: str = out_dir, force: bool = False) -> bool:
+    """Export the dashboard to `_out_dir`.  Return False if the export was
+    skipped because neither the data nor the code has changed since the last
+    export."""
+    manifest = load_manifest(_out_dir)
+    version = code_version()
+    if ((not force) and manifest.get('data_version') == cd.data_version and manifest.get('code_version') == version
+            and exists(join(_out_dir, 'index.html'))):
+        logging.info(f'Static export of data version {cd.data_version} is up to date.')
+        return False
+
+    makedirs(_out_dir, exist_ok=True)
+    exporter = Exporter(_out_dir)
+    page = exporter.page().encode('utf-8')
+    _write(join(_out_dir, 'index.html'), page)
+    _write(join(_out_dir, 'index.html.gz'), _gzip(page))
+    _write(join(_out_dir, manifest_name), json.dumps({
+        'data_version': cd.data_version,
+        'code_version': version,
+        'files': sorted(exporter.files)
+    }, indent=1).encode('utf-8'))
+    exporter.prune(exporter.files)
+    logging.info(f'Exported data version {cd.data_version} to {_out_dir} '
+                 f'({exporter.written} of {len(exporter.files)} hashed files written).')
+    return True
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Export the dashboard as a static site.')
+    parser.add_argument('--out', default=out_dir, help='Directory to export to.')
+    parser.add_argument('--force', action='store_true', help='Export even if the data and code are unchanged.')
+    args = parser.parse_args()
+    export(args.out, args.force)
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+"""The app's modules import each other by name, so the tests import them
+from the app directory too.  (Modules which load the data files, such as
+fetch_data, need them to be present in app/data_files.)"""
+
+from os.path import dirname, join, realpath
+import sys
+
+sys.path.insert(0, join(dirname(dirname(realpath(__file__))), 'app'))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+import crosstab
+import fetch_data as fd
+
+
+def _series(values, name):
+    return pd.Series(values, name=name, dtype=object)
+
+
+def test_pairs():
+    a = crosstab.encode(_series([fd.Combo('x', 'y'), 'x', None, 'y'], 'a'))
+    b = crosstab.encode(_series(['p', fd.Combo('p', 'q'), 'q', None], 'b'))
+    a_codes, b_codes, rows = crosstab._pairs(a, b)
+    pairs = sorted(zip(rows.tolist(), a.categories[a_codes], b.categories[b_codes]))
+    # Every pair of values from the same row; rows with a null in either column have none.
+    assert pairs == [(0, 'x', 'p'), (0, 'y', 'p'), (1, 'x', 'p'), (1, 'x', 'q')]
+
+
+def test_group_count_split():
+    series = _series([fd.Combo('x', 'y'), 'x', None, 'y'], 'a')
+    counts = crosstab.group_count(series)
+    assert counts.to_dict() == {'x': 2, 'y': 2}
+    assert counts.dtype == np.int64
+    weights = [10, 1, 100, np.nan]
+    assert crosstab.group_count(series, weights).to_dict() == {'x': 11, 'y': 10}
+    # Split between the values of the Combo, so the total is unchanged (less the null row's weight).
+    split = crosstab.group_count(series, weights, split=True)
+    assert split.to_dict() == {'x': 6, 'y': 5}
+    assert split.sum() == 11
+
+
+def test_stacked_counts():
+    level_0 = _series([fd.Combo('x', 'y'), 'x', 'x', None], 'a')
+    level_1 = _series(['p', fd.Combo('p', 'q'), 'p', 'q'], 'b')
+    stacked = crosstab.stacked_counts(level_0, level_1)
+    assert stacked.to_dict() == {('x', 'p'): 3, ('x', 'q'): 1, ('y', 'p'): 1}
+    # Pairs which don't occur are left out, including from the index's levels.
+    assert ('y', 'q') not in stacked.index
+    assert stacked.index.levels[1].tolist() == ['p', 'q']
+    weighted = crosstab.stacked_counts(level_0, level_1, weights=[1.0, 2.0, 4.0, 8.0])
+    assert weighted.to_dict() == {('x', 'p'): 7.0, ('x', 'q'): 2.0, ('y', 'p'): 1.0}
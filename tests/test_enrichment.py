@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+import flask
+import pytest
+
+import enrichment
+import fetch_data as fd
+
+
+def _isin(body: str) -> str:
+    # Complete an ISIN with its check digit.
+    return next(body + d for d in '0123456789' if fd.RegisterParser.check_isin(body + d))
+
+
+FOUND = _isin('XS000000001')
+OTHER = _isin('XS000000002')
+MISSING = _isin('XS000000003')
+
+
+def _record(isin: str, lei: str) -> str:
+    return (
+        f'<RefData><FinInstrmGnlAttrbts><Id>{isin}</Id><FullNm>Note</FullNm><ShrtNm>NOTE</ShrtNm>'
+        f'<ClssfctnTp>DAVSFR</ClssfctnTp><NtnlCcy>EUR</NtnlCcy></FinInstrmGnlAttrbts><Issr>{lei}</Issr>'
+        f'<TradgVnRltdAttrbts><Id>XDUB</Id></TradgVnRltdAttrbts><DebtInstrmAttrbts>'
+        f'<TtlIssdNmnlAmt Ccy="EUR">100</TtlIssdNmnlAmt></DebtInstrmAttrbts><TechAttrbts>'
+        f'<RlvntCmptntAuthrty>IE</RlvntCmptntAuthrty></TechAttrbts></RefData>\n'
+    )
+
+
+@pytest.fixture
+def service(tmp_path):
+    firds_dir = tmp_path / 'firds'
+    firds_dir.mkdir()
+    (firds_dir / 'FULINS_D.xml').write_text(
+        '<Document><FinInstrmRptgRefDataRpt>\n' + _record(FOUND, 'LEI1') + _record(OTHER, 'LEI1') +
+        '</FinInstrmRptgRefDataRpt></Document>\n'
+    )
+    service = enrichment.EnrichmentService(str(firds_dir), str(tmp_path / 'cache.json'), batch_window=0.01)
+    service.fp.get_issuers = lambda leis: [
+        {'LEI': {'$': lei}, 'Entity': {'LegalName': {'$': f'Issuer {lei}'}, 'LegalJurisdiction': {'$': 'IE'}}}
+        for lei in leis
+    ]
+    return service
+
+
+def test_enrich_caches_results_and_expires_misses(service, monkeypatch):
+    results, breakdown = service.enrich([FOUND.lower(), MISSING])
+    assert results[FOUND]['Issuer Name'] == 'Issuer LEI1'
+    assert results[FOUND]['Nominal Amount'] == ('EUR', 100.0)
+    assert results[MISSING] is None
+    assert breakdown == {'cache': 0, 'coalesced': 0, 'lookup': 2, 'not_found': 1}
+
+    # Both are cached, and the cache is shared with a new service.
+    assert service.enrich([FOUND, MISSING])[1]['cache'] == 2
+    reloaded = enrichment.EnrichmentService(service.fp.data_dir, service.cache_file)
+    assert reloaded.enrich([FOUND, MISSING])[1]['cache'] == 2
+    assert service.batches == 1
+
+    # Misses are looked up again once they expire.
+    monkeypatch.setattr(enrichment, 'MISS_TTL', -1)
+    assert service.enrich([FOUND, MISSING])[1] == {'cache': 1, 'coalesced': 0, 'lookup': 1, 'not_found': 1}
+    assert service.batches == 2
+
+
+def test_enrich_combines_concurrent_lookups(service):
+    service.batch_window = 0.2
+    threads = [threading.Thread(target=service.enrich, args=([isin],)) for isin in (FOUND, OTHER, MISSING)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert service.batches == 1
+    assert set(service.isins) == {FOUND, OTHER}
+
+
+def test_enrich_rejects_invalid_isins(service):
+    bad = FOUND[:-1] + str((int(FOUND[-1]) + 1) % 10)
+    with pytest.raises(ValueError):
+        service.enrich([FOUND, bad])
+    assert enrichment.invalid_isins([FOUND, bad, 'N/A', 'XS00000000<1']) == [bad, 'N/A', 'XS00000000<1']
+    assert service.batches == 0
+
+
+def test_endpoint_validates_and_is_local_only():
+    app = flask.Flask(__name__)
+    app.register_blueprint(enrichment.blueprint, url_prefix='/enrich')
+    client = app.test_client()
+    assert client.get('/enrich/?isins=N/A').status_code == 400
+    assert client.post('/enrich/', json={'isins': [FOUND[:-1] + 'X']}).status_code == 400
+    remote = app.test_client()
+    remote.environ_base['REMOTE_ADDR'] = '203.0.113.5'
+    assert remote.get(f'/enrich/?isins={FOUND}').status_code == 403
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+
+import pandas as pd
+
+import fetch_data as fd
+
+
+def _issuer(name: str, lei: str, country: str = 'DE'):
+    return {'LEI': {'$': lei}, 'Entity': {'LegalName': {'$': name}, 'LegalJurisdiction': {'$': country}}}
+
+
+def _register(names):
+    return pd.DataFrame({
+        'Unique Securitisation Identifier': [f'USI{i}' for i in range(len(names))],
+        'Securitisation Name': names,
+        'Private or Public': 'Public',
+        'Issuer LEI': None,
+        'Issuer Name': None,
+        'Issuer Country': None
+    })
+
+
+def test_match_missing_issuers():
+    issuers = [
+        _issuer('Globaldrive Auto Receivables 2019-A B.V.', 'LEI_GD_2019A', 'NL'),
+        _issuer('SC Germany S.A., Compartment Consumer 2020-1', 'LEI_SC_2020', 'LU'),
+        _issuer('Red & Black Auto Germany 7 UG', 'LEI_RB_7'),
+        _issuer('Red & Black Auto Germany 6 UG', 'LEI_RB_6'),
+        _issuer('Bumper DE S.A.', 'LEI_BUMPER', 'LU'),
+    ]
+    df = _register([
+        'Globaldrive Auto Receivables UK 2019-B',
+        'SC Germany Consumer 2019-1',
+        'Red & Black Auto Germany 6',
+        'Bumper DE 2019-1',
+        None
+    ])
+    df, report = fd.match_missing_issuers(df, issuers)
+    # Sibling vehicles are never matched, however similar their names.
+    assert df['Issuer LEI'].tolist() == [None, None, 'LEI_RB_6', 'LEI_BUMPER', None]
+    assert df['Issuer Country'].tolist() == [None, None, 'DE', 'LU', None]
+    assert report['Applied'].tolist() == [False, False, True, True, False]
+    assert report['Identifiers Conflict'].tolist() == [True, True, False, False, False]
+    # The conflicting matches are still reported, for review.
+    assert report['Matched Issuer LEI'].tolist()[:2] == ['LEI_GD_2019A', 'LEI_SC_2020']
+
+
+def test_match_missing_issuers_only_fills_public_rows_without_issuers():
+    df = _register(['Bumper DE 2019-1', 'Bumper DE 2019-1'])
+    df.loc[0, 'Private or Public'] = 'Private'
+    df, report = fd.match_missing_issuers(df, [_issuer('Bumper DE S.A.', 'LEI_BUMPER', 'LU')], min_score=0.99)
+    assert report['Unique Securitisation Identifier'].tolist() == ['USI1']
+    assert df['Issuer LEI'].tolist() == [None, None]
+
+
+def _isin(ccy: str, amount: float, lei: str = 'LEI1'):
+    return {'Currency': ccy, 'Issuer LEI': lei, 'Issuer Name': f'Issuer {lei}', 'Issuer Country': 'IE',
+            'Competent Authority': 'IE', 'Nominal Amount': (ccy, amount)}
+
+
+def test_apply_issuer_data_counts_duplicate_tranches():
+    from crosstab import encode_amounts, total_per_row
+    isin_data = {
+        'XS0000000001': _isin('EUR', 100.0),
+        'XS0000000002': _isin('EUR', 100.0),
+        'XS0000000003': _isin('GBP', 50.0),
+        'XS0000000004': _isin('EUR', 300.0, lei='LEI2'),
+    }
+    rows = pd.DataFrame({
+        'Securitisation Name': ['Deal 1', 'Deal 2', 'Deal 3'],
+        'ISIN code': [fd.Combo('XS0000000001', 'XS0000000002', 'XS0000000003'),
+                      fd.Combo('XS0000000001', 'XS0000000002'), 'XS0000000004']
+    })
+    for col in fd.ISSUER_COLS:
+        rows[col] = None
+    rows = rows.apply(lambda r: fd._apply_issuer_data(r, isin_data), axis=1)
+
+    # Two identical EUR tranches are summed, not collapsed into one.
+    assert rows['Nominal Amount'].iloc[0] == fd.Combo(('EUR', 200.0), ('GBP', 50.0))
+    assert rows['Nominal Amount'].iloc[1] == ('EUR', 200.0)
+    assert rows['Nominal Amount'].iloc[2] == ('EUR', 300.0)
+    assert rows['Currency'].iloc[0] == fd.Combo('EUR', 'GBP')
+    assert rows['Issuer LEI'].iloc[0] == 'LEI1'
+
+    amounts = encode_amounts(rows['Nominal Amount'])
+    assert amounts.rows.tolist() == [0, 0, 1, 2]
+    assert amounts.amounts.sum() == 200 + 50 + 200 + 300
+    totals = total_per_row(amounts, {'GBP': 0.5})
+    assert totals.tolist() == [300.0, 200.0, 300.0]
+
+
+def test_merge_issuer_data_returns_name_matches(tmp_path):
+    isin_data = {'XS0000000001': _isin('EUR', 100.0, lei='LEI_RB_6')}
+    issuers = [_issuer('Red & Black Auto Germany 6 UG', 'LEI_RB_6')]
+    register = pd.DataFrame({
+        'Unique Securitisation Identifier': ['USI0', 'USI1'],
+        'Securitisation Name': ['Red & Black Auto Germany 6', 'Red & Black Auto Germany 6 (Tap)'],
+        'Private or Public': 'Public',
+        'ISIN code': ['XS0000000001', None]
+    })
+    df, report = fd.merge_issuer_data(register, isin_data, issuers)
+    assert df['Issuer LEI'].tolist() == ['LEI_RB_6', 'LEI_RB_6']
+    assert report['Unique Securitisation Identifier'].tolist() == ['USI1']
+    fpath = tmp_path / 'matches.csv'
+    fd.save_name_match_report(report, str(fpath))
+    assert pd.read_csv(fpath)['Matched Issuer LEI'].tolist() == ['LEI_RB_6']
+    fd.save_name_match_report(report.iloc[:0], str(tmp_path / 'none.csv'))
+    assert not (tmp_path / 'none.csv').exists()
+
+
+def _refdata(isin: str, lei: str, ccy: str, amount: float, rca: str, venue_id: str = 'XDUB', prefix: str = ''):
+    return (
+        f'<{prefix}RefData><{prefix}FinInstrmGnlAttrbts><{prefix}Id>{isin}</{prefix}Id>'
+        f'<{prefix}FullNm>Note</{prefix}FullNm><{prefix}ShrtNm>NOTE</{prefix}ShrtNm>'
+        f'<{prefix}ClssfctnTp>DAVSFR</{prefix}ClssfctnTp><{prefix}NtnlCcy>{ccy}</{prefix}NtnlCcy>'
+        f'</{prefix}FinInstrmGnlAttrbts><{prefix}Issr>{lei}</{prefix}Issr>'
+        f'<{prefix}TradgVnRltdAttrbts><{prefix}Id>{venue_id}</{prefix}Id></{prefix}TradgVnRltdAttrbts>'
+        f'<{prefix}DebtInstrmAttrbts><{prefix}TtlIssdNmnlAmt Ccy="{ccy}">{amount}</{prefix}TtlIssdNmnlAmt>'
+        f'</{prefix}DebtInstrmAttrbts><{prefix}TechAttrbts><{prefix}RlvntCmptntAuthrty>{rca}'
+        f'</{prefix}RlvntCmptntAuthrty></{prefix}TechAttrbts></{prefix}RefData>\n'
+    )
+
+
+def _firds_file(path, records, prefix: str = ''):
+    ns = f' xmlns:{prefix[:-1]}' if prefix else ' xmlns'
+    path.write_text(
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<BizData><Pyld><{prefix}Document{ns}="urn:iso:std:iso:20022:tech:xsd:auth.017.001.02">'
+        f'<{prefix}FinInstrmRptgRefDataRpt>\n' + ''.join(records) +
+        f'</{prefix}FinInstrmRptgRefDataRpt></{prefix}Document></Pyld></BizData>\n'
+    )
+    return str(path)
+
+
+def test_search_isins(tmp_path):
+    fp = fd.FIRDSParser()
+    for prefix in ('', 'auth:'):
+        fpath = _firds_file(tmp_path / f'firds{prefix[:-1]}.xml', [
+            # XS0000000018 appears in this record, but isn't its ISIN.
+            _refdata('XS0000000026', 'LEI2', 'GBP', 50.0, 'GB', venue_id='XS0000000018', prefix=prefix),
+            _refdata('XS0000000018', 'LEI1', 'EUR', 100.0, 'IE', prefix=prefix),
+            _refdata('XS0000000034', 'LEI3', 'USD', 75.0, 'LU', prefix=prefix),
+        ], prefix=prefix)
+        results, missing = fp.search_isins({'XS0000000018', 'XS0000000034', 'XS0000000042'}, fpath)
+        assert results == {
+            'XS0000000018': {'Currency': 'EUR', 'Issuer LEI': 'LEI1', 'Competent Authority': 'IE',
+                             'Nominal Amount': ('EUR', 100.0)},
+            'XS0000000034': {'Currency': 'USD', 'Issuer LEI': 'LEI3', 'Competent Authority': 'LU',
+                             'Nominal Amount': ('USD', 75.0)}
+        }
+        assert missing == {'XS0000000042'}
+
+
+def test_search_isins_empty_file(tmp_path):
+    (tmp_path / 'empty.xml').write_bytes(b'')
+    assert fd.FIRDSParser().search_isins({'XS0000000018'}, str(tmp_path / 'empty.xml')) == ({}, {'XS0000000018'})
+
+
+def test_register_index_positions_between():
+    dates = pd.to_datetime(['2020-03-01', '2020-01-15', None, '2020-02-01', '2020-01-15'])
+    df = pd.DataFrame({
+        'Unique Securitisation Identifier': [f'USI{i}' for i in range(5)],
+        'ISIN code': None,
+        'Notification date to ESMA': dates
+    })
+    index = fd.RegisterIndex(df)
+    # Positions are in their original order, and the range is inclusive at both ends.
+    assert index.positions_between(datetime(2020, 1, 15), datetime(2020, 2, 1)).tolist() == [1, 3, 4]
+    assert index.positions_between(datetime(2020, 1, 16)).tolist() == [0, 3]
+    assert index.positions_between(to_date=datetime(2020, 1, 15)).tolist() == [1, 4]
+    # Rows with no date are never included.
+    assert index.positions_between().tolist() == [0, 1, 3, 4]
+    assert index.positions_between(datetime(2021, 1, 1)).tolist() == []
+    assert index.get_between(datetime(2020, 2, 1)).index.tolist() == [0, 3]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+from os import listdir
+
+import pandas as pd
+
+import ingest
+
+
+def test_read_excel_cached_keeps_latest_entry(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, 'cache_dir', str(tmp_path / 'cache'))
+    fpath = str(tmp_path / 'book.xlsx')
+    pd.DataFrame({'Name': ['a', 'b'], ' Amount ': [1, ':'], 'Other': [0, 0]}).to_excel(fpath, index=False)
+
+    df = ingest.read_excel_cached(fpath, {'Name': 'str', 'Amount': 'float'})
+    assert df.columns.tolist() == ['Name', 'Amount']
+    assert df['Name'].tolist() == ['a', 'b']
+    assert df['Amount'].iloc[0] == 1 and pd.isnull(df['Amount'].iloc[1])
+    assert len(listdir(ingest.cache_dir)) == 1
+    # Read from the cache.
+    pd.testing.assert_frame_equal(ingest.read_excel_cached(fpath, {'Name': 'str', 'Amount': 'float'}), df)
+
+    # Another way of reading the same workbook has its own entry.
+    ingest.read_excel_cached(fpath, {'Name': 'str'})
+    assert len(listdir(ingest.cache_dir)) == 2
+
+    # Updating the workbook replaces its entry, rather than adding another.
+    pd.DataFrame({'Name': ['c'], ' Amount ': [2], 'Other': [0]}).to_excel(fpath, index=False)
+    assert ingest.read_excel_cached(fpath, {'Name': 'str', 'Amount': 'float'})['Name'].tolist() == ['c']
+    assert len(listdir(ingest.cache_dir)) == 2
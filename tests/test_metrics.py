@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import flask
+
+import metrics
+
+
+def _app(monkeypatch) -> flask.Flask:
+    registry = metrics.Registry()
+    monkeypatch.setattr(metrics, 'registry', registry)
+    monkeypatch.setattr(metrics, 'observe_request', registry.observe_request)
+    app = flask.Flask(__name__)
+
+    @app.route('/stream')
+    def stream():
+        def body():
+            for chunk in ('abc', 'défg'):
+                time.sleep(0.1)
+                yield chunk
+        return flask.Response(flask.stream_with_context(body()))
+
+    @app.route('/plain')
+    def plain():
+        return 'hello'
+
+    metrics.init_app(app)
+    return app
+
+
+def test_streamed_response_recorded_when_sent(monkeypatch):
+    app = _app(monkeypatch)
+    response = app.test_client().get('/stream', buffered=False)
+    # Nothing is recorded until the body has been sent.
+    assert 'other' not in metrics.registry.latency
+    body = b''.join(response.response)
+    response.close()
+    assert body == 'abcdéfg'.encode('utf-8')
+    assert metrics.registry.size['other'].sum == len(body)
+    assert metrics.registry.latency['other'].sum >= 0.2
+
+
+def test_plain_response_recorded(monkeypatch):
+    app = _app(monkeypatch)
+    app.test_client().get('/plain')
+    assert metrics.registry.size['other'].sum == 5
+    assert metrics.registry.latency['other'].count == 1
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from name_match import NameIndex, identifiers, identifiers_conflict, normalise_name
+
+
+def _issuer(name: str, lei: str, country: str = 'DE'):
+    return {'LEI': {'$': lei}, 'Entity': {'LegalName': {'$': name}, 'LegalJurisdiction': {'$': country}}}
+
+
+@pytest.mark.parametrize('name, normalised', [
+    ('Bumper DE S.A.', 'bumper de'),
+    ('Red & Black Auto Germany 7 UG (haftungsbeschränkt)', 'red and black auto germany 7 haftungsbeschr nkt'),
+    ('Globaldrive Auto Receivables UK 2019-B', 'globaldrive auto receivables uk 2019 b'),
+    ('SC Germany S.A., Compartment Consumer 2020-1', 'sc germany consumer 2020 1'),
+    ('Silver Arrow Merfina 2019-1 S.R.L.', 'silver arrow merfina 2019 1'),
+])
+def test_normalise_name(name, normalised):
+    assert normalise_name(name) == normalised
+
+
+def test_identifiers():
+    assert identifiers('globaldrive auto receivables uk 2019 b') == {'2019', 'b'}
+    assert identifiers('pbd germany auto lease master ii') == {'ii'}
+    assert identifiers('bumper de') == set()
+
+
+@pytest.mark.parametrize('a, b, conflict', [
+    ('Globaldrive Auto Receivables UK 2019-B', 'Globaldrive Auto Receivables 2019-A B.V.', True),
+    ('SC Germany Consumer 2019-1', 'SC Germany S.A., Compartment Consumer 2020-1', True),
+    ('Red & Black Auto Germany 6', 'Red & Black Auto Germany 7 UG', True),
+    ('Red & Black Auto Germany 6', 'Red & Black Auto Germany 6 UG', False),
+    ('Bumper DE 2019-1', 'Bumper DE S.A.', False),
+])
+def test_identifiers_conflict(a, b, conflict):
+    assert identifiers_conflict(a, b) is conflict
+    assert identifiers_conflict(b, a) is conflict
+
+
+def test_name_index_match():
+    index = NameIndex()
+    index.update([
+        ('Red & Black Auto Germany 7 UG', 1),
+        ('SC Germany S.A., Compartment Consumer 2020-1', 2),
+        ('Bumper DE S.A.', 3),
+        ('Silver Arrow Merfina 2019-1 S.R.L.', 4),
+    ])
+    assert len(index) == 4
+    name, payload, score = index.match('Red and Black Auto Germany 7')[0]
+    assert (name, payload) == ('Red & Black Auto Germany 7 UG', 1)
+    assert score == pytest.approx(1.0)
+    matches = index.match('Bumper DE', limit=3)
+    assert matches[0][1] == 3
+    assert [m[2] for m in matches] == sorted((m[2] for m in matches), reverse=True)
+    assert index.match('zzzz') == []
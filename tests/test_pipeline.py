@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+import sys
+from typing import Callable, List
+
+import pandas as pd
+import pytest
+
+import crosstab
+import pipeline
+from pipeline import Pipeline, Stage
+
+SCALE = 2
+
+
+def helper(x):
+    return x * SCALE
+
+
+def other_helper(x):
+    return x * 3
+
+
+def uses_helper(x):
+    return helper(x)
+
+
+def uses_app_function(series):
+    return crosstab.group_count(series)
+
+
+def test_code_hash_follows_helpers_and_constants(monkeypatch):
+    stage = Stage('s', uses_helper)
+    before = stage.code_hash()
+    assert Stage('s', uses_helper).code_hash() == before
+    # A helper in the same module, found without being declared in `uses`.
+    monkeypatch.setattr(sys.modules[__name__], 'helper', other_helper)
+    assert stage.code_hash() != before
+    monkeypatch.undo()
+    # A constant referred to by a helper.
+    monkeypatch.setattr(sys.modules[__name__], 'SCALE', 4)
+    assert stage.code_hash() != before
+    monkeypatch.undo()
+    assert stage.code_hash() == before
+    assert Stage('s', uses_helper, version=2).code_hash() != before
+
+
+def test_code_hash_follows_app_module_attributes(monkeypatch):
+    stage = Stage('s', uses_app_function)
+    before = stage.code_hash()
+    # A function the stage uses from another of the app's modules is part of its hash...
+    monkeypatch.setattr(crosstab, 'group_count', other_helper)
+    assert stage.code_hash() != before
+    monkeypatch.undo()
+    # ...but the rest of that module isn't.
+    monkeypatch.setattr(crosstab, 'fold_small', other_helper)
+    assert stage.code_hash() == before
+
+
+def test_unrelated_change_leaves_register_cached(monkeypatch):
+    register = pipeline.data_pipeline.stages['register']
+    before = register.code_hash()
+    # register uses fetch_data's RegisterParser (and what its methods use), but not get_fx.
+    monkeypatch.setattr(pipeline.fd, 'get_fx', other_helper)
+    assert register.code_hash() == before
+    monkeypatch.setattr(pipeline.fd.RegisterParser, 'check_isin', staticmethod(other_helper))
+    assert register.code_hash() != before
+    monkeypatch.undo()
+    # Nor does a change to a constant in another module which it doesn't use.
+    monkeypatch.setattr(pipeline.fd, 'NAME_MATCH_THRESHOLD', 0.5)
+    assert register.code_hash() == before
+    monkeypatch.setattr(pipeline.fd, 'iso_to_name', dict(pipeline.fd.iso_to_name, XX='Nowhere'))
+    assert register.code_hash() != before
+
+
+def test_provided_hashes(tmp_path):
+    p = Pipeline(str(tmp_path))
+    calls = []
+
+    @p.stage()
+    def base():
+        return pd.DataFrame({'a': [1, 2, 3]})
+
+    @p.stage(deps=('base',))
+    def total(base):
+        calls.append('total')
+        return int(base['a'].sum())
+
+    assert p.build(['total'])['total'] == 6
+    with open(p.output_file('base'), 'rb') as f:
+        data = f.read()
+    # Provided as if loaded from a copy of the cached output, with the hash of
+    # that copy: the downstream stage is found in the cache.
+    out = p.build(['total'], provided={'base': pickle.loads(data)},
+                  provided_hashes={'base': pipeline.sha256(data).hexdigest()})
+    assert out['total'] == 6
+    assert calls == ['total']
+    assert p.report['total']['status'] == 'cached'
+    # Different data under its own hash is rebuilt.
+    out = p.build(['total'], provided={'base': pd.DataFrame({'a': [4]})})
+    assert out['total'] == 4
+    assert calls == ['total', 'total']
+
+
+def test_unknown_stage(tmp_path):
+    with pytest.raises(KeyError):
+        Pipeline(str(tmp_path)).build(['missing'])
+
+
+def _counting_pipeline(cache_dir: str, base: Callable, calls: List[str], fail: List[bool]) -> Pipeline:
+    p = Pipeline(cache_dir)
+    p.stage(name='base')(base)
+
+    @p.stage(deps=('base',))
+    def doubled(base):
+        calls.append('doubled')
+        if fail[0]:
+            raise RuntimeError('interrupted')
+        return base * 2
+
+    @p.stage(deps=('doubled',))
+    def total(doubled):
+        calls.append('total')
+        return int(doubled['a'].sum())
+
+    return p
+
+
+def _base():
+    return pd.DataFrame({'a': [1, 2, 3]})
+
+
+def _same_base():
+    # Different code, same output.
+    return pd.DataFrame({'a': list(range(1, 4))})
+
+
+def test_build_resumes_and_caches(tmp_path):
+    calls = []
+    fail = [True]
+    p = _counting_pipeline(str(tmp_path), _base, calls, fail)
+    with pytest.raises(RuntimeError):
+        p.build(['total'])
+    assert calls == ['doubled']
+
+    # The stage completed before the failure isn't re-run.
+    fail[0] = False
+    assert p.build(['total'])['total'] == 12
+    assert calls == ['doubled', 'doubled', 'total']
+    assert [p.report[n]['status'] for n in ('base', 'doubled', 'total')] == ['cached', 'built', 'built']
+
+    # Nothing is re-run, even by a new Pipeline using the same cache.
+    p = _counting_pipeline(str(tmp_path), _base, calls, fail)
+    assert p.build(['total'])['total'] == 12
+    assert calls == ['doubled', 'doubled', 'total']
+    assert {r['status'] for r in p.report.values()} == {'cached'}
+
+
+def test_unchanged_output_does_not_rebuild_downstream(tmp_path):
+    calls = []
+    p = _counting_pipeline(str(tmp_path), _base, calls, [False])
+    p.build(['total'])
+    assert calls == ['doubled', 'total']
+
+    # base is re-run, as its code has changed, but its output hasn't, so the
+    # stages that depend on it are found in the cache.
+    p = _counting_pipeline(str(tmp_path), _same_base, calls, [False])
+    assert p.build(['total'])['total'] == 12
+    assert p.report['base']['status'] == 'built'
+    assert p.report['doubled']['status'] == p.report['total']['status'] == 'cached'
+    assert calls == ['doubled', 'total']